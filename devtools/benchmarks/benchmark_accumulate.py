@@ -0,0 +1,89 @@
+""" Benchmark the accumulation of atomic contributions to the potential V.
+
+Compares fancy-index += (the previous implementation, which drops repeated
+grid points), np.add.at, np.bincount and the compiled scatter kernel used by
+DefaultProjector.add_to_grid on
+    - a small water cell, where the boxes are larger than the cell and wrap
+    - a large slab with many atoms
+
+Usage: python benchmark_accumulate.py [n_repeat]
+"""
+import sys
+import time
+import numpy as np
+from neuralxc.projector import DensityProjector
+from neuralxc.projector import kernels
+
+SYSTEMS = {
+    'water_small': {
+        'unitcell': np.eye(3) * 3.0,
+        'grid': np.array([20, 20, 20]),
+        'basis': {'O': {'n': 4, 'l': 4, 'r_o': 2.0}, 'H': {'n': 3, 'l': 3, 'r_o': 1.5}},
+        'positions': np.array([[1.5, 1.5, 1.5], [2.26, 2.09, 1.5], [0.74, 2.09, 1.5]]),
+        'species': ['O', 'H', 'H'],
+    },
+    'slab_large': {
+        'unitcell': np.diag([20.0, 20.0, 60.0]),
+        'grid': np.array([100, 100, 300]),
+        'basis': {'O': {'n': 4, 'l': 4, 'r_o': 2.0}},
+        'positions': np.array([[x, y, z] for x in np.arange(1, 20, 2.5) for y in np.arange(1, 20, 2.5)
+                               for z in np.arange(20, 40, 2.5)]),
+        'species': None,
+    },
+}
+
+
+def fancy_index(V, mesh, v):
+    V[mesh] += v
+
+
+def add_at(V, mesh, v):
+    np.add.at(V, mesh, v)
+
+
+def bincount(V, mesh, v):
+    flat = np.ravel_multi_index(mesh, V.shape).ravel()
+    V += np.bincount(flat, v.ravel(), minlength=V.size).reshape(V.shape)
+
+
+def scatter(V, mesh, v):
+    flat = np.ravel_multi_index(mesh, V.shape).ravel()
+    kernels.scatter_add(V.reshape(-1), flat, v.ravel())
+
+
+METHODS = {'fancy_index': fancy_index, 'add_at': add_at, 'bincount': bincount, 'scatter': scatter}
+
+
+def benchmark(system, n_repeat=3):
+    species = system['species'] or ['O'] * len(system['positions'])
+    projector = DensityProjector(system['unitcell'], system['grid'], system['basis'])
+    contributions = []
+    for pos, spec in zip(system['positions'], species):
+        box = projector.box_around(pos, system['basis'][spec]['r_o'])
+        contributions.append((tuple(box['mesh']), np.random.rand(*box['mesh'][0].shape)))
+
+    reference = np.zeros(system['grid'])
+    for mesh, v in contributions:
+        add_at(reference, mesh, v)
+
+    results = {}
+    for name, method in METHODS.items():
+        V = np.zeros(system['grid'])
+        method(V, *contributions[0])  # Compilation
+        timings = []
+        for _ in range(n_repeat):
+            V = np.zeros(system['grid'])
+            start = time.perf_counter()
+            for mesh, v in contributions:
+                method(V, mesh, v)
+            timings.append(time.perf_counter() - start)
+        results[name] = {'time': min(timings), 'exact': bool(np.allclose(V, reference))}
+    return results
+
+
+if __name__ == '__main__':
+    n_repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for name, system in SYSTEMS.items():
+        print('{} ({} atoms, grid {})'.format(name, len(system['positions']), system['grid'].tolist()))
+        for method, result in benchmark(system, n_repeat).items():
+            print('    {:12s} {:10.5f} s   exact: {}'.format(method, result['time'], result['exact']))
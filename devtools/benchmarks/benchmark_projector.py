@@ -0,0 +1,204 @@
+""" Micro-benchmarks of the density projectors on synthetic densities.
+
+A density is built as a sum of Gaussians centered on randomly placed atoms
+(fixed seed) in a cubic cell. For every registered projector type
+(ortho, non-ortho, behler, sparse, fft, ...) the following are timed
+    - precompute_stencils (new projector, empty stencil library)
+    - get_basis_rep
+    - get_V and get_V with calc_forces=True
+    - box_around (all atoms)
+    - get_radials (on the box of one atom per species)
+Times are the minimum and mean over n_repeat runs after one warm-up run
+(compilation). Results are stored as JSON so that runs on different commits
+can be compared.
+
+Usage:
+    python benchmark_projector.py [--systems small medium] [--projectors ortho fft]
+                                  [--repeat 3] [--out results.json]
+    python benchmark_projector.py --system custom --cell 12 --grid 60 --atoms 16
+    python benchmark_projector.py --compare old.json new.json [--threshold 1.2]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import neuralxc
+from neuralxc.projector import DensityProjector
+from neuralxc.projector.projector import BaseProjector, stencil_library
+
+SYSTEMS = {
+    'small': {'cell': 8.0, 'grid': 40, 'atoms': 4},
+    'medium': {'cell': 15.0, 'grid': 80, 'atoms': 32},
+    'large': {'cell': 25.0, 'grid': 128, 'atoms': 128},
+}
+
+BASIS = {'O': {'n': 4, 'l': 4, 'r_o': 2.0}, 'H': {'n': 3, 'l': 3, 'r_o': 1.5}}
+CHARGES = {'O': 8.0, 'H': 1.0}
+
+
+def projector_types():
+    return [name for name in BaseProjector.get_registry() if not name in ['default', 'base', 'pyscf']]
+
+
+def make_system(cell, grid, atoms, seed=42):
+    """ Random atoms in a cubic cell and the sum of Gaussians centered on them
+
+    Returns
+    -------
+        unitcell, grid, positions, species, rho
+    """
+    rng = np.random.RandomState(seed)
+    unitcell = np.eye(3) * cell
+    grid = np.array([grid] * 3)
+    positions = rng.rand(atoms, 3) * cell
+    species = ['O' if i % 3 == 0 else 'H' for i in range(atoms)]
+
+    # Minimum image distance of every grid point to every atom
+    frac = [np.arange(g) / g for g in grid]
+    rho = np.zeros(grid)
+    for pos, spec in zip(positions, species):
+        d = [(f - p / cell + 0.5) % 1 - 0.5 for f, p in zip(frac, pos)]
+        r2 = (d[0][:, None, None]**2 + d[1][None, :, None]**2 + d[2][None, None, :]**2) * cell**2
+        sigma = 0.5 if spec == 'O' else 0.3
+        rho += CHARGES[spec] * np.exp(-r2 / (2 * sigma**2)) / (2 * np.pi * sigma**2)**1.5
+    return unitcell, grid, positions, species, rho
+
+
+def timeit(func, n_repeat):
+    func()  # Warm-up, compilation
+    timings = []
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {'min': min(timings), 'mean': float(np.mean(timings)), 'repeat': n_repeat}
+
+
+def benchmark(projector_type, unitcell, grid, positions, species, rho, n_repeat=3):
+    basis_instructions = dict(BASIS, projector_type=projector_type)
+    projector = DensityProjector(unitcell, grid, basis_instructions)
+    results = {}
+
+    def precompute():
+        stencil_library.clear()
+        DensityProjector(unitcell, grid, basis_instructions).precompute_stencils(positions, species)
+
+    results['precompute_stencils'] = timeit(precompute, n_repeat)
+    projector.precompute_stencils(positions, species)
+
+    basis_rep = projector.get_basis_rep(rho, positions, species)
+    dEdC = {spec: np.ones_like(basis_rep[spec]) for spec in basis_rep}
+    results['get_basis_rep'] = timeit(lambda: projector.get_basis_rep(rho, positions, species), n_repeat)
+    results['get_V'] = timeit(lambda: projector.get_V(dEdC, positions, species), n_repeat)
+    results['get_V_forces'] = timeit(lambda: projector.get_V(dEdC, positions, species, calc_forces=True, rho=rho),
+                                     n_repeat)
+
+    def box_around():
+        for pos, spec in zip(positions, species):
+            projector.box_around(pos, BASIS[spec]['r_o'])
+
+    results['box_around'] = timeit(box_around, n_repeat)
+
+    radii = {}
+    for pos, spec in zip(positions, species):
+        if not spec in radii:
+            radii[spec] = projector.box_around(pos, BASIS[spec]['r_o'])['radial'][0]
+
+    def radials():
+        for spec in radii:
+            projector.get_radials(radii[spec], projector.basis[spec], projector.W[spec])
+
+    results['radials'] = timeit(radials, n_repeat)
+    return results
+
+
+def get_metadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = ''
+    return {
+        'commit': commit,
+        'neuralxc': getattr(neuralxc, '__version__', ''),
+        'numpy': np.__version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'date': datetime.datetime.now().isoformat(),
+    }
+
+
+def run(systems, projectors, n_repeat):
+    results = {'meta': get_metadata(), 'systems': systems, 'results': {}}
+    for name, system in systems.items():
+        unitcell, grid, positions, species, rho = make_system(**system)
+        print('{} ({} atoms, grid {})'.format(name, system['atoms'], grid.tolist()))
+        results['results'][name] = {}
+        for projector_type in projectors:
+            timings = benchmark(projector_type, unitcell, grid, positions, species, rho, n_repeat)
+            results['results'][name][projector_type] = timings
+            for bench, timing in timings.items():
+                print('    {:10s} {:20s} {:10.5f} s'.format(projector_type, bench, timing['min']))
+    return results
+
+
+def compare(old, new, threshold=1.2):
+    """ Print the ratio new/old of the minimum times, mark ratios above threshold
+
+    Returns
+    -------
+        int
+            number of regressions
+    """
+    regressions = 0
+    print('{:8s} {:10s} {:20s} {:>10s} {:>10s} {:>7s}'.format('system', 'projector', 'benchmark', 'old', 'new',
+                                                                'ratio'))
+    for system in new['results']:
+        for projector_type in new['results'][system]:
+            for bench, timing in new['results'][system][projector_type].items():
+                try:
+                    t_old = old['results'][system][projector_type][bench]['min']
+                except KeyError:
+                    continue
+                ratio = timing['min'] / t_old
+                flag = ' <--' if ratio > threshold else ''
+                regressions += ratio > threshold
+                print('{:8s} {:10s} {:20s} {:10.5f} {:10.5f} {:7.2f}{}'.format(system, projector_type, bench, t_old,
+                                                                              timing['min'], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark density projectors on synthetic densities')
+    parser.add_argument('--systems', nargs='+', default=['small', 'medium'], help='Presets ({})'.format(', '.join(SYSTEMS)))
+    parser.add_argument('--system', type=str, default='', help='Name of a custom system (set --cell, --grid, --atoms)')
+    parser.add_argument('--cell', type=float, default=10.0, help='Edge of the cubic cell in bohr (custom system)')
+    parser.add_argument('--grid', type=int, default=50, help='Grid points along each axis (custom system)')
+    parser.add_argument('--atoms', type=int, default=8, help='Number of atoms (custom system)')
+    parser.add_argument('--projectors', nargs='+', default=projector_types(), help='Projector types')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs')
+    parser.add_argument('--out', type=str, default='', help='Store results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two JSON results instead')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Ratio new/old reported as regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        old, new = [json.load(open(path)) for path in args.compare]
+        sys.exit(1 if compare(old, new, args.threshold) else 0)
+
+    if args.system:
+        systems = {args.system: {'cell': args.cell, 'grid': args.grid, 'atoms': args.atoms}}
+    else:
+        systems = {name: SYSTEMS[name] for name in args.systems}
+
+    results = run(systems, args.projectors, args.repeat)
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(results, file, indent=2)
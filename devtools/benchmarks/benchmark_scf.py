@@ -0,0 +1,167 @@
+""" End-to-end benchmark of the NeuralXC adapters, driven the way an SCF
+cycle drives them: initialize once, then get_V repeatedly on slowly changing
+densities (and once more with forces at the end).
+
+SIESTA: uses the benzene fixture in neuralxc/tests/benzene_test (model,
+density and structure). Larger systems are built by tiling the cell
+(--supercell 2 2 1), which keeps density and structure consistent.
+
+PySCF (optional): --pyscf MODEL runs PySCFNXC.get_V with the initial guess
+density matrix of the molecule in --xyz (basis --basis) for a model that was
+fitted with application 'pyscf'.
+
+Reports per number of workers the median latency of initialize, get_V and
+get_V with forces, the throughput in SCF steps per second and the speedup
+relative to the first worker count.
+
+Usage:
+    python benchmark_scf.py [--workers 1 2 4] [--backend thread] [--steps 10]
+                            [--supercell 2 2 1] [--out results.json]
+    python benchmark_scf.py --pyscf path/to/model --xyz molecule.xyz --basis def2-svp
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import time
+import numpy as np
+from ase.io import read
+from neuralxc.neuralxc import get_nxc_adapter
+from neuralxc.utils import SiestaDensityGetter
+from neuralxc.constants import Bohr
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'neuralxc', 'tests', 'benzene_test')
+
+
+def load_siesta_system(supercell=(1, 1, 1)):
+    """ Benzene fixture, tiled supercell times
+
+    Returns
+    -------
+        rho, unitcell, grid, positions (bohr), atomic numbers
+    """
+    rho, unitcell, grid = SiestaDensityGetter(binary=True).get_density(os.path.join(TEST_DIR, 'benzene.RHOXC'))
+    atoms = read(os.path.join(TEST_DIR, 'benzene.xyz'), '0')
+    positions = atoms.get_positions() / Bohr
+    numbers = atoms.get_atomic_numbers()
+
+    shifts = [np.dot([i, j, k], unitcell) for i in range(supercell[0]) for j in range(supercell[1])
+              for k in range(supercell[2])]
+    positions = np.concatenate([positions + shift for shift in shifts])
+    numbers = np.concatenate([numbers] * len(shifts))
+    rho = np.tile(rho, supercell)
+    unitcell = unitcell * np.array(supercell)[:, None]
+    grid = np.array(grid) * np.array(supercell)
+    return rho, unitcell, grid, positions, numbers
+
+
+def median_time(func, n_repeat):
+    timings = []
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def benchmark_siesta(model, workers, backend, n_steps, supercell):
+    rho, unitcell, grid, positions, numbers = load_siesta_system(supercell)
+    # Arrays as passed by SIESTA (Fortran order)
+    rho_f = rho.ravel(order='F')
+    step = iter(range(10**9))
+
+    results = {'system': {'atoms': len(numbers), 'grid': grid.tolist(), 'supercell': list(supercell)}, 'workers': {}}
+    V_ref = None
+    for max_workers in workers:
+        with contextlib.redirect_stdout(io.StringIO()):
+            adapter = get_nxc_adapter('siesta', model, {'max_workers': max_workers, 'backend': backend})
+            t_init = median_time(lambda: adapter.initialize(rho_f, unitcell.T, grid, positions.T, numbers), 1)
+
+            def scf_step(calc_forces=False):
+                # SCF densities change slightly from step to step
+                V = np.zeros((len(rho_f), 1))
+                adapter.get_V(rho_f * (1 + 1e-4 * next(step)), unitcell.T, grid, positions.T, numbers, V,
+                              calc_forces)
+                return V
+
+            scf_step()  # Warm-up, compilation
+            scf_step(True)
+            t_step = median_time(scf_step, n_steps)
+            t_forces = median_time(lambda: scf_step(True), max(1, n_steps // 5))
+            V = np.zeros((len(rho_f), 1))
+            adapter.get_V(rho_f, unitcell.T, grid, positions.T, numbers, V)
+        if adapter._adaptee._process_backend is not None:
+            adapter._adaptee._process_backend.close()
+
+        if V_ref is None:
+            V_ref = V
+        results['workers'][max_workers] = {
+            'initialize': t_init,
+            'get_V': t_step,
+            'get_V_forces': t_forces,
+            'steps_per_second': 1 / t_step,
+            'speedup': results['workers'][workers[0]]['get_V'] / t_step if results['workers'] else 1.0,
+            'max_deviation': float(np.max(np.abs(V - V_ref)))
+        }
+    return results
+
+
+def benchmark_pyscf(model, xyz, basis, workers, n_steps):
+    from pyscf import gto
+    from pyscf.scf import RHF
+
+    atoms = read(xyz, '0')
+    mol = gto.M(atom=[[s, p] for s, p in zip(atoms.get_chemical_symbols(), atoms.get_positions())], basis=basis)
+    dm = RHF(mol).init_guess_by_atom()
+
+    results = {'system': {'atoms': len(atoms), 'basis': basis, 'nao': mol.nao_nr()}, 'workers': {}}
+    for max_workers in workers:
+        with contextlib.redirect_stdout(io.StringIO()):
+            adapter = get_nxc_adapter('pyscf', model, {'max_workers': max_workers})
+            t_init = median_time(lambda: adapter.initialize(mol), 1)
+            adapter.get_V(dm)  # Warm-up
+            t_step = median_time(lambda: adapter.get_V(dm), n_steps)
+        results['workers'][max_workers] = {
+            'initialize': t_init,
+            'get_V': t_step,
+            'steps_per_second': 1 / t_step,
+            'speedup': results['workers'][workers[0]]['get_V'] / t_step if results['workers'] else 1.0
+        }
+    return results
+
+
+def print_results(name, results):
+    print('{} {}'.format(name, results['system']))
+    print('    {:>7s} {:>12s} {:>12s} {:>14s} {:>10s} {:>8s}'.format('workers', 'initialize', 'get_V', 'get_V_forces',
+                                                                   'steps/s', 'speedup'))
+    for max_workers, result in results['workers'].items():
+        print('    {:7d} {:12.4f} {:12.4f} {:>14s} {:10.2f} {:8.2f}'.format(
+            max_workers, result['initialize'], result['get_V'],
+            '{:.4f}'.format(result['get_V_forces']) if 'get_V_forces' in result else '-',
+            result['steps_per_second'], result['speedup']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark SCF steps through the NeuralXC adapters')
+    parser.add_argument('--model', type=str, default=os.path.join(TEST_DIR, 'benzene'), help='SIESTA model')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Values of max_workers')
+    parser.add_argument('--backend', type=str, default='thread', choices=['thread', 'process'])
+    parser.add_argument('--steps', type=int, default=10, help='SCF steps (calls to get_V) per measurement')
+    parser.add_argument('--supercell', type=int, nargs=3, default=[1, 1, 1], help='Tile the benzene cell')
+    parser.add_argument('--pyscf', type=str, default='', help='PySCF model, benchmark PySCFNXC instead')
+    parser.add_argument('--xyz', type=str, default=os.path.join(TEST_DIR, 'benzene.xyz'), help='Molecule (PySCF)')
+    parser.add_argument('--basis', type=str, default='def2-svp', help='Basis set of the molecule (PySCF)')
+    parser.add_argument('--out', type=str, default='', help='Store results as JSON')
+    args = parser.parse_args()
+
+    if args.pyscf:
+        results = {'pyscf': benchmark_pyscf(args.pyscf, args.xyz, args.basis, args.workers, args.steps)}
+    else:
+        results = {'siesta': benchmark_siesta(args.model, args.workers, args.backend, args.steps, args.supercell)}
+
+    for name in results:
+        print_results(name, results[name])
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(results, file, indent=2)
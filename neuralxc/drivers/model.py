@@ -119,9 +119,10 @@ def parse_sets_input(path):
     return hdf5
 
 
-def convert_tf(tf_path, np_path):
+def convert_tf(tf_path, np_path, compile_model=False):
     """ Converts the tensorflow estimator inside a NXCPipeline to a simple
-    numpy base estimator"""
+    numpy base estimator. If compile_model, the transformers preceding the
+    estimator are folded into its first layer (see NXCPipeline.compile)"""
 
     nxc_tf = xc.NeuralXC(tf_path)
     pipeline = nxc_tf._pipeline
@@ -134,11 +135,14 @@ def convert_tf(tf_path, np_path):
     D = nxc_tf.symmetrizer.get_symmetrized(C)
     nxc_tf._pipeline.predict(D)
     nxc_tf._pipeline.save(np_path, True, True)
+    if compile_model:
+        load_pipeline(np_path).compile().save(np_path, True, True)
 
 
-def merge_driver(chained, merged):
+def merge_driver(chained, merged, compile_model=False):
     """ Converts the tensorflow estimator inside a NXCPipeline to a simple
-    numpy base estimator"""
+    numpy base estimator. If compile_model, the transformers preceding the
+    estimator are folded into its first layer (see NXCPipeline.compile)"""
 
     nxc_tf = xc.NeuralXC(chained)
     pipeline = nxc_tf._pipeline
@@ -170,6 +174,8 @@ def merge_driver(chained, merged):
     pipeline.steps[-2] = (label, ChainedEstimator([npestimator, estimator]).merge())
     pipeline.steps = pipeline.steps[:-1]
     nxc_tf._pipeline.save(merged, True, True)
+    if compile_model:
+        load_pipeline(merged).compile().save(merged, True, True)
 
 
 def adiabatic_driver(xyz,
@@ -208,3 +208,46 @@ def pre_driver(xyz, srcdir, preprocessor, dest='.tmp/'):
             f.close()
     if delete_workdir:
         shutil.rmtree(workdir)
+
+
+def replay_driver(model,
+                  density,
+                  xyz,
+                  constant='',
+                  forces=False,
+                  workers=1,
+                  backend='thread',
+                  repeat=1,
+                  memory='tracemalloc',
+                  dest='NXC_TIMING'):
+    """ Replay a (SIESTA) density through NeuralXC.get_V and print the time
+    and memory spent in every stage
+    """
+    from neuralxc.timer import enable_timer
+    timer = enable_timer(dest, memory=None if memory == 'none' else memory)
+
+    density_getter = xc.utils.SiestaDensityGetter(binary=True)
+    rho, unitcell, grid = density_getter.get_density(density)
+    atoms = read(xyz, '0')
+    positions = atoms.get_positions() / xc.constants.Bohr
+    species = atoms.get_chemical_symbols()
+
+    nxc = xc.NeuralXC(model)
+    nxc.max_workers = workers
+    nxc.backend = backend
+    timer.start('initialize')
+    nxc.initialize(unitcell, grid, positions, species)
+    if constant:
+        rho_const, _, _ = density_getter.get_density(constant)
+        nxc.set_constant_density(rho_const)
+    timer.stop('initialize')
+
+    for _ in range(repeat):
+        E, _ = nxc.get_V(rho, calc_forces=forces)
+    if nxc._process_backend is not None:
+        nxc._process_backend.close()
+
+    timer.create_report()
+    print(timer.format_report())
+    print('Enxc = {} eV'.format(E))
+    print('Report written to {0}, {0}.json and {0}.trace.json'.format(timer.path))
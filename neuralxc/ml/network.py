@@ -99,6 +99,33 @@ class NXCPipeline(Pipeline):
             basis_instructions=self.basis_instructions,
             symmetrize_instructions=self.symmetrize_instructions)
 
+    def compile(self):
+        """ Fold the affine transformers (variance threshold, scaler, PCA)
+        directly preceding the final NumpyNetworkEstimator into the first
+        layer of its networks. The returned pipeline gives the same
+        predictions and gradients, but skips the transformers.
+
+        Returns
+        -------
+        NXCPipeline
+        """
+        label, estimator = self.steps[-1]
+        if not isinstance(estimator, NumpyNetworkEstimator):
+            raise Exception('Only pipelines ending in a NumpyNetworkEstimator can be compiled,'\
+            + ' use convert-tf or merge first')
+
+        steps = list(self.steps[:-1])
+        W = {spec: estimator.W[spec][0] for spec in estimator.W}
+        B = {spec: estimator.B[spec][0] for spec in estimator.B}
+        while steps and hasattr(steps[-1][-1], '_fold_function'):
+            _, transformer = steps.pop()
+            W, B = transformer.fold(W, B)
+
+        W = {spec: [W[spec]] + list(estimator.W[spec][1:]) for spec in W}
+        B = {spec: [B[spec]] + list(estimator.B[spec][1:]) for spec in B}
+        compiled = NumpyNetworkEstimator(W, B, estimator.activation, getattr(estimator, 'trunc', False))
+        return NXCPipeline(steps + [(label, compiled)], self.basis_instructions, self.symmetrize_instructions)
+
     def _make_serializable(self, path):
         return self.steps[-1][-1]._make_serializable(os.path.join(path, 'network'))
 
@@ -284,22 +311,28 @@ class NumpyNetworkEstimator(BaseEstimator):
         if not hasattr(self, 'trunc'):
             self.trunc = False
 
-        # del z_1/ del x_i
-        gradient = np.array([np.eye(len(W[0]))] * len(x)).swapaxes(0, 1)
-
-        Z = []
-        for w, b in zip(W[:], B[:]):
-            x = x.dot(w) + b
-            Z.append(self.activation.df(x))
-            x = self.activation.f(x)
-
         if not self.trunc:
-            for w, z in zip(W[:-1], Z[:-1]):
-                gradient = gradient.dot(w) * z
-
-            gradient = gradient.dot(W[-1])
-            return gradient[:, :, 0].T
+            # Backpropagation, the output layer is linear
+            Z = []
+            for w, b in zip(W[:-1], B[:-1]):
+                x = x.dot(w) + b
+                Z.append(self.activation.df(x))
+                x = self.activation.f(x)
+
+            gradient = np.tile(W[-1][:, 0], (len(x), 1))
+            for w, z in zip(W[-2::-1], Z[::-1]):
+                gradient = (gradient * z).dot(w.T)
+            return gradient
         else:
+            # del z_1/ del x_i
+            gradient = np.array([np.eye(len(W[0]))] * len(x)).swapaxes(0, 1)
+
+            Z = []
+            for w, b in zip(W[:], B[:]):
+                x = x.dot(w) + b
+                Z.append(self.activation.df(x))
+                x = self.activation.f(x)
+
             for w, z in zip(W, Z):
                 gradient = gradient.dot(w) * z
 
@@ -123,6 +123,28 @@ class GroupedTransformer(ABC):
     def fit_transform(self, X, y=None, **fit_params):
         return self.fit(X).transform(X)
 
+    def fold(self, W, B):
+        """ Fold the (affine) transformation into a subsequent linear layer
+        x -> x.dot(W) + B, only available for transformers implementing
+        _fold_function
+
+        Parameters
+        ------------------
+        W, dict of np.ndarrays
+        	Weights of the layer (n_transformed_features, n_nodes) per species
+        B, dict of np.ndarrays
+        	Biases of the layer per species
+
+        Returns
+        -------------
+        W, B: dicts of np.ndarrays
+        	Weights and biases of the layer acting on the untransformed features
+        """
+        W_folded, B_folded = {}, {}
+        for spec in W:
+            W_folded[spec], B_folded[spec] = self._spec_dict[spec]._fold_function(W[spec], B[spec])
+        return W_folded, B_folded
+
 
 # TODO: The better solution might be to have a factory, pass an instance of the object
 # and copy this instance. Abstract factory?
@@ -149,6 +171,12 @@ class GroupedVarianceThreshold(GroupedTransformer, VarianceThreshold):
         X_grad[:, support] = X
         return X_grad.reshape(*X_shape[:-1], X_grad.shape[-1])
 
+    def _fold_function(self, W, B):
+        support = self.get_support()
+        W_folded = np.zeros((len(support), ) + W.shape[1:])
+        W_folded[support] = W
+        return W_folded, B
+
 
 class GroupedPCA(GroupedTransformer, PCA):
     def __init__(self,
@@ -203,6 +231,12 @@ class GroupedPCA(GroupedTransformer, PCA):
         else:
             return super().get_gradient(X, y, **fit_params)
 
+    def fold(self, W, B):
+        if self.n_components == 1:
+            return W, B
+        else:
+            return super().fold(W, B)
+
     def _gradient_function(self, X):
         X_shape = X.shape
         if not X.ndim == 2:
@@ -210,6 +244,13 @@ class GroupedPCA(GroupedTransformer, PCA):
         X_grad = X.dot(self.components_)
         return X_grad.reshape(*X_shape[:-1], X_grad.shape[-1])
 
+    def _fold_function(self, W, B):
+        # transform: (x - mean_).dot(components_.T) (/ sqrt(explained_variance_))
+        if self.whiten:
+            W = W / np.sqrt(self.explained_variance_).reshape(-1, 1)
+        W_folded = self.components_.T.dot(W)
+        return W_folded, B - self.mean_.dot(W_folded)
+
 
 class GroupedStandardScaler(GroupedTransformer, StandardScaler):
     def __init__(self, threshold=0.0):
@@ -231,6 +272,14 @@ class GroupedStandardScaler(GroupedTransformer, StandardScaler):
         X = X / np.sqrt(self.var_).reshape(1, -1)
         return X.reshape(*X_shape[:-1], X.shape[-1])
 
+    def _fold_function(self, W, B):
+        # transform: (x - mean_) / scale_
+        if self.with_std:
+            W = W / self.scale_.reshape(-1, 1)
+        if self.with_mean:
+            B = B - self.mean_.dot(W)
+        return W, B
+
 
 def identity(x):
     return x
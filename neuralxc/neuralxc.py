@@ -9,15 +9,17 @@ and all other relevant classes
 import numpy as np
 from .ml.network import load_pipeline
 from .ml.network import NetworkEstimator
-from .projector import DensityProjector, DeltaProjector
+from .projector import DensityProjector, DeltaProjector, DefaultProjector, select_projector_type
 from .symmetrizer import symmetrizer_factory
 from .utils.visualize import plot_density_cut
 from .constants import Rydberg, Bohr, Hartree
 from abc import ABC, abstractmethod
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import os
 import time
 import traceback
+import numba
 from periodictable import elements as element_dict
 from .timer import timer
 from .pyscf import BasisPadder
@@ -41,6 +43,24 @@ def prints_error(method):
     return wrapper_print_error
 
 
+@contextmanager
+def numba_threads(n_threads):
+    """ Context manager: run the numba kernels with n_threads threads and
+    restore the previous (process-wide) setting on exit. With n_threads = None
+    numba is left untouched, querying it would start its thread pool which is
+    not fork-safe with every threading layer (process backend).
+    """
+    if n_threads is None:
+        yield
+        return
+    previous = numba.get_num_threads()
+    numba.set_num_threads(n_threads)
+    try:
+        yield
+    finally:
+        numba.set_num_threads(previous)
+
+
 def verify_type(obj):
     print('Type of object is:')
     print(obj)
@@ -78,15 +98,18 @@ class NXCAdapter(ABC):
 
         # This complicated structure is necessary because of forpy, which
         # for some reason doesn't let us access the dict by strings
-        workers = 1
+        workers = None
+        backend = 'thread'
         for key in options:
             if key == 'max_workers':
                 workers = options[key]
-        if workers > 1:
-            timer.threaded = True
-        self._adaptee.max_workers = int(workers)
+            if key == 'backend':
+                backend = options[key]
+        if workers is not None:
+            self._adaptee.max_workers = int(workers)
+        self._adaptee.backend = backend
 
-        print('NeuralXC: Using {} thread(s)'.format(self._adaptee.max_workers))
+        print('NeuralXC: Using {} {}(s)'.format(self._adaptee.max_workers, backend))
 
     @abstractmethod
     def get_V(self):
@@ -115,15 +138,15 @@ class SiestaNXC(NXCAdapter):
         model_elements = [key for key in self._adaptee._pipeline.get_basis_instructions() if len(key) == 1]
         self.element_filter = np.array([(e in model_elements) for e in elements])
         positions = positions[self.element_filter]
-        elements = elements[self.element_filter]
-        self._adaptee.initialize(unitcell, grid, positions, elements)
+        self.elements = elements[self.element_filter]
+        self.grid = np.array(grid)
+        self._adaptee.initialize(unitcell, grid, positions, self.elements)
         use_drho = False
         if self._adaptee._pipeline.get_basis_instructions().get('extension', 'RHOXC') == 'DRHO':
             use_drho = True
             print('NeuralXC: Using DRHO')
             rho_reshaped = rho.reshape(*grid[::-1]).T
-            self._adaptee.projector = DeltaProjector(self._adaptee.projector)
-            self._adaptee.projector.set_constant_density(rho_reshaped, positions, elements)
+            self._adaptee.set_constant_density(rho_reshaped)
         else:
             print('NeuralXC: Using RHOXC')
         self.initialized = True
@@ -162,27 +185,30 @@ class SiestaNXC(NXCAdapter):
 
         Note
         -----
-        Arrays should be provided in Fortran order
+        Arrays should be provided in Fortran order. Positions and elements are
+        the ones passed to initialize (atoms are fixed during an SCF cycle)
         """
-        elements = np.array([str(element_dict[e]) for e in elements])
-        unitcell = unitcell.T
-        positions = positions.T
-        rho_reshaped = rho.reshape(*grid[::-1]).T
         if not self.initialized:
             raise Exception('Must call initialize before calling get_V')
 
-        Enxc, Vnxc = self._adaptee.get_V(rho_reshaped, calc_forces=calc_forces)
+        # Views, no copies
+        rho_reshaped = rho.reshape(*self.grid[::-1]).T
+        if V.flags.c_contiguous or V.flags.f_contiguous:
+            out = V.reshape(*self.grid[::-1]).T
+        else:
+            out = None
+
+        # Contributions are accumulated in Rydberg directly into SIESTA's buffer
+        Enxc, Vnxc = self._adaptee.get_V(rho_reshaped, calc_forces=calc_forces, out=out, scale=1 / Rydberg)
         if calc_forces:
-            self.force_correction = Vnxc[1][:-3].T / Rydberg
-            self.stress_correction = Vnxc[1][-3:].T / Rydberg
+            self.force_correction = Vnxc[1][:-3].T
+            self.stress_correction = Vnxc[1][-3:].T
             #            if not np.allclose(self.stress_correction, self.stress_correction.T):
             #                raise Exception('Stress correction not symmetric')
             Vnxc = Vnxc[0]
 
-        Enxc = Enxc / Rydberg
-        Vnxc = Vnxc.real.T.reshape(-1, 1) / Rydberg
-        # print('Not correcting V!')
-        V[:, :] = Vnxc + V
+        if out is None:
+            V[:, :] += Vnxc.T.reshape(-1, 1)
         print('NeuralXC: Enxc = {} eV'.format(Enxc * Rydberg))
         return Enxc
 
@@ -220,11 +246,30 @@ class NeuralXC():
         symmetrize_dict = {'basis': self._pipeline.get_basis_instructions()}
         symmetrize_dict.update(self._pipeline.get_symmetrize_instructions())
         self.symmetrizer = symmetrizer_factory(symmetrize_dict)
-        self.max_workers = 1
+        self._max_workers = None
+        self.backend = 'thread'
+        self._process_backend = None
         if symmetrize_dict['basis'].get('spec_agnostic', False):
             element_dict = agnostic_dict
         print('NeuralXC: Pipeline successfully loaded')
 
+    @property
+    def max_workers(self):
+        """ Number of python threads/processes used by get_V, 1 unless set """
+        return 1 if self._max_workers is None else self._max_workers
+
+    @max_workers.setter
+    def max_workers(self, max_workers):
+        self._max_workers = max_workers
+
+    @property
+    def numba_num_threads(self):
+        """ Number of threads used by the numba kernels: max_workers if set,
+        numba's default (NUMBA_NUM_THREADS) otherwise """
+        if self._max_workers is None:
+            return numba.config.NUMBA_NUM_THREADS
+        return min(self._max_workers, numba.config.NUMBA_NUM_THREADS)
+
     @prints_error
     def initialize(self, unitcell, grid, positions, species):
         """Parameters
@@ -243,7 +288,44 @@ class NeuralXC():
         self.grid = grid
         self.positions = positions
         self.species = species
-        self.projector = DensityProjector(unitcell, grid, self._pipeline.get_basis_instructions())
+        basis_instructions = self._pipeline.get_basis_instructions()
+        if not 'projector_type' in basis_instructions and basis_instructions.get('application', 'siesta') == 'siesta' \
+                and select_projector_type(unitcell, grid, basis_instructions, species) == 'fft':
+            # Models are fitted with a specific projector, fft is opt-in only
+            print('NeuralXC: projector_type \'fft\' would be faster for this system, it has to be set explicitly'\
+                + ' in basis_instructions (coefficients differ from \'ortho\' by the interpolation error)')
+        self.projector = DensityProjector(unitcell, grid, basis_instructions)
+        if self.backend == 'process' and self.max_workers > 1 and self._process_backend is None:
+            # Imported here, shared memory is not available on every platform
+            from .parallel import ProcessBackend, process_backend_supported
+            if process_backend_supported():
+                self._process_backend = ProcessBackend(self, self.max_workers)
+            else:
+                print('NeuralXC: Process backend requires Python >= 3.8, fork and a fork-safe numba threading layer,'
+                      + ' using threads instead')
+                self.backend = 'thread'
+        if self.backend == 'process' and self.max_workers > 1:
+            # Workers own the projectors for their atoms
+            self._process_backend.initialize(unitcell, grid, positions, species)
+        elif isinstance(self.projector, DefaultProjector):
+            # Atoms stay fixed during SCF cycle -> precompute basis functions
+            self.projector.precompute_stencils(positions, species)
+
+    @prints_error
+    def set_constant_density(self, rho):
+        """ Subtract the basis representation of a constant density (e.g. core
+        density) from the basis representation of all densities passed to get_V
+
+        Parameters
+        ------------------
+        rho, array, float
+        	Constant density in real space
+        """
+        if self.backend == 'process' and self._process_backend is not None:
+            self._process_backend.set_constant_density(rho)
+        else:
+            self.projector = DeltaProjector(self.projector)
+            self.projector.set_constant_density(rho, self.positions, self.species)
 
     def _get_v_thread(self, dEdC, rho, positions, species, calc_forces=False):
         # print(positions, species)
@@ -254,15 +336,23 @@ class NeuralXC():
         # print(positions, species)
         positions = positions.reshape(-1, 3)
         species = [species]
+        timer.start('project')
         C = self.projector.get_basis_rep(rho, positions, species)
-        D = self.symmetrizer.get_symmetrized(C)
+        timer.stop('project')
+        timer.start('symmetrize')
+        D, ctx = self.symmetrizer.symmetrize(C)
+        timer.stop('symmetrize')
+        timer.start('ml_pipeline')
         E = self._pipeline.predict(D)[0]
         dEdD = self._pipeline.get_gradient(D)
-        dEdC = self.symmetrizer.get_gradient(dEdD, C)
+        timer.stop('ml_pipeline')
+        timer.start('symmetrize:gradient')
+        dEdC = self.symmetrizer.get_gradient(dEdD, ctx)
+        timer.stop('symmetrize:gradient')
         return E, dEdC
 
     @prints_error
-    def get_V(self, rho, calc_forces=False):
+    def get_V(self, rho, calc_forces=False, out=None, scale=1.0):
         """Parameters
         ------------------
         rho, array, float
@@ -277,6 +367,11 @@ class NeuralXC():
         	atomic species (chem. symbols)
         calc_forces, bool
         	calculate force and stress correction?
+        out, array, float (optional)
+        	C- or Fortran-contiguous array on the grid, V is added to it in place
+        	and returned instead of a new array
+        scale, float
+        	Unit conversion, applied to E, V and force/stress corrections
 
         Returns
         ------------
@@ -286,6 +381,9 @@ class NeuralXC():
 
         """
 
+        if self.backend == 'process' and self._process_backend is not None:
+            return self._process_backend.get_V(rho, calc_forces, out, scale)
+
         E = 0
         if calc_forces:
             timer.start('get_V_forces')
@@ -293,18 +391,30 @@ class NeuralXC():
         else:
             timer.start('get_V')
             V = 0
-        if self.max_workers == 1:
-            timer.start('project')
-            C = self.projector.get_basis_rep(rho, self.positions, self.species)
-            timer.stop('project')
-            timer.start('ml_pipeline')
-            D = self.symmetrizer.get_symmetrized(C)
-            E = self._pipeline.predict(D)[0]
-            dEdC = self.symmetrizer.get_gradient(self._pipeline.get_gradient(D))
-            timer.stop('ml_pipeline')
-            timer.start('build_V')
-            V = self.projector.get_V(dEdC, self.positions, self.species, calc_forces, rho)
-            timer.stop('build_V')
+        kernel = getattr(self.projector, 'kernel', 'numpy')
+        # The FFT projector treats all atoms at once, per atom threads would repeat the FFTs
+        fft = getattr(self.projector, '_registry_name', None) == 'fft'
+        if self.max_workers == 1 or kernel == 'numba' or fft:
+            # A numba projector is multi-threaded itself, no need for python threads
+            with numba_threads(self.numba_num_threads if kernel == 'numba' else None):
+                timer.start('project')
+                C = self.projector.get_basis_rep(rho, self.positions, self.species)
+                timer.stop('project')
+                timer.start('symmetrize')
+                D, ctx = self.symmetrizer.symmetrize(C)
+                timer.stop('symmetrize')
+                timer.start('ml_pipeline')
+                E = self._pipeline.predict(D)[0] * scale
+                dEdD = self._pipeline.get_gradient(D)
+                timer.stop('ml_pipeline')
+                timer.start('symmetrize:gradient')
+                dEdC = self.symmetrizer.get_gradient(dEdD, ctx)
+                if scale != 1:
+                    dEdC = {spec: dEdC[spec] * scale for spec in dEdC}
+                timer.stop('symmetrize:gradient')
+                timer.start('build_V')
+                V = self.projector.get_V(dEdC, self.positions, self.species, calc_forces, rho, out=out)
+                timer.stop('build_V')
         else:
             with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
                 future_to_rep = {
@@ -318,30 +428,53 @@ class NeuralXC():
                     E += results[0]
                     dEdC.append(results[1])
 
-                if not calc_forces:
-                    dEdC = np.array(dEdC)
+                dEdC_dict = {}
+                for entry in dEdC:
+                    for spec in entry:
+                        if not spec in dEdC_dict:
+                            dEdC_dict[spec] = []
+                        dEdC_dict[spec].append(entry[spec])
+                for spec in dEdC_dict:
+                    dEdC_dict[spec] = np.concatenate(dEdC_dict[spec], axis=1) * scale
+                E = E * scale
+
+                timer.start('build_V')
+                if hasattr(self.projector, 'get_V_parallel'):
+                    # Every thread only writes to its slab of V
+                    V = self.projector.get_V_parallel(dEdC_dict,
+                                                      self.positions,
+                                                      self.species,
+                                                      executor,
+                                                      self.max_workers,
+                                                      out=out)
+                    if calc_forces:
+                        V = [
+                            V,
+                            self.projector.get_force_corrections(dEdC_dict,
+                                                                 self.positions,
+                                                                 self.species,
+                                                                 rho,
+                                                                 executor=executor)
+                        ]
+                elif not calc_forces:
+                    dEdC = [{spec: entry[spec] * scale for spec in entry} for entry in dEdC]
                     future_to_rep = {
                         executor.submit(self.projector.get_V, dedc, position.reshape(-1, 3), [spec], calc_forces, rho):
                         spec
                         for dedc, position, spec in zip(dEdC, self.positions, self.species)
                     }
+                    if out is not None:
+                        V = out
                     for i, future in enumerate(future_to_rep):
                         results = future.result()
                         V += results
                 else:
-                    dEdC_dict = {}
-                    for entry in dEdC:
-                        for spec in entry:
-                            if not spec in dEdC_dict:
-                                dEdC_dict[spec] = []
-                            dEdC_dict[spec].append(entry[spec])
-                    for spec in dEdC_dict:
-                        dEdC_dict[spec] = np.concatenate(dEdC_dict[spec], axis=1)
-
-                    V = self.projector.get_V(dEdC_dict, self.positions, self.species, calc_forces, rho)
+                    V = self.projector.get_V(dEdC_dict, self.positions, self.species, calc_forces, rho, out=out)
+                timer.stop('build_V')
 
         if calc_forces:
-            timer.create_report('NXC_TIMING')
+            timer.stop('get_V_forces')
+            timer.create_report()
         else:
             timer.stop('get_V')
         return E, V
@@ -0,0 +1,214 @@
+"""
+parallel.py
+Persistent multi-process backend for NeuralXC.get_V. Atoms are partitioned
+across worker processes that share the density and their partial potentials
+with the main process through multiprocessing.shared_memory.
+"""
+
+import numpy as np
+import numba
+import os
+import multiprocessing
+import traceback
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+
+def _numba_forks_safely():
+    """ numba's TBB threading layer is not fork-safe: once its thread pool has
+    been started (by a numba kernel) forking makes the process hang on exit
+    """
+    try:
+        return numba.threading_layer() != 'tbb'
+    except ValueError:  # Thread pool not started yet
+        return True
+
+
+def process_backend_supported():
+    """ The process backend needs multiprocessing.shared_memory (Python >= 3.8)
+    and the 'fork' start method (not available on Windows), it can not be used
+    after numba kernels have run on the TBB threading layer
+    """
+    return shared_memory is not None and 'fork' in multiprocessing.get_all_start_methods() \
+        and _numba_forks_safely()
+
+
+class SharedArray():
+    """ Numpy array backed by a shared memory block, processes forked after
+    its creation access the same memory through self.array
+    """
+
+    def __init__(self, shape):
+        """
+        Parameters
+        ------------------
+        shape, tuple of int
+        	Shape of array (dtype is float64)
+        """
+        self.shape = tuple(int(s) for s in shape)
+        self.pid = os.getpid()
+        self.shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(self.shape)) * 8, 1))
+        self.array = np.ndarray(self.shape, dtype=np.float64, buffer=self.shm.buf)
+
+    def close(self):
+        # Copies in forked processes must not release the memory
+        if os.getpid() != self.pid:
+            return
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _worker(conn, nxc, rho, V):
+    """ Event loop of a worker process. nxc is the (forked) NeuralXC instance
+    of the main process, it is used with a subset of the atoms. rho and V
+    are views of the shared memory blocks inherited from the main process.
+    """
+    nxc.max_workers = 1
+    nxc.backend = 'thread'
+    while True:
+        task, args = conn.recv()
+        try:
+            if task == 'initialize':
+                nxc.initialize(*args)
+                result = None
+            elif task == 'set_constant_density':
+                nxc.set_constant_density(rho.copy())
+                result = None
+            elif task == 'get_V':
+                calc_forces, scale = args
+                V[:] = 0
+                E, V_atoms = nxc.get_V(rho, calc_forces=calc_forces, out=V, scale=scale)
+                if calc_forces:
+                    result = (E, V_atoms[1])
+                else:
+                    result = (E, None)
+            elif task == 'close':
+                break
+            conn.send(('ok', result))
+        except Exception as e:
+            conn.send(('error', ''.join(traceback.format_exception(type(e), e, e.__traceback__))))
+    conn.close()
+
+
+class ProcessBackend():
+    """ Persistent pool of worker processes, every worker owns a fixed
+    subset of the atoms (set in initialize) and computes their energy,
+    potential and force corrections. rho and the partial potentials live in
+    shared memory, so only energies and forces are sent through pipes.
+    """
+
+    def __init__(self, nxc, max_workers):
+        """
+        Parameters
+        ------------------
+        nxc, NeuralXC
+        	Instance that is copied into the worker processes (by forking)
+        max_workers, int
+        	Number of worker processes
+        """
+        if not process_backend_supported():
+            raise RuntimeError('The process backend requires Python >= 3.8 and a platform that supports fork')
+        self.max_workers = max_workers
+        self.workers = []
+        self.connections = []
+        self.rho = None
+        self.V = []
+        self.partition = []
+        self.pid = os.getpid()
+        self._nxc = nxc
+
+    def _start(self):
+        # Fork, so that neither the pipeline nor the shared buffers have to be pickled
+        context = multiprocessing.get_context('fork')
+        for V in self.V:
+            parent_conn, child_conn = context.Pipe()
+            worker = context.Process(target=_worker, args=(child_conn, self._nxc, self.rho.array, V.array), daemon=True)
+            worker.start()
+            child_conn.close()
+            self.workers.append(worker)
+            self.connections.append(parent_conn)
+
+    def _run(self, task, args=None):
+        """ Send task to all workers and collect their results
+        """
+        for conn, arg in zip(self.connections, args or [None] * len(self.connections)):
+            conn.send((task, arg))
+        results = []
+        for conn in self.connections:
+            status, result = conn.recv()
+            if status == 'error':
+                raise Exception('NeuralXC: Worker process failed:\n' + result)
+            results.append(result)
+        return results
+
+    def initialize(self, unitcell, grid, positions, species):
+        """ Partition atoms across workers and allocate shared buffers
+        """
+        n_workers = min(self.max_workers, len(positions))
+        if n_workers != len(self.workers) or self.rho is None or self.rho.shape != tuple(grid):
+            self.close()
+            self.rho = SharedArray(grid)
+            self.V = [SharedArray(grid) for _ in range(n_workers)]
+            self._start()
+
+        species = np.array(species)
+        self.partition = np.array_split(np.arange(len(positions)), n_workers)
+        self._run('initialize', [(unitcell, grid, positions[idx], species[idx]) for idx in self.partition])
+
+    def set_constant_density(self, rho):
+        self.rho.array[:] = rho
+        self._run('set_constant_density')
+
+    def get_V(self, rho, calc_forces=False, out=None, scale=1.0):
+        """ Same as NeuralXC.get_V
+        """
+        self.rho.array[:] = rho
+        results = self._run('get_V', [(calc_forces, scale)] * len(self.workers))
+
+        E = sum([result[0] for result in results])
+        if out is None:
+            V = self.V[0].array.copy()
+        else:
+            V = out
+            V += self.V[0].array
+        for V_worker in self.V[1:]:
+            V += V_worker.array
+
+        if calc_forces:
+            n_atoms = sum([len(idx) for idx in self.partition])
+            forces = np.zeros([n_atoms + 3, 3])
+            for idx, result in zip(self.partition, results):
+                forces[idx] = result[1][:-3]
+                # Stress corrections are additive over atoms
+                forces[-3:] += result[1][-3:]
+            return E, [V, forces]
+        else:
+            return E, V
+
+    def close(self):
+        """ Stop worker processes and release shared memory
+        """
+        if os.getpid() != self.pid:
+            return
+        for conn in self.connections:
+            try:
+                conn.send(('close', None))
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            worker.join()
+        for conn in self.connections:
+            conn.close()
+        for array in [self.rho] + self.V:
+            if array is not None:
+                array.close()
+        self.workers, self.connections, self.V, self.rho = [], [], [], None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -1,2 +1,2 @@
-from .projector import DensityProjector, M_make_complex, BehlerProjector, NonOrthoProjector, DeltaProjector, DefaultProjector, BaseProjector
+from .projector import DensityProjector, M_make_complex, BehlerProjector, NonOrthoProjector, DeltaProjector, DefaultProjector, BaseProjector, SparseProjector, FFTProjector, select_projector_type
 from . import projector
@@ -0,0 +1,128 @@
+""" Compiled numba kernels for the projection, the potential build and
+the force corrections. The multi-threaded (parallel=True) kernels are selected
+with basis_instructions['kernel'] = 'numba', the number of threads is
+controlled by numba (NUMBA_NUM_THREADS or numba.set_num_threads)
+"""
+import numpy as np
+from numba import jit, prange
+
+
+@jit(nopython=True, parallel=True)
+def project_batch(basis, rho):
+    """ Project the density onto the stencils of several atoms
+
+    Parameters
+    ----------
+        basis: np.ndarray (n_atoms, n_basis, n_points)
+            basis functions on stencil points (see DefaultProjector.batch_stencils)
+        rho: np.ndarray (n_atoms, n_points)
+            density on stencil points
+
+    Returns
+    -------
+        np.ndarray (n_atoms, n_basis)
+            coefficients (not yet multiplied by the volume element)
+    """
+    n_atoms, n_basis, n_points = basis.shape
+    coeff = np.zeros((n_atoms, n_basis))
+    for ik in prange(n_atoms * n_basis):
+        a = ik // n_basis
+        k = ik % n_basis
+        c = 0.0
+        for p in range(n_points):
+            c += basis[a, k, p] * rho[a, p]
+        coeff[a, k] = c
+    return coeff
+
+
+@jit(nopython=True, parallel=True)
+def build_batch(coeffs, basis, flat, V):
+    """ Add the potential of several atoms to V (in place)
+
+    Parameters
+    ----------
+        coeffs: np.ndarray (n_atoms, n_basis)
+            coefficients dEdC
+        basis: np.ndarray (n_atoms, n_basis, n_points)
+            basis functions on stencil points
+        flat: np.ndarray (n_atoms, n_points)
+            indices of stencil points in the flattened grid
+        V: np.ndarray (n_grid)
+            flattened potential
+    """
+    n_atoms, n_basis, n_points = basis.shape
+    v = np.zeros((n_atoms, n_points))
+    for a in prange(n_atoms):
+        for k in range(n_basis):
+            c = coeffs[a, k]
+            for p in range(n_points):
+                v[a, p] += c * basis[a, k, p]
+
+    # Stencils of different atoms overlap, accumulate serially
+    scatter_add(V, flat.ravel(), v.ravel())
+
+
+@jit(nopython=True, parallel=True)
+def force_integral(angs, dangs, crads, cdrads, X, Y, Z, R, rho):
+    """ Integrate the gradient of the basis functions (contracted with
+    the coefficients) against the density
+
+    Parameters
+    ----------
+        angs: np.ndarray (n_lm, n_points)
+            spherical harmonics
+        dangs: np.ndarray (n_lm, n_points, 3)
+            gradients of r**l * spherical harmonics
+        crads: np.ndarray (n_lm, n_points)
+            radial functions contracted with coefficients, divided by r**l
+        cdrads: np.ndarray (n_lm, n_points)
+            radial derivatives contracted with coefficients, minus l/r * crads
+        X, Y, Z, R: np.ndarray (n_points)
+            euclidean and radial coordinates of points
+        rho: np.ndarray (n_points)
+            density
+
+    Returns
+    -------
+        np.ndarray (3)
+            force (not yet multiplied by the volume element)
+    """
+    n_lm, n_points = angs.shape
+    fx = 0.0
+    fy = 0.0
+    fz = 0.0
+    for p in prange(n_points):
+        # Gradient is set to zero at the origin
+        if R[p] >= 1e-15:
+            radial = 0.0
+            gx = 0.0
+            gy = 0.0
+            gz = 0.0
+            for k in range(n_lm):
+                radial += angs[k, p] * cdrads[k, p]
+                gx += crads[k, p] * dangs[k, p, 0]
+                gy += crads[k, p] * dangs[k, p, 1]
+                gz += crads[k, p] * dangs[k, p, 2]
+            radial /= R[p]
+            fx += (radial * X[p] + gx) * rho[p]
+            fy += (radial * Y[p] + gy) * rho[p]
+            fz += (radial * Z[p] + gz) * rho[p]
+    return np.array([fx, fy, fz])
+
+
+@jit(nopython=True, nogil=True)
+def scatter_add(V, flat, v):
+    """ V[flat] += v for flattened arrays, repeated indices are accumulated.
+    Releases the GIL, threads may write to disjoint parts of V concurrently.
+
+    Parameters
+    ----------
+        V: np.ndarray (n_grid)
+            flattened output buffer, modified in place
+        flat: np.ndarray (n_points)
+            indices into V
+        v: np.ndarray (n_points)
+            values to add
+    """
+    for p in range(len(flat)):
+        V[flat[p]] += v[p]
@@ -1,22 +1,135 @@
 from abc import ABC, abstractmethod
 import numpy as np
-from scipy.special import sph_harm
 import scipy.linalg
+import scipy.sparse
+import scipy.interpolate
+import scipy.fft
 from sympy import N
-from functools import reduce
+from functools import reduce, wraps
+from collections import OrderedDict
 import time
 import math
 from ..doc_inherit import doc_inherit
-from spher_grad import grlylm
 from ..base import ABCRegistry
 from numba import jit
 from ..timer import timer
+from . import spherical
+from . import kernels
 
 
 class ProjectorRegistry(ABCRegistry):
     REGISTRY = {}
 
 
+# Process-wide cache for quantities that only depend on the radial basis
+radial_cache = {}
+
+
+def cached_radial(method):
+    """ Decorator: cache the result of a (class-)method that only depends on
+    the radial basis by (projector_type, method, r_o, n, sigma)
+    """
+
+    @wraps(method)
+    def wrapper_cached_radial(cls, basis):
+        key = (cls._registry_name, method.__name__, basis['r_o'], basis['n'], basis.get('sigma', None))
+        if not key in radial_cache:
+            radial_cache[key] = method(cls, basis)
+        return radial_cache[key]
+
+    return wrapper_cached_radial
+
+
+def get_nbytes(obj):
+    """ Memory occupied by the arrays contained in obj (recursively for
+    dicts, lists and tuples, scipy.sparse matrices are supported)
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif scipy.sparse.issparse(obj):
+        return sum([get_nbytes(getattr(obj, attr, None)) for attr in ['data', 'indices', 'indptr']])
+    elif isinstance(obj, dict):
+        return sum([get_nbytes(value) for value in obj.values()])
+    elif isinstance(obj, (list, tuple)):
+        return sum([get_nbytes(value) for value in obj])
+    else:
+        return 0
+
+
+class LRUCache():
+    """ Dictionary-like cache that evicts the least recently used entries
+    once the arrays stored in it exceed a memory budget
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Parameters
+        ------------------
+        max_bytes, int
+        	Memory budget in bytes
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._nbytes = {}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, key):
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        if key in self._entries:
+            self.pop(key)
+        self._entries[key] = value
+        self._nbytes[key] = get_nbytes(value)
+        self.nbytes += self._nbytes[key]
+        self.evict()
+
+    def pop(self, key):
+        self.nbytes -= self._nbytes.pop(key)
+        return self._entries.pop(key)
+
+    def evict(self):
+        """ Remove least recently used entries until the memory budget is met
+        (the most recent entry is always kept)
+        """
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            self.pop(next(iter(self._entries)))
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes.clear()
+        self.nbytes = 0
+
+
+# Process-wide library of stencils keyed by the offset of atoms from the grid
+stencil_library = LRUCache(1024 * 2**20)
+
+
+def set_stencil_library_memory(memory):
+    """ Memory budget of the process-wide stencil library (shared by all
+    projectors)
+
+    Parameters
+    ------------------
+    memory, float
+    	Budget in MB
+    """
+    stencil_library.max_bytes = int(memory * 2**20)
+    stencil_library.evict()
+
+
 class BaseProjector(metaclass=ProjectorRegistry):
 
     _registry_name = 'base'
@@ -93,6 +206,8 @@ def DensityProjector(unitcell=None, grid=None, basis_instructions=None):
 class DefaultProjector(BaseProjector):
 
     _registry_name = 'default'
+    # Force corrections only need the density inside the atomic boxes
+    _boxed_force_corrections = True
 
     #TODO: Make some functions private
     def __init__(self, unitcell=None, grid=None, basis_instructions=None):
@@ -127,7 +242,295 @@ class DefaultProjector(BaseProjector):
         self.U_inv = np.linalg.inv(self.U)
         self.a = a
         self.W = W
-        self.all_angs = {}
+
+        # Memory budget (in MB) for the basis functions cached by this projector,
+        # the process-wide stencil_library has its own (set_stencil_library_memory)
+        max_bytes = int(basis_instructions.get('cache_memory', 1024) * 2**20)
+        self.all_angs = LRUCache(max_bytes)
+        self.offset_tolerance = basis_instructions.get('offset_tolerance', 0)
+        self.stencils = {}
+        self.stencil_batches = {}
+        self.kernel = basis_instructions.get('kernel', 'numpy')
+        if self.kernel not in ['numpy', 'numba']:
+            raise ValueError('Kernel {} not available, use numpy or numba'.format(self.kernel))
+
+    def precompute_stencils(self, positions, species):
+        """Precompute and store the basis functions on all grid points within
+        r_o of every atom. As long as the atomic positions do not change (e.g.
+        during an SCF cycle) get_basis_rep and get_V use these stencils instead
+        of rebuilding the basis functions on every call.
+
+        Parameters
+        ------------------
+        positions, array float
+        	atomic positions
+        species, list string
+        	atomic species (chem. symbols)
+        """
+        self.stencils = {}
+        self.stencil_batches = {}
+        for spec in dict.fromkeys(species):
+            basis = self.basis[spec]
+            keys = []
+            for pos, s in zip(positions, species):
+                if s != spec:
+                    continue
+                idx = '{}{}{}{}'.format(spec, pos[0], pos[1], pos[2])
+                self.stencils[idx] = self.get_atom_stencil(pos, spec)
+                keys.append(idx)
+            self.stencil_batches[spec] = self.batch_stencils(keys)
+
+    def get_atom_stencil(self, pos, spec):
+        """ Stencil (see get_stencil) for an atom at position pos.
+
+        The basis functions only depend on the offset of the atom from its
+        closest grid point, so they are taken from (or stored in) the
+        process-wide stencil_library and merely shifted to the atom's grid
+        point. With basis_instructions['offset_tolerance'] > 0 offsets are
+        binned, such that atoms are displaced by at most offset_tolerance
+        (in bohr) when evaluating their basis functions (see stencil_position).
+        Otherwise (default) only identical offsets share stencils.
+
+        Parameters
+        ----------
+            pos: np.ndarray
+                atomic position
+            spec: str
+                atomic species
+
+        Returns
+        -------
+            dict
+                {'mesh', 'basis'}
+        """
+        basis = self.basis[spec]
+        cm, offset = self.stencil_offset(pos)
+        key = (self._registry_name, basis['r_o'], basis['n'], basis['l'], basis.get('sigma', None),
+               self.basis.get('radial_table', True), self.U.tobytes(), tuple(np.asarray(self.grid).tolist()), spec,
+               offset)
+        if key in stencil_library:
+            timer.start('stencil_library:hit', False)
+            stencil = stencil_library[key]
+            timer.stop('stencil_library:hit', False)
+        else:
+            box = self.box_around(self.U.dot(offset), basis['r_o'])
+            stencil = self.get_stencil(box, basis, self.W[spec])
+            stencil_library[key] = stencil
+
+        mesh = tuple((m + c) % g for m, c, g in zip(stencil['mesh'], cm, self.grid))
+        return {'mesh': mesh, 'basis': stencil['basis']}
+
+    def stencil_offset(self, pos):
+        """ Closest grid point (mesh indices) to pos and the offset (in units
+        of the grid spacing) of the atom's stencil from it, binned if
+        offset_tolerance > 0
+        """
+        cm, dr = self.grid_offset(pos)
+        frac = self.U_inv.dot(dr)
+        if self.offset_tolerance > 0:
+            # Bins per grid spacing, so that sum_i |U_i| * (bin width / 2) <= tolerance
+            n_bins = np.ceil(3 * self.a / (2 * self.offset_tolerance))
+            offset = tuple((np.round(frac * n_bins) / n_bins).tolist())
+        else:
+            offset = tuple(np.round(frac, 12).tolist())
+        return cm, offset
+
+    def force_box(self, pos, spec):
+        """ Box (see box_around) on which the force correction of an atom is
+        evaluated and its cached angular functions (None if not available).
+        Atoms whose basis functions are taken from a (binned) stencil are
+        displaced like the stencil, see stencil_position.
+        """
+        r_o = self.basis[spec]['r_o']
+        idx = '{}{}{}{}'.format(spec, pos[0], pos[1], pos[2])
+        if self.offset_tolerance > 0 and self._uses_stencil(idx):
+            return self.box_around(self.stencil_position(pos), r_o), None
+        return self.box_around(pos, r_o), self.all_angs.get(idx, None)
+
+    def _uses_stencil(self, idx):
+        """ Whether the basis functions of atom idx are taken from its stencil
+        """
+        return idx in self.stencils
+
+    def stencil_position(self, pos):
+        """ Position at which the basis functions of an atom at pos are
+        evaluated, differs from pos by at most offset_tolerance
+        """
+        cm, offset = self.stencil_offset(pos)
+        return self.U.dot(cm + np.array(offset))
+
+    def batch_stencils(self, keys):
+        """ Stack the stencils of several atoms of the same species into
+        zero-padded arrays so that all of them can be projected/built in a
+        single (batched) matrix product. The basis functions of the individual
+        stencils are replaced by views into the batch. Note that the entries
+        in the process-wide stencil_library are kept (so that they can be
+        reused across MD steps and projectors), i.e. every batched stencil is
+        held twice, the extra copy being bounded by the library's memory
+        budget (see set_stencil_library_memory).
+
+        Parameters
+        ----------
+            keys: list of str
+                keys of the stencils in self.stencils
+
+        Returns
+        -------
+            dict
+                {'keys', 'mesh', 'flat', 'basis'}, grid indices with shape
+                (3, n_atoms, n_points), flattened grid indices, basis functions
+                with shape (n_atoms, n*l**2, n_points)
+        """
+        stencils = [self.stencils[idx] for idx in keys]
+        n_points = max([len(stencil['mesh'][0]) for stencil in stencils])
+        n_basis = len(stencils[0]['basis'])
+
+        mesh = np.zeros([3, len(stencils), n_points], dtype=int)
+        batch_basis = np.zeros([len(stencils), n_basis, n_points])
+        for i, stencil in enumerate(stencils):
+            n = len(stencil['mesh'][0])
+            mesh[:, i, :n] = stencil['mesh']
+            batch_basis[i, :, :n] = stencil['basis']
+            stencil['basis'] = batch_basis[i, :, :n]
+
+        return {
+            'keys': keys,
+            'mesh': tuple(mesh),
+            'flat': np.ravel_multi_index(tuple(mesh), self.grid),
+            'basis': batch_basis
+        }
+
+    def match_stencil_batches(self, positions, species):
+        """ Return the stencil batches if positions and species are the ones
+        passed to precompute_stencils, None otherwise
+        """
+        if not self.stencil_batches:
+            return None
+
+        keys = {}
+        for pos, spec in zip(positions, species):
+            keys.setdefault(spec, []).append('{}{}{}{}'.format(spec, pos[0], pos[1], pos[2]))
+
+        if list(keys) != list(self.stencil_batches):
+            return None
+        for spec in keys:
+            if keys[spec] != self.stencil_batches[spec]['keys']:
+                return None
+        return self.stencil_batches
+
+    def get_stencil(self, box, basis, W=None):
+        """ Tabulate the (radial x angular) basis functions on the grid
+        points of box
+
+        Parameters
+        ----------
+            box: dict
+                 contains the mesh in spherical and euclidean coordinates,
+                 can be obtained with get_box_around()
+            basis: dict
+                 basis instructions for this species
+            W: np.ndarray
+                 matrix used to orthonormalize radial basis functions
+
+        Returns
+        -------
+            dict
+                {'mesh', 'basis'}, grid indices of the stencil points and
+                basis functions with shape (n*l**2, n_points) in the order (n,l,m)
+        """
+        n_l = basis['l']
+        R = box['radial'][0].ravel()
+        mesh = tuple(m.ravel() for m in box['mesh'])
+
+        if not isinstance(W, np.ndarray):
+            W = self.get_W(basis)
+
+        rads = self.get_radials(R, basis, W)
+        angs = self.angulars_cartesian(n_l, *[x.ravel() for x in box['real']])
+        stencil_basis = np.einsum('np,lp -> nlp', rads, angs).reshape(-1, len(R))
+
+        return {'mesh': mesh, 'basis': np.ascontiguousarray(stencil_basis)}
+
+    def project_stencil(self, rho, stencil):
+        """ Same as project but uses precomputed basis functions (see get_stencil)
+        """
+        timer.start('project:project', False)
+        coeff = stencil['basis'].dot(rho[stencil['mesh']]) * self.V_cell
+        timer.stop('project:project', False)
+        return coeff.reshape(1, -1)
+
+    def build_stencil(self, coeffs, stencil):
+        """ Same as build but uses precomputed basis functions (see get_stencil)
+        """
+        timer.start('build:build', False)
+        v = coeffs.dot(stencil['basis'])
+        timer.stop('build:build', False)
+        return v
+
+    @staticmethod
+    def add_to_grid(V, mesh, v):
+        """ Add the values v on the grid points mesh to V (in place). Unlike
+        V[mesh] += v, grid points that appear several times (boxes that are
+        larger than the unit cell and wrap around) are accumulated correctly.
+
+        Parameters
+        ----------
+            V: np.ndarray
+                output buffer on the full grid, modified in place
+            mesh: list of np.ndarray
+                grid indices along the three axes
+            v: np.ndarray
+                values on mesh, same shape as the index arrays
+        """
+        timer.start('build:accumulate', False)
+        V_flat, order = DefaultProjector.flat_view(V)
+        if V_flat is not None:
+            flat = np.ravel_multi_index(tuple(mesh), V.shape, order=order).ravel()
+            kernels.scatter_add(V_flat, flat, np.ascontiguousarray(v, dtype=V.dtype).ravel())
+        else:
+            np.add.at(V, tuple(mesh), v)
+        timer.stop('build:accumulate', False)
+
+    @staticmethod
+    def flat_view(V):
+        """ One dimensional view of V and the order ('C' or 'F') of its
+        elements in memory, (None, None) if V is not contiguous
+        """
+        if V.flags.c_contiguous:
+            return V.reshape(-1), 'C'
+        elif V.flags.f_contiguous:
+            return V.reshape(-1, order='F'), 'F'
+        else:
+            return None, None
+
+    def project_batch(self, rho, batch):
+        """ Project rho onto the basis functions of all atoms in batch (see batch_stencils)
+        """
+        timer.start('project:project', False)
+        if self.kernel == 'numba':
+            coeff = kernels.project_batch(batch['basis'], rho[batch['mesh']]) * self.V_cell
+        else:
+            coeff = np.matmul(batch['basis'], rho[batch['mesh']][:, :, None])[:, :, 0] * self.V_cell
+        timer.stop('project:project', False)
+        return coeff
+
+    def build_batch(self, coeffs, batch, V, order='C'):
+        """ Add the contributions of all atoms in batch to V (flattened grid, modified in place)
+        with grid points in C or Fortran order
+        """
+        timer.start('build:build', False)
+        if order == 'C':
+            flat = batch['flat']
+        else:
+            if not 'flat_F' in batch:
+                batch['flat_F'] = np.ravel_multi_index(batch['mesh'], self.grid, order='F')
+            flat = batch['flat_F']
+        if self.kernel == 'numba':
+            kernels.build_batch(np.ascontiguousarray(coeffs), batch['basis'], flat, V)
+        else:
+            v = np.matmul(coeffs[:, None, :], batch['basis'])[:, 0, :]
+            kernels.scatter_add(V, flat.ravel(), v.ravel())
+        timer.stop('build:build', False)
 
     def get_basis_rep(self, rho, positions, species):
         """Calculates the basis representation for a given real space density
@@ -146,12 +549,20 @@ class DefaultProjector(BaseProjector):
         c, dict of np.ndarrays
         	Basis representation, dict keys correspond to atomic species.
         """
+        batches = self.match_stencil_batches(positions, species)
+        if batches:
+            return {spec: self.project_batch(rho, batches[spec]) for spec in batches}
+
         basis_rep = {}
         for pos, spec in zip(positions, species):
             if not spec in basis_rep:
                 basis_rep[spec] = []
 
             idx = '{}{}{}{}'.format(spec, pos[0], pos[1], pos[2])
+            if idx in self.stencils:
+                basis_rep[spec].append(self.project_stencil(rho, self.stencils[idx]))
+                continue
+
             basis = self.basis[spec]
             box = self.box_around(pos, basis['r_o'])
             projection, angs = self.project(rho, box, basis, self.W[spec], angs=self.all_angs.get(idx, None))
@@ -184,7 +595,7 @@ class DefaultProjector(BaseProjector):
 
         return basis_rep
 
-    def get_V(self, dEdC, positions, species, calc_forces=False, rho=None):
+    def get_V(self, dEdC, positions, species, calc_forces=False, rho=None, out=None):
         """Calculates the basis representation for a given real space density
 
         Parameters
@@ -197,6 +608,9 @@ class DefaultProjector(BaseProjector):
         	atomic species (chem. symbols)
         calc_forces, bool
         	Calc. and return force corrections + stress corrections (concatenated)
+        out, np.ndarray (optional)
+        	C- or Fortran-contiguous array with the shape of the grid. V is
+        	added to out (in place) and out is returned instead of a new array
         Returns
         ------------
         V, (force_correction) np.ndarray
@@ -204,10 +618,22 @@ class DefaultProjector(BaseProjector):
         if isinstance(dEdC, list):
             dEdC = dEdC[0]
 
-        V = np.zeros(self.grid)
+        V = self.get_output_buffer(out)
+        batches = self.match_stencil_batches(positions, species)
+        if batches:
+            V_flat, order = self.flat_view(V)
+            for spec in batches:
+                if dEdC[spec].ndim == 3:
+                    assert dEdC[spec].shape[0] == 1
+                    dEdC[spec] = dEdC[spec][0]
+                self.build_batch(dEdC[spec], batches[spec], V_flat, order)
+            if calc_forces:
+                return V, self.get_force_corrections(dEdC, positions, species, rho)
+            else:
+                return V
+
         spec_idx = {spec: -1 for spec in species}
-        force_corrections = np.zeros([len(species), 3])
-        for i, (pos, spec) in enumerate(zip(positions, species)):
+        for pos, spec in zip(positions, species):
             spec_idx[spec] += 1
             if dEdC[spec].ndim == 3:
                 assert dEdC[spec].shape[0] == 1
@@ -215,24 +641,202 @@ class DefaultProjector(BaseProjector):
 
             coeffs = dEdC[spec][spec_idx[spec]]
             basis = self.basis[spec]
-            box = self.box_around(pos, basis['r_o'])
 
             idx = '{}{}{}{}'.format(spec, pos[0], pos[1], pos[2])
-            V[tuple(box['mesh'])] += self.build(coeffs, box, basis, self.W[spec], angs=self.all_angs.get(idx, None))
-            if calc_forces:
-                if not isinstance(rho, np.ndarray):
-                    raise ValueError('Must provide rho as np.ndarray')
-                force_corrections[i] = self.get_force_correction(
-                    rho, coeffs, box, basis, self.W[spec], angs=self.all_angs.get(idx, None))
-
-        stress_correction = np.einsum('ij,ik-> jk', force_corrections, positions)
+            if idx in self.stencils:
+                stencil = self.stencils[idx]
+                self.add_to_grid(V, stencil['mesh'], self.build_stencil(coeffs, stencil))
+            else:
+                box = self.box_around(pos, basis['r_o'])
+                self.add_to_grid(V, box['mesh'], self.build(coeffs, box, basis, self.W[spec],
+                                                           angs=self.all_angs.get(idx, None)))
 
-        force_corrections = np.concatenate([force_corrections, stress_correction], axis=0)
         if calc_forces:
-            return V, force_corrections
+            return V, self.get_force_corrections(dEdC, positions, species, rho)
         else:
             return V
 
+    def get_output_buffer(self, out=None):
+        """ Array that V is accumulated into, either out (checked) or a new
+        array of zeros
+        """
+        if out is None:
+            return np.zeros(self.grid)
+        if tuple(out.shape) != tuple(self.grid) or self.flat_view(out)[0] is None:
+            raise ValueError('out must be a contiguous array of shape {}'.format(tuple(self.grid)))
+        return out
+
+    def get_V_parallel(self, dEdC, positions, species, executor, n_slabs, out=None, max_bytes=None):
+        """Same as get_V (without force corrections) but distributed over the
+        workers of executor. Atoms are processed in chunks: the contributions
+        of the atoms in a chunk are computed in parallel, then the grid is
+        partitioned into n_slabs slabs along the slowest (in memory) axis and
+        every task accumulates all contributions that fall into its slab.
+        Tasks write to disjoint parts of V, so V is the only full grid array
+        that is allocated, independent of the number of workers.
+
+        The memory of a chunk (its contributions plus the scratch needed to
+        evaluate the basis functions of atoms without precomputed stencils)
+        is estimated from the atomic spheres and kept below max_bytes. Chunks
+        contain at least n_slabs atoms (one per worker), so the bound is
+        max(max_bytes, n_slabs * memory of the largest atom).
+
+        Parameters
+        ------------------
+        dEdc , dict of numpy.ndarray
+
+        positions, array float
+        	atomic positions
+        species, list string
+        	atomic species (chem. symbols)
+        executor, concurrent.futures.Executor
+        	thread pool
+        n_slabs, int
+        	number of slabs
+        out, np.ndarray (optional)
+        	see get_V
+        max_bytes, int (optional)
+        	Memory budget per chunk of atoms, default: size of one grid
+        Returns
+        ------------
+        V, np.ndarray
+        """
+        if isinstance(dEdC, list):
+            dEdC = dEdC[0]
+
+        if max_bytes is None:
+            max_bytes = int(np.prod(self.grid)) * 8
+
+        # Chunks of consecutive atoms, so that every grid point receives the
+        # contributions in the same order as without chunks
+        chunks = [[]]
+        n_bytes = 0
+        spec_idx = {spec: -1 for spec in species}
+        for pos, spec in zip(positions, species):
+            spec_idx[spec] += 1
+            if dEdC[spec].ndim == 3:
+                assert dEdC[spec].shape[0] == 1
+                dEdC[spec] = dEdC[spec][0]
+            basis = self.basis[spec]
+            points = 4 / 3 * np.pi * basis['r_o']**3 / self.V_cell
+            # Contribution and its grid indices, mesh, coordinates, radial and angular functions
+            idx = '{}{}{}{}'.format(spec, pos[0], pos[1], pos[2])
+            per_point = 2 if idx in self.stencils else 11 + basis['n'] + basis['l']**2
+            if len(chunks[-1]) >= n_slabs and n_bytes + points * per_point * 8 > max_bytes:
+                chunks.append([])
+                n_bytes = 0
+            chunks[-1].append((pos, spec, dEdC[spec][spec_idx[spec]]))
+            n_bytes += points * per_point * 8
+
+        V = self.get_output_buffer(out)
+        V_flat, order = self.flat_view(V)
+        axis = 0 if order == 'C' else 2
+
+        def contribution(atom):
+            pos, spec, coeffs = atom
+            idx = '{}{}{}{}'.format(spec, pos[0], pos[1], pos[2])
+            if idx in self.stencils:
+                mesh = self.stencils[idx]['mesh']
+                v = self.build_stencil(coeffs, self.stencils[idx])
+            else:
+                basis = self.basis[spec]
+                box = self.box_around(pos, basis['r_o'])
+                mesh = box['mesh']
+                v = self.build(coeffs, box, basis, self.W[spec], angs=self.all_angs.get(idx, None))
+
+            # Sort points by slab
+            slab = np.ravel(mesh[axis]) * n_slabs // self.grid[axis]
+            sort = np.argsort(slab, kind='stable')
+            bounds = np.searchsorted(slab[sort], np.arange(n_slabs + 1))
+            flat = np.ravel_multi_index(tuple(mesh), self.grid, order=order).ravel()
+            return flat[sort], np.ravel(v)[sort], bounds
+
+        def accumulate(slab, contributions):
+            for flat, v, bounds in contributions:
+                if bounds[slab + 1] > bounds[slab]:
+                    kernels.scatter_add(V_flat, flat[bounds[slab]:bounds[slab + 1]], v[bounds[slab]:bounds[slab + 1]])
+
+        for atoms in chunks:
+            timer.start('build:build', False)
+            contributions = list(executor.map(contribution, atoms))
+            timer.stop('build:build', False)
+
+            timer.start('build:accumulate', False)
+            list(executor.map(accumulate, range(n_slabs), [contributions] * n_slabs))
+            timer.stop('build:accumulate', False)
+            del contributions
+        return V
+
+    def get_force_corrections(self, dEdC, positions, species, rho, executor=None, constant_density=None):
+        """Calculates the force and stress corrections that arise from the
+        dependence of the basis functions on the atomic positions
+
+        Parameters
+        ------------------
+        dEdc , dict of numpy.ndarray
+
+        positions, array float
+        	atomic positions
+        species, list string
+        	atomic species (chem. symbols)
+        rho, array, float
+        	Electron density in real space
+        executor, concurrent.futures.Executor (optional)
+        	Distribute atoms over the workers of executor. The stress is
+        	always summed over atoms in the same order, so results do not
+        	depend on the number of workers.
+        constant_density, np.ndarray (optional)
+        	Constant density on the grid, it is subtracted from rho on the
+        	box of every atom (see DeltaProjector)
+        Returns
+        ------------
+        force_correction, np.ndarray (n_atoms + 3, 3)
+        	force corrections and stress correction (concatenated)
+        """
+        if not isinstance(rho, np.ndarray):
+            raise ValueError('Must provide rho as np.ndarray')
+
+        if isinstance(dEdC, list):
+            dEdC = dEdC[0]
+
+        atoms = []
+        spec_idx = {spec: -1 for spec in species}
+        for pos, spec in zip(positions, species):
+            spec_idx[spec] += 1
+            if dEdC[spec].ndim == 3:
+                assert dEdC[spec].shape[0] == 1
+                dEdC[spec] = dEdC[spec][0]
+            atoms.append((pos, spec, dEdC[spec][spec_idx[spec]]))
+
+        def correction(atom):
+            pos, spec, coeffs = atom
+            basis = self.basis[spec]
+            box, angs = self.force_box(pos, spec)
+            rho_const = None
+            if constant_density is not None:
+                rho_const = constant_density[tuple(box['mesh'])].ravel()
+            force = self.get_force_correction(rho,
+                                              coeffs,
+                                              box,
+                                              basis,
+                                              self.W[spec],
+                                              angs=angs,
+                                              rho_const=rho_const)
+            return force, np.outer(force, pos)
+
+        if executor is None:
+            results = list(map(correction, atoms))
+        else:
+            results = list(executor.map(correction, atoms))
+
+        force_corrections = np.zeros([len(species), 3])
+        stress_correction = np.zeros([3, 3])
+        for i, (force, stress) in enumerate(results):
+            force_corrections[i] = force
+            stress_correction += stress
+
+        return np.concatenate([force_corrections, stress_correction], axis=0)
+
     def angulars(self, l, m, theta, phi):
         """ Angular functions (uses physics convention for angles)
         (For compatibility with complex version)
@@ -280,21 +884,34 @@ class DefaultProjector(BaseProjector):
         float or np.ndarray
             Value of angular function at provided point(s)
         """
-        if l > 0:
-            M = M_make_complex(l + 1)[-(2 * l + 1):, -(2 * l + 1):]
-            M = np.linalg.inv(M)
-        else:
-            M = np.eye(1)
+        theta, phi = np.broadcast_arrays(np.asarray(theta, dtype=float), np.asarray(phi, dtype=float))
+        X = np.sin(theta) * np.cos(phi)
+        Y = np.sin(theta) * np.sin(phi)
+        Z = np.cos(theta)
+        ang = spherical.ylm(l, X.ravel(), Y.ravel(), Z.ravel())[l**2:]
+        return ang.reshape((2 * l + 1, ) + theta.shape)
+
+    @staticmethod
+    def angulars_cartesian(n_l, X, Y, Z):
+        """ Real spherical harmonics for all angular momenta l < n_l, evaluated
+        directly on euclidean coordinates (relative to the atom) by recursion
 
-        shape = (2 * l + 1, ) + phi.shape
-        sh_list = np.zeros(shape, dtype=np.complex)
-        for i, m in enumerate(range(-l, l + 1)):
-            sh_list[i] = sph_harm(m, l, phi, theta)
+        Parameters
+        ----------
+        n_l: int
+            number of angular momenta
+        X, Y, Z: np.ndarray
+            euclidean coordinates
 
-        ang = np.einsum('ij,j...-> i...', M, sh_list, optimize=True)
-        return ang.real
+        Returns
+        -------
+        np.ndarray (n_l**2, *X.shape)
+            Angular functions ordered by (l, m) with m = -l...l
+        """
+        ang = spherical.ylm(n_l - 1, np.ravel(X), np.ravel(Y), np.ravel(Z))
+        return ang.reshape((n_l**2, ) + np.shape(X))
 
-    def get_force_correction(self, rho, coeffs, box, basis, W=None, angs=None):
+    def get_force_correction(self, rho, coeffs, box, basis, W=None, angs=None, rho_const=None):
         """ Calculate the contribution to the forces that arises from the
         dependence of the (nxc-)basis set on the atomic positions
 
@@ -315,6 +932,8 @@ class DefaultProjector(BaseProjector):
                  outer radial cutoff in Angstrom
             W: np.ndarray
                  matrix used to orthonormalize radial basis functions
+            rho_const: np.ndarray
+                 constant density on the (flattened) box mesh, subtracted from rho
 
         Returns
         -------
@@ -331,74 +950,54 @@ class DefaultProjector(BaseProjector):
         X, Y, Z = box['real']
 
         #Build angular part of basis functions
-        if not isinstance(angs, list):
-            angs = []
-            for l in range(n_l):
-                angs.append([])
-                ang_l = self.angulars_real(l, Theta, Phi)
-                for m in range(-l, l + 1):
-                    # angs[l].append(sph_harm(m, l, Phi, Theta).conj()) TODO: In theory should be conj!?
-                    # angs[l].append(self.angulars(l, m, Theta, Phi))
-                    angs[l].append(ang_l[l + m])
+        if angs is None:
+            angs = self.angulars_cartesian(n_l, *box['real'])
 
         timer.start('force:basis_functions:dangular')
-        # Derivatives of spherical harmonic
-        # M = M_make_complex(n_l)
-        dangs = np.zeros([3, n_l**2, len(X.flatten())])
-
-        for ir, r in enumerate(zip(X.flatten(), Y.flatten(), Z.flatten())):
-            dangs[:, :, ir] = grlylm(n_l - 1, r)  # shape: (3, n_l*n_l)
-
-        # dangs = np.einsum('ij,kjl -> ilk', M, dangs, optimize=True)
-        dangs = dangs.transpose((1, 2, 0))
-        # print(dangs.shape)
-        dangs = dangs.reshape(len(dangs), *X.shape, 3)
-
+        # Derivatives of spherical harmonics, shape: (n_l*n_l, n_points, 3)
+        if self.kernel == 'numba':
+            dangs = spherical.grlylm_parallel(n_l - 1, X.ravel(), Y.ravel(), Z.ravel())
+        else:
+            dangs = spherical.grlylm(n_l - 1, X.ravel(), Y.ravel(), Z.ravel())
         timer.stop('force:basis_functions:dangular')
         timer.start('force:basis_functions:radial')
         #Build radial part of b.f.
         if not isinstance(W, np.ndarray):
             W = self.get_W(basis)  # Matrix to orthogonalize radial basis
 
-        drads = self.dradials(R, basis, W)
-        rads = self.radials(R, basis, W)
-        radsr = np.array(rads)
-        # radsr[R<1e-15] = 0
-        radsr = radsr / R
-        # radsr[:, R < 1e-15] = 0
+        R = R.ravel()
+        drads = self.get_radials(R, basis, W, derivative=True)
+        rads = self.get_radials(R, basis, W)
 
-        rhat = np.array([X / R, Y / R, Z / R])
-        # rhat[:, R < 1e-15] = 0
-        rho = rho[tuple(box['mesh'])]
-        force = np.zeros(3)
+        rho = rho[tuple(box['mesh'])].ravel()
+        if rho_const is not None:
+            rho = rho - rho_const
 
         timer.stop('force:basis_functions:radial')
 
         timer.start('force:integrals')
 
         timer.start('force:integrals:precomp')
-        # Precomputing common factors in loops below (saves factor 3 comp. time)
-        RtoL = [R**l for l in range(n_l)]
-        radbyrl = [[rads[n] / RtoL[l] for l in range(n_l)] for n in range(n_rad)]
-        vmult0 = [[(drads[n] - l * radsr[n]) for l in range(n_l)] for n in range(n_rad)]
-        vmult = [[[angs[l][m] * vmult0[n][l] for m in range(2 * l + 1)] for l in range(n_l)] for n in range(n_rad)]
+        # Contract radial functions with coefficients first, leaves arrays of shape (n_l*n_l, n_points)
+        l_of_lm = np.repeat(np.arange(n_l), 2 * np.arange(n_l) + 1)
+        angs = angs.reshape(n_l**2, -1)
+        coeffs = np.asarray(coeffs).reshape(n_rad, n_l**2)
+        crads = coeffs.T.dot(rads)
+        # Grid points at R = 0 give inf/nan here, their gradient is set to zero below
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cdrads = coeffs.T.dot(drads) - l_of_lm.reshape(-1, 1) * crads / R
+            crads /= R**l_of_lm.reshape(-1, 1)
         timer.stop('force:integrals:precomp')
 
-        for ix in range(3):
-            v = np.zeros_like(rho)
-            idx_coeff = 0
-            for n in range(n_rad):
-                idx_l = 0
-                for l in range(n_l):
-                    for m in range(2 * l + 1):
-                        v2 = (radbyrl[n][l] * dangs[idx_l, :, :, :, ix])
-                        v += coeffs[idx_coeff] * ((vmult[n][l][m] * rhat[ix]) + v2)
-                        idx_l += 1
-                        idx_coeff += 1
-
-            # assert np.allclose(v.imag, np.zeros_like(v))
-            v[R < 1e-15] = 0
-            force[ix] = np.sum(rho * v) * self.V_cell
+        if self.kernel == 'numba':
+            force = kernels.force_integral(angs, dangs, crads, cdrads, X.ravel(), Y.ravel(), Z.ravel(), R,
+                                           rho) * self.V_cell
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rhat = np.array([X.ravel() / R, Y.ravel() / R, Z.ravel() / R])
+                v = np.sum(angs * cdrads, axis=0) * rhat + np.einsum('kp,kpx -> xp', crads, dangs, optimize=True)
+            v[:, R < 1e-15] = 0
+            force = v.dot(rho) * self.V_cell
         timer.stop('force:integrals')
         return force
 
@@ -441,15 +1040,8 @@ class DefaultProjector(BaseProjector):
         timer.start('build:basis_functions', False)
         timer.start('build:basis_functions:angular', False)
         #Build angular part of basis functions
-        if not isinstance(angs, list):
-            angs = []
-            for l in range(n_l):
-                angs.append([])
-                ang_l = self.angulars_real(l, Theta, Phi)
-                for m in range(-l, l + 1):
-                    # angs[l].append(sph_harm(m, l, Phi, Theta).conj()) TODO: In theory should be conj!?
-                    # angs[l].append(self.angulars(l, m, Theta, Phi))
-                    angs[l].append(ang_l[l + m])
+        if angs is None:
+            angs = self.angulars_cartesian(n_l, *box['real'])
 
         timer.stop('build:basis_functions:angular', False)
         timer.start('build:basis_functions:radial', False)
@@ -457,25 +1049,13 @@ class DefaultProjector(BaseProjector):
         if not isinstance(W, np.ndarray):
             W = self.get_W(basis)  # Matrix to orthogonalize radial basis
 
-        rads = self.radials(R, basis, W)
+        rads = self.get_radials(R, basis, W)
 
         timer.stop('build:basis_functions:radial', False)
-        v = np.zeros_like(Xm, dtype=np.float64)
-        idx = 0
-
         timer.stop('build:basis_functions', False)
         timer.start('build:build', False)
-        for n in range(n_rad):
-            for l in range(n_l):
-                for m in range(2 * l + 1):
-                    v += coeffs[idx] * angs[l][m] * rads[n]
-                    idx += 1
-
-        # coeffs_rs = coeffs.reshape(n_rad,n_l**2)
-        # angs_flat = np.array([a for ang in angs for a in ang]).reshape(n_l**2, *Xm.shape)
-        # rads = np.array(rads)
-        #
-        # v = np.einsum('nl,lijk,nijk-> ijk',coeffs_rs,angs_flat,rads, optimize=False)
+        coeffs = np.asarray(coeffs).reshape(n_rad, n_l**2)
+        v = np.einsum('nl,l...,n... -> ...', coeffs, angs, rads, optimize=True)
         timer.stop('build:build', False)
         return v
 
@@ -519,52 +1099,40 @@ class DefaultProjector(BaseProjector):
             small_rho = False
 
         #Build angular part of basis functions
-        if not isinstance(angs, list):
-            angs = []
-            for l in range(n_l):
-                angs.append([])
-                ang_l = self.angulars_real(l, Theta, Phi)
-                for m in range(-l, l + 1):
-                    # angs[l].append(sph_harm(m, l, Phi, Theta).conj()) TODO: In theory should be conj!?
-                    # angs[l].append(self.angulars(l, m, Theta, Phi))
-                    angs[l].append(ang_l[l + m])
+        if angs is None:
+            angs = self.angulars_cartesian(n_l, *box['real'])
 
         #Build radial part of b.f.
         if not isinstance(W, np.ndarray):
             W = self.get_W(basis)  # Matrix to orthogonalize radial basis
 
-        rads = self.radials(R, basis, W)
+        rads = self.get_radials(R, basis, W)
 
         timer.start('project:project', False)
 
-        if not small_rho:
+        if small_rho:
+            srho = rho
+        else:
             srho = rho[Xm, Ym, Zm]
 
-        #zero_pad_angs (so that it can be converted to numpy array):
-        zeropad = np.zeros_like(Xm, dtype=np.float64)
-        angs_padded = []
-        for l in range(n_l):
-            angs_padded.append([zeropad] * (n_l - l) + angs[l] + [zeropad] * (n_l - l))
-        angs_padded = np.array(angs_padded)
-
-        rads = np.array(rads) * self.V_cell
-        coeff_array = np.einsum('lmijk,nijk,ijk -> nlm', angs_padded, rads, srho, optimize=True)
-        coeff = []
-
-        #remove zero padding from m
-        for n in range(n_rad):
-            for l in range(n_l):
-                for m in range(2 * n_l + 1):
-                    if abs(m - n_l) <= l:
-                        coeff.append(coeff_array[n, l, m])
+        # Angular functions are stored unpadded in the order (l, m), so that
+        # the coefficients come out in the order (n, l, m) directly
+        coeff = np.einsum('l...,n...,... -> nl', angs, rads, srho, optimize=True) * self.V_cell
 
         timer.stop('project:project', False)
         if return_dict:
             return coeff_dict, angs
         else:
-            return np.array(coeff).reshape(1, -1), angs
+            return coeff.reshape(1, -1), angs
 
-    def box_around(self, pos, radius):
+    def grid_offset(self, pos):
+        """ Closest grid point (mesh indices) to pos and the offset of pos from it
+        """
+        cm = np.round(self.U_inv.dot(np.ravel(pos))).astype(int)
+        dr = np.ravel(pos) - self.U.dot(cm)
+        return cm, dr
+
+    def box_around(self, pos, radius, compact=True):
         '''
         Return dictionary containing box around an atom at position pos with
         given radius. Dictionary contains box in mesh, euclidean and spherical
@@ -572,6 +1140,14 @@ class DefaultProjector(BaseProjector):
 
         Parameters
         ---
+            pos: np.ndarray
+                position of atom
+            radius: float
+                radius of sphere around atom
+            compact: bool
+                only keep the grid points within radius (the basis functions
+                vanish outside) and return them as flat arrays. Otherwise return
+                the full cube of grid points as 3d arrays.
 
         Returns
         ---
@@ -583,6 +1159,7 @@ class DefaultProjector(BaseProjector):
             raise Exception('please provide only one point for pos. shape = {}'.format(pos.shape))
 
         pos = pos.flatten()
+        timer.start('box_around', False)
 
         #Create box with max. distance = radius
         rmax = (np.ceil(radius / self.a).astype(int)+2).tolist()
@@ -590,8 +1167,7 @@ class DefaultProjector(BaseProjector):
         X, Y, Z = mesh_3d(self.U, self.a, scaled=True, rmax=rmax, indexing='ij')
 
         #Find mesh pos.
-        cm = np.round(self.U_inv.dot(pos)).astype(int)
-        dr = pos - self.U.dot(cm)
+        cm, dr = self.grid_offset(pos)
         X -= dr[0]
         Y -= dr[1]
         Z -= dr[2]
@@ -602,16 +1178,23 @@ class DefaultProjector(BaseProjector):
 
         R = np.sqrt(X**2 + Y**2 + Z**2)
 
+        if compact:
+            inside = R <= radius
+            Xm, Ym, Zm, X, Y, Z, R = [x[inside] for x in [Xm, Ym, Zm, X, Y, Z, R]]
+
         Phi = np.arctan2(Y, X)
-        Theta = np.arccos(Z / R, where=(R > 1e-15))
-        Theta[R < 1e-15] = 0
+        # Theta = 0 at the origin
+        Theta = np.arccos(np.divide(Z, R, out=np.ones_like(R), where=(R > 1e-15)))
 
+        timer.stop('box_around', False)
         return {'mesh': [Xm, Ym, Zm], 'real': [X, Y, Z], 'radial': [R, Theta, Phi]}
 
 
 class OrthoProjector(DefaultProjector):
 
     _registry_name = 'ortho'
+    # Number of intervals used to tabulate radial functions
+    n_table = 4096
 
     @classmethod
     def dg(cls, r, basis, a):
@@ -730,6 +1313,7 @@ class OrthoProjector(DefaultProjector):
         return cls.orthogonalize(cls.g, r, basis, W)
 
     @classmethod
+    @cached_radial
     def get_W(cls, basis):
         '''
         Get matrix to orthonormalize radial basis functions
@@ -750,7 +1334,83 @@ class OrthoProjector(DefaultProjector):
         return scipy.linalg.sqrtm(np.linalg.pinv(cls.S(basis)))
 
     @classmethod
-    # @jit
+    @cached_radial
+    def radial_table(cls, basis):
+        '''
+        Tabulate orthonormal radial basis functions and their derivatives
+        on a fine grid up to r_o as piecewise cubic polynomials
+
+        Parameters
+        -------
+
+            basis: dict
+                dictionary containing r_o, n
+
+        Returns
+        -------
+
+            np.ndarray (2, 4, n_intervals, n)
+                polynomial coefficients (highest order first) for radials
+                and derivatives in every interval
+        '''
+        W = cls.get_W(basis)
+        r_grid = np.linspace(0, basis['r_o'], cls.n_table + 1)
+        table = [scipy.interpolate.CubicSpline(r_grid, f(r_grid, basis, W), axis=1).c for f in [cls.radials, cls.dradials]]
+        return np.ascontiguousarray(table)
+
+    @staticmethod
+    @jit(nopython=True)
+    def interpolate_compiled(r, r_o, coeffs):
+        """
+        Evaluate tabulated functions (see radial_table) on all points in r
+        """
+        n_intervals, n_funcs = coeffs.shape[1], coeffs.shape[2]
+        h = r_o / n_intervals
+        result = np.zeros((n_funcs, len(r)))
+        for ip in range(len(r)):
+            if r[ip] > r_o:
+                continue
+            i = min(int(r[ip] / h), n_intervals - 1)
+            t = r[ip] - i * h
+            for n in range(n_funcs):
+                result[n, ip] = ((coeffs[0, i, n] * t + coeffs[1, i, n]) * t + coeffs[2, i, n]) * t + coeffs[3, i, n]
+        return result
+
+    def get_radials(self, r, basis, W, derivative=False):
+        '''
+        Orthonormal radial basis functions (or their derivatives) as used by
+        the projector. Unless basis_instructions['radial_table'] is False
+        these are interpolated from radial_table instead of being evaluated
+        from scratch.
+
+        Parameters
+        -------
+
+            r: np.ndarray
+                radius
+            basis: dict
+                dictionary containing r_o, n
+            W: np.ndarray
+                orthogonalization matrix (only used if radial_table is False,
+                tables are built with get_W(basis))
+            derivative: bool
+                return derivatives of radial functions
+
+        Returns
+        -------
+
+            np.ndarray
+                radial functions
+        '''
+        if not self.basis.get('radial_table', True):
+            return self.dradials(r, basis, W) if derivative else self.radials(r, basis, W)
+
+        table = self.radial_table(basis)[int(derivative)]
+        result = self.interpolate_compiled(np.ravel(r).astype(float), basis['r_o'], table)
+        return result.reshape((len(result), ) + np.shape(r))
+
+    @classmethod
+    @cached_radial
     def S(cls, basis):
         '''
         Overlap matrix between radial basis functions
@@ -847,6 +1507,7 @@ class NonOrthoProjector(OrthoProjector):
         return g_(r, r_o, a) / N
 
     @classmethod
+    @cached_radial
     def S(cls, basis):
         '''
         Overlap matrix between radial basis functions
@@ -889,43 +1550,450 @@ class BehlerProjector(OrthoProjector):
         return r * (r_o - r) * np.exp(-(r - mu)**2 / (sigma * r_o))
 
     @classmethod
+    @cached_radial
     def get_W(cls, basis):
         return np.eye(basis['n'])
 
 
+class SparseProjector(OrthoProjector):
+
+    _registry_name = 'sparse'
+
+    def __init__(self, unitcell=None, grid=None, basis_instructions=None):
+        """ Uses the same basis functions as OrthoProjector but assembles a
+        single sparse matrix P that maps the flattened density onto the
+        coefficients of all atoms, so that get_basis_rep and get_V reduce to
+        P @ rho and P.T @ dEdC respectively.
+
+        Parameters
+        ------------------
+        unitcell, array float
+        	Unitcell in bohr
+        grid, array float
+        	Grid points per unitcell
+        basis_instructions, dict
+        	Instructions that defines basis
+        """
+        OrthoProjector.__init__(self, unitcell, grid, basis_instructions)
+        self.projection_matrices = LRUCache(self.all_angs.max_bytes)
+
+    def precompute_stencils(self, positions, species):
+        self.get_projection_matrix(positions, species)
+
+    def force_box(self, pos, spec):
+        """ Box (see box_around) on which the force correction of an atom is
+        evaluated and its cached angular functions (None if not available).
+        Atoms whose basis functions are taken from a (binned) stencil are
+        displaced like the stencil, see stencil_position.
+        """
+        r_o = self.basis[spec]['r_o']
+        idx = '{}{}{}{}'.format(spec, pos[0], pos[1], pos[2])
+        if self.offset_tolerance > 0 and self._uses_stencil(idx):
+            return self.box_around(self.stencil_position(pos), r_o), None
+        return self.box_around(pos, r_o), self.all_angs.get(idx, None)
+
+    def _uses_stencil(self, idx):
+        # P is always assembled from stencils
+        return True
+
+    def get_projection_matrix(self, positions, species):
+        """ Assemble (or retrieve from cache) the sparse projection matrix
+        for given atomic positions
+
+        Parameters
+        ------------------
+        positions, array float
+        	atomic positions
+        species, list string
+        	atomic species (chem. symbols)
+
+        Returns
+        ------------
+        P, scipy.sparse.csr_matrix (n_coefficients, n_gridpoints)
+        	Projection matrix, rows are ordered by species (in order of
+            first occurrence) then by atom
+        slices, dict
+            Rows in P belonging to each species
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        species = list(species)
+        key = positions.tobytes() + ''.join(species).encode()
+        if key in self.projection_matrices:
+            return self.projection_matrices[key]
+
+        timer.start('sparse:assemble', False)
+        rows, cols, vals = [], [], []
+        slices = {}
+        n_rows = 0
+        for spec in dict.fromkeys(species):
+            start = n_rows
+            basis = self.basis[spec]
+            for pos, s in zip(positions, species):
+                if s != spec:
+                    continue
+                stencil = self.get_atom_stencil(pos, spec)
+                n_basis, n_points = stencil['basis'].shape
+                rows.append(np.repeat(np.arange(n_rows, n_rows + n_basis), n_points))
+                cols.append(np.tile(np.ravel_multi_index(stencil['mesh'], self.grid), n_basis))
+                vals.append(stencil['basis'].ravel())
+                n_rows += n_basis
+            slices[spec] = slice(start, n_rows)
+
+        # Duplicate entries (boxes that wrap around the unit cell) are summed
+        P = scipy.sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                                    shape=(n_rows, int(np.prod(self.grid))))
+        timer.stop('sparse:assemble', False)
+
+        self.projection_matrices[key] = (P, slices)
+        return P, slices
+
+    def get_basis_rep(self, rho, positions, species):
+        P, slices = self.get_projection_matrix(positions, species)
+        timer.start('project:project', False)
+        coeffs = P.dot(rho.reshape(-1)) * self.V_cell
+        timer.stop('project:project', False)
+
+        basis_rep = {}
+        for spec in slices:
+            basis_rep[spec] = coeffs[slices[spec]].reshape(list(species).count(spec), -1)
+        return basis_rep
+
+    def get_V(self, dEdC, positions, species, calc_forces=False, rho=None, out=None):
+        if isinstance(dEdC, list):
+            dEdC = dEdC[0]
+
+        P, slices = self.get_projection_matrix(positions, species)
+        for spec in slices:
+            if dEdC[spec].ndim == 3:
+                assert dEdC[spec].shape[0] == 1
+                dEdC[spec] = dEdC[spec][0]
+
+        timer.start('build:build', False)
+        coeffs = np.concatenate([dEdC[spec].reshape(-1) for spec in slices])
+        V = P.T.dot(coeffs).reshape(self.grid)
+        if out is not None:
+            out = self.get_output_buffer(out)
+            out += V
+            V = out
+        timer.stop('build:build', False)
+
+        if calc_forces:
+            return V, self.get_force_corrections(dEdC, positions, species, rho)
+        else:
+            return V
+
+    def get_V_parallel(self, dEdC, positions, species, executor, n_slabs, out=None, max_bytes=None):
+        # P.T @ dEdC is a single (already exact) product, no slabs needed
+        return self.get_V(dEdC, positions, species, out=out)
+
+
+class FFTProjector(OrthoProjector):
+
+    _registry_name = 'fft'
+    _boxed_force_corrections = False
+
+    def __init__(self, unitcell=None, grid=None, basis_instructions=None):
+        """ Projector that computes the coefficients of all atoms at once by
+        convolving the density with every basis function via FFT and
+        interpolating the result at the atomic positions. Uses the radial
+        functions of OrthoProjector, coefficients of atoms that sit on grid
+        points agree exactly, otherwise up to the interpolation error.
+        get_V is the exact adjoint of get_basis_rep.
+
+        Parameters
+        ------------------
+        unitcell, array float
+        	Unitcell in bohr
+        grid, array float
+        	Grid points per unitcell
+        basis_instructions, dict
+        	Instructions that defines basis, basis_instructions['fft_interpolation']
+            sets the number of grid points per axis used for (Lagrange)
+            interpolation at atomic positions (default 4)
+        """
+        OrthoProjector.__init__(self, unitcell, grid, basis_instructions)
+        self.n_interpolation = basis_instructions.get('fft_interpolation', 4)
+        self.basis_ft = LRUCache(self.all_angs.max_bytes)
+
+    def precompute_stencils(self, positions, species):
+        """ Not needed, basis functions are only stored in reciprocal space
+        """
+        pass
+
+    def get_basis_ft(self, spec):
+        """ Fourier transform (rfftn) of all basis functions of species spec
+        centered at the origin, shape (n*l**2, *rfft grid)
+        """
+        if spec in self.basis_ft:
+            return self.basis_ft[spec]
+
+        timer.start('fft:basis', False)
+        stencil = self.get_atom_stencil(np.zeros(3), spec)
+        flat = np.ravel_multi_index(stencil['mesh'], self.grid)
+        basis_ft = []
+        for b in stencil['basis']:
+            B = np.zeros(int(np.prod(self.grid)))
+            kernels.scatter_add(B, flat, np.ascontiguousarray(b))
+            basis_ft.append(scipy.fft.rfftn(B.reshape(self.grid), workers=-1))
+        basis_ft = np.array(basis_ft)
+        timer.stop('fft:basis', False)
+
+        if basis_ft.nbytes <= self.basis_ft.max_bytes:
+            self.basis_ft[spec] = basis_ft
+        return basis_ft
+
+    def get_interpolation(self, positions, derivative=False):
+        """ Lagrange interpolation weights on the grid for every position
+
+        Returns
+        -------
+            flat: np.ndarray (n_positions, n_interpolation**3)
+                indices of grid points in flattened grid
+            weights: np.ndarray (n_positions, n_interpolation**3)
+                interpolation weights
+            dweights: np.ndarray (n_positions, 3, n_interpolation**3)
+                derivative of weights w.r.t. the positions in bohr (only
+                if derivative)
+        """
+        n = self.n_interpolation
+        frac = np.asarray(positions, dtype=float).reshape(-1, 3).dot(self.U_inv.T)
+        base = np.floor(frac).astype(int)
+        t = frac - base
+        nodes = np.arange(n) - (n // 2 - 1)
+
+        # weights[a, axis, node] and their derivatives w.r.t. t
+        weights = np.ones(t.shape + (n, ))
+        dweights = np.zeros(t.shape + (n, ))
+        for j in range(n):
+            for k in range(n):
+                if k != j:
+                    weights[..., j] *= (t - nodes[k]) / (nodes[j] - nodes[k])
+            for m in range(n):
+                if m != j:
+                    term = np.ones_like(t) / (nodes[j] - nodes[m])
+                    for k in range(n):
+                        if k != j and k != m:
+                            term *= (t - nodes[k]) / (nodes[j] - nodes[k])
+                    dweights[..., j] += term
+
+        idx = [(base[:, i:i + 1] + nodes) % self.grid[i] for i in range(3)]
+        flat = np.ravel_multi_index((idx[0][:, :, None, None], idx[1][:, None, :, None], idx[2][:, None, None, :]),
+                                    self.grid).reshape(len(frac), -1)
+
+        def outer(w0, w1, w2):
+            return (w0[:, :, None, None] * w1[:, None, :, None] * w2[:, None, None, :]).reshape(len(frac), -1)
+
+        w = [weights[:, i] for i in range(3)]
+        dw = [dweights[:, i] for i in range(3)]
+        if not derivative:
+            return flat, outer(*w)
+
+        # Chain rule t -> positions, t = positions.dot(U_inv.T) + const.
+        dweights_frac = np.stack([outer(dw[0], w[1], w[2]), outer(w[0], dw[1], w[2]), outer(w[0], w[1], dw[2])], axis=1)
+        dweights = np.einsum('aip,ij->ajp', dweights_frac, self.U_inv)
+        return flat, outer(*w), dweights
+
+    def get_basis_rep(self, rho, positions, species):
+        positions = np.asarray(positions).reshape(-1, 3)
+        species = np.array(species)
+        rho_ft = scipy.fft.rfftn(rho, workers=-1)
+        basis_rep = {}
+        for spec in dict.fromkeys(species):
+            basis_ft = self.get_basis_ft(spec)
+            flat, weights = self.get_interpolation(positions[species == spec])
+            timer.start('project:project', False)
+            coeffs = np.zeros([len(flat), len(basis_ft)])
+            for k, b in enumerate(basis_ft):
+                h = scipy.fft.irfftn(rho_ft * b.conj(), s=rho.shape, workers=-1).reshape(-1)
+                coeffs[:, k] = np.sum(h[flat] * weights, axis=-1)
+            basis_rep[spec] = coeffs * self.V_cell
+            timer.stop('project:project', False)
+        return basis_rep
+
+    def get_V(self, dEdC, positions, species, calc_forces=False, rho=None, out=None):
+        if isinstance(dEdC, list):
+            dEdC = dEdC[0]
+
+        positions = np.asarray(positions).reshape(-1, 3)
+        V_ft = 0
+        for spec in dict.fromkeys(species):
+            if dEdC[spec].ndim == 3:
+                assert dEdC[spec].shape[0] == 1
+                dEdC[spec] = dEdC[spec][0]
+            basis_ft = self.get_basis_ft(spec)
+            flat, weights = self.get_interpolation(positions[np.array(species) == spec])
+            timer.start('build:build', False)
+            for k, b in enumerate(basis_ft):
+                spread = np.zeros(int(np.prod(self.grid)))
+                kernels.scatter_add(spread, flat.ravel(), (weights * dEdC[spec][:, k:k + 1]).ravel())
+                V_ft = V_ft + scipy.fft.rfftn(spread.reshape(self.grid), workers=-1) * b
+            timer.stop('build:build', False)
+        V = scipy.fft.irfftn(V_ft, s=tuple(self.grid), workers=-1)
+        if out is not None:
+            out = self.get_output_buffer(out)
+            out += V
+            V = out
+
+        if calc_forces:
+            return V, self.get_force_corrections(dEdC, positions, species, rho)
+        else:
+            return V
+
+    def get_force_corrections(self, dEdC, positions, species, rho, executor=None, constant_density=None):
+        """ Force and stress corrections consistent with get_basis_rep: the
+        basis functions only depend on the atomic positions through the
+        interpolation weights, so the corrections follow from their derivatives.
+        executor is ignored (the FFTs are multi-threaded), constant_density
+        has to be subtracted from rho beforehand (see DeltaProjector).
+
+        Returns
+        ------------
+        force_correction, np.ndarray (n_atoms + 3, 3)
+        	force corrections and stress correction (concatenated)
+        """
+        if not isinstance(rho, np.ndarray):
+            raise ValueError('Must provide rho as np.ndarray')
+        if constant_density is not None:
+            raise ValueError('FFTProjector needs the constant density to be subtracted from rho')
+
+        if isinstance(dEdC, list):
+            dEdC = dEdC[0]
+
+        positions = np.asarray(positions).reshape(-1, 3)
+        species = np.array(species)
+        rho = rho.reshape(*self.grid)
+        rho_ft = scipy.fft.rfftn(rho, workers=-1)
+        force_corrections = np.zeros([len(species), 3])
+        for spec in dict.fromkeys(species):
+            if dEdC[spec].ndim == 3:
+                assert dEdC[spec].shape[0] == 1
+                dEdC[spec] = dEdC[spec][0]
+            basis_ft = self.get_basis_ft(spec)
+            flat, _, dweights = self.get_interpolation(positions[species == spec], derivative=True)
+            timer.start('forces:fft', False)
+            dEdR = np.zeros([len(flat), 3])
+            for k, b in enumerate(basis_ft):
+                h = scipy.fft.irfftn(rho_ft * b.conj(), s=rho.shape, workers=-1).reshape(-1)
+                dEdR += np.einsum('ap,aip->ai', h[flat], dweights) * dEdC[spec][:, k:k + 1]
+            force_corrections[species == spec] = -dEdR * self.V_cell
+            timer.stop('forces:fft', False)
+
+        stress_correction = np.einsum('ai,aj->ij', force_corrections, positions)
+        return np.concatenate([force_corrections, stress_correction], axis=0)
+
+    def get_V_parallel(self, dEdC, positions, species, executor, n_slabs, out=None, max_bytes=None):
+        # The FFTs are already multi-threaded
+        return self.get_V(dEdC, positions, species, out=out)
+
+
+def select_projector_type(unitcell, grid, basis_instructions, species):
+    """ Recommend real space ('ortho') or reciprocal space ('fft')
+    projection. FFT is faster if the atomic spheres of all atoms together
+    contain more grid points than the grid itself. Only advisory, models
+    have to be used with the projector they were fitted with.
+
+    Parameters
+    ------------------
+    unitcell, array float
+    	Unitcell in bohr
+    grid, array float
+    	Grid points per unitcell
+    basis_instructions, dict
+    	Instructions that defines basis
+    species, list string
+    	atomic species (chem. symbols)
+
+    Returns
+    ------------
+    str
+        projector_type
+    """
+    V_cell = np.abs(np.linalg.det(unitcell)) / np.prod(grid)
+    n_points = sum([4 / 3 * np.pi * basis_instructions[spec]['r_o']**3 / V_cell for spec in species])
+    if n_points > np.prod(grid):
+        return 'fft'
+    else:
+        return 'ortho'
+
+
 class DeltaProjector():
+
+    # Atoms closer than this (in bohr) to an atom passed to set_constant_density are identified with it
+    position_tolerance = 1e-4
+
     def __init__(self, projector):
         """ Wrapper class that can store a constant basis set representation
         and subtract it from given densities (e.g. subtract contribution from
-        core densities)
+        core densities). The constant density itself is kept for the force
+        corrections, projectors whose force corrections only need the density
+        inside the atomic boxes read it there, no difference rho - constant_rho
+        is allocated.
         """
         self.projector = projector
         self.constant_basis_rep = {}
+        self.constant_rho = None
+        self.rows = np.zeros(0, dtype=int)
 
     def set_constant_density(self, rho, positions, species):
-        self.constant_rho = np.array(rho)
-        print('NeuralXC: set_constant_density called ')
         self.constant_basis_rep = \
             self.projector.get_basis_rep(rho, positions, species)
-        self.positions = positions
-        self.species = species
+
+        # Row of every atom in constant_basis_rep[spec]
+        self.positions = np.asarray(positions).reshape(-1, 3)
+        self.species = np.array(species)
+        self.rows = np.zeros(len(self.species), dtype=int)
+        for spec in dict.fromkeys(species):
+            self.rows[self.species == spec] = np.arange(np.sum(self.species == spec))
+
+        # One grid, per-atom copies of the boxes would need more memory once spheres overlap
+        self.constant_rho = np.array(rho)
+
+    def get_atom_indices(self, positions, species):
+        """ Match atoms to those passed to set_constant_density by species
+        and position (within position_tolerance)
+
+        Returns
+        ------------
+        list of tuple
+        	(atom index, row in constant_basis_rep[spec]) for every atom
+        """
+        positions = np.asarray(positions).reshape(-1, 3)
+        distance = np.linalg.norm(positions[:, None] - self.positions[None], axis=-1)
+        distance[np.array(species)[:, None] != self.species[None]] = np.inf
+        index = np.argmin(distance, axis=1)
+        mismatch = distance[np.arange(len(index)), index] > self.position_tolerance
+        if np.any(mismatch):
+            raise ValueError('Atoms at {} do not match any atom of the constant density'.format(
+                positions[mismatch].tolist()))
+        return [(i, self.rows[i]) for i in index]
 
     def get_basis_rep(self, rho, positions, species):
         basis_rep = self.projector.get_basis_rep(rho, positions, species)
-        if positions.shape != self.positions.shape:
-            index = np.where(np.all(self.positions[species[0] == np.array(self.species)] == positions[0], axis=-1))
-            basis_rep[species[0]] -= self.constant_basis_rep[species[0]][index]
-        else:
-            for spec in basis_rep:
-                basis_rep[spec] -= self.constant_basis_rep[spec]
+        rows = {spec: [] for spec in basis_rep}
+        for spec, (_, row) in zip(species, self.get_atom_indices(positions, species)):
+            rows[spec].append(row)
+        for spec in basis_rep:
+            basis_rep[spec] -= self.constant_basis_rep[spec][rows[spec]]
         return basis_rep
 
-    def get_V(self, dEdC, positions, species, calc_forces=False, rho=None):
-
-        if isinstance(rho, np.ndarray):
-            rho = rho - self.constant_rho
+    def get_V(self, dEdC, positions, species, calc_forces=False, rho=None, out=None):
+        V = self.projector.get_V(dEdC, positions, species, out=out)
+        if calc_forces:
+            return V, self.get_force_corrections(dEdC, positions, species, rho)
+        else:
+            return V
 
-        return self.projector.get_V(dEdC, positions, species, calc_forces, rho)
+    def get_force_corrections(self, dEdC, positions, species, rho, executor=None):
+        if not getattr(self.projector, '_boxed_force_corrections', False):
+            if isinstance(rho, np.ndarray):
+                rho = rho - self.constant_rho
+            return self.projector.get_force_corrections(dEdC, positions, species, rho, executor)
+        return self.projector.get_force_corrections(dEdC,
+                                                    positions,
+                                                    species,
+                                                    rho,
+                                                    executor,
+                                                    constant_density=self.constant_rho)
 
     def __getattr__(self, attr):
         if attr in self.__dict__:
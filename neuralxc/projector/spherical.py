@@ -0,0 +1,229 @@
+""" Compiled kernels to evaluate real spherical harmonics and their gradients
+on many points at once
+"""
+import numpy as np
+from numba import jit, prange
+
+
+@jit(nopython=True)
+def _rlylm_norm(lmax):
+    """ Normalization constants of the real spherical harmonics in the
+    order (l, m) with m = -l...l
+    """
+    C = np.zeros((lmax + 1)**2)
+    fourpi = 16 * np.arctan(1.0)
+    for l in range(lmax + 1):
+        ilm0 = l * l + l
+        for m in range(l + 1):
+            fac = (2 * l + 1) / fourpi
+            for i in range(l - m + 1, l + m + 1):
+                fac = fac / i
+            C[ilm0 + m] = np.sqrt(fac)
+            # Real harmonics are combinations of m and -m
+            if m != 0:
+                C[ilm0 + m] = C[ilm0 + m] * np.sqrt(2.0)
+            C[ilm0 - m] = C[ilm0 + m]
+    return C
+
+
+@jit(nopython=True)
+def _legendre(lmax, rxy, rz, P, ZP):
+    """ Associated Legendre polynomials P[l, m] of rz = cos(theta) and their
+    derivatives ZP[l, m] (Numerical Recipes PLGNDR), computed in place
+    """
+    for m in range(lmax, -1, -1):
+        P[m, m + 1] = 0
+        P[m, m] = 1
+        fac = 1.0
+        for i in range(m):
+            P[m, m] = -(P[m, m] * fac * rxy)
+            fac = fac + 2
+        P[m + 1, m] = rz * (2 * m + 1) * P[m, m]
+        for l in range(m + 2, lmax + 1):
+            P[l, m] = (rz * (2 * l - 1) * P[l - 1, m] - (l + m - 1) * P[l - 2, m]) / (l - m)
+        for l in range(m, lmax + 1):
+            ZP[l, m] = -((m * P[l, m] * rz / rxy + P[l, m + 1]) / rxy)
+
+
+@jit(nopython=True)
+def ylm(lmax, X, Y, Z):
+    """ Real spherical harmonics Y_lm in the direction of all points in
+    X, Y, Z. Evaluated by recursion on the euclidean coordinates, without
+    angles or complex intermediates. The origin is treated as lying on the
+    positive z-axis.
+
+    Parameters
+    ----------
+        lmax: int
+            maximum angular momentum
+        X, Y, Z: np.ndarray (n_points)
+            euclidean coordinates of points
+
+    Returns
+    -------
+        np.ndarray ((lmax + 1)**2, n_points)
+            spherical harmonics, ordered by (l, m) with m = -l...l
+    """
+    tiny = 1e-14
+    n_lm = (lmax + 1)**2
+    C = _rlylm_norm(lmax)
+    Y_lm = np.zeros((n_lm, len(X)))
+    P = np.zeros((lmax + 2, lmax + 2))
+    ZP = np.zeros((lmax + 2, lmax + 2))
+
+    for ip in range(len(X)):
+        x, y, z = X[ip], Y[ip], Z[ip]
+        rsize = np.sqrt(x * x + y * y + z * z)
+        if rsize < tiny:
+            rx, ry, rz = 0.0, 0.0, 1.0
+        else:
+            rx = x / rsize
+            ry = y / rsize
+            rz = z / rsize
+
+        # Avoid z axis
+        rxy = np.sqrt(rx * rx + ry * ry)
+        if rxy < tiny:
+            rx = tiny
+            rxy = np.sqrt(rx * rx + ry * ry)
+
+        _legendre(lmax, rxy, rz, P, ZP)
+
+        cosphi = rx / rxy
+        sinphi = ry / rxy
+        cosm = 1.0
+        sinm = 0.0
+        for m in range(lmax + 1):
+            for l in range(m, lmax + 1):
+                Y_lm[l * l + l - m, ip] = C[l * l + l - m] * P[l, m] * sinm
+                Y_lm[l * l + l + m, ip] = C[l * l + l + m] * P[l, m] * cosm
+            cosmm1 = cosm
+            sinmm1 = sinm
+            cosm = cosmm1 * cosphi - sinmm1 * sinphi
+            sinm = cosmm1 * sinphi + sinmm1 * cosphi
+
+    return Y_lm
+
+
+@jit(nopython=True)
+def grlylm(lmax, X, Y, Z):
+    """ Gradients of the real spherical harmonics multiplied by r**l
+    (r**l * Y_lm) for all points in X, Y, Z. Vectorized version of
+    spher_grad.grlylm (J.M. Soler), which it reproduces point by point.
+
+    Parameters
+    ----------
+        lmax: int
+            maximum angular momentum
+        X, Y, Z: np.ndarray (n_points)
+            euclidean coordinates of points
+
+    Returns
+    -------
+        np.ndarray ((lmax + 1)**2, n_points, 3)
+            gradients, ordered by (l, m) with m = -l...l
+    """
+    grly = np.zeros(((lmax + 1)**2, len(X), 3))
+    _grlylm_range(lmax, X, Y, Z, _rlylm_norm(lmax), grly, 0, len(X))
+    return grly
+
+
+@jit(nopython=True, parallel=True)
+def grlylm_parallel(lmax, X, Y, Z, chunk_size=1024):
+    """ Same as grlylm but distributes chunks of points over threads
+    """
+    grly = np.zeros(((lmax + 1)**2, len(X), 3))
+    C = _rlylm_norm(lmax)
+    n_chunks = (len(X) + chunk_size - 1) // chunk_size
+    for ic in prange(n_chunks):
+        _grlylm_range(lmax, X, Y, Z, C, grly, ic * chunk_size, min((ic + 1) * chunk_size, len(X)))
+    return grly
+
+
+@jit(nopython=True)
+def _grlylm_range(lmax, X, Y, Z, C, grly, start, stop):
+    """ Evaluate gradients for the points start...stop-1 and store them in grly
+    """
+    tiny = 1e-14
+    P = np.zeros((lmax + 2, lmax + 2))
+    ZP = np.zeros((lmax + 2, lmax + 2))
+    RL = np.zeros(lmax + 2)
+
+    for ip in range(start, stop):
+        x, y, z = X[ip], Y[ip], Z[ip]
+
+        # Explicit formulas up to l = 2
+        if lmax <= 2:
+            if lmax == 0:
+                continue
+            grly[1, ip, 1] = -C[1]
+            grly[2, ip, 2] = C[2]
+            grly[3, ip, 0] = -C[3]
+            if lmax == 1:
+                continue
+            grly[4, ip, 0] = C[4] * 6 * y
+            grly[4, ip, 1] = C[4] * 6 * x
+            grly[5, ip, 1] = -C[5] * 3 * z
+            grly[5, ip, 2] = -C[5] * 3 * y
+            grly[6, ip, 0] = -C[6] * x
+            grly[6, ip, 1] = -C[6] * y
+            grly[6, ip, 2] = C[6] * 2 * z
+            grly[7, ip, 0] = -C[7] * 3 * z
+            grly[7, ip, 2] = -C[7] * 3 * x
+            grly[8, ip, 0] = C[8] * 6 * x
+            grly[8, ip, 1] = -C[8] * 6 * y
+            continue
+
+        rsize = np.sqrt(x * x + y * y + z * z)
+        if rsize < tiny:
+            grly[1, ip, 1] = -C[1]
+            grly[2, ip, 2] = C[2]
+            grly[3, ip, 0] = -C[3]
+            continue
+
+        # Avoid z axis
+        rx = x / rsize
+        ry = y / rsize
+        rz = z / rsize
+        rxy = np.sqrt(rx * rx + ry * ry)
+        if rxy < tiny:
+            rx = tiny
+            rxy = np.sqrt(rx * rx + ry * ry)
+
+        _legendre(lmax, rxy, rz, P, ZP)
+
+        # RL[l + 1] = r**l
+        RL[0] = 0
+        RL[1] = 1
+        for l in range(1, lmax + 1):
+            RL[l + 1] = RL[l] * rsize
+
+        cosphi = rx / rxy
+        sinphi = ry / rxy
+        cosm = 1.0
+        sinm = 0.0
+        for m in range(lmax + 1):
+            for l in range(m, lmax + 1):
+                for ms in (-1, 1):
+                    if ms == -1:
+                        ilm = l * l + l - m
+                        yy = C[ilm] * P[l, m] * sinm
+                        gy0 = -ZP[l, m] * rx * rz * sinm - P[l, m] * m * cosm * sinphi / rxy
+                        gy1 = -ZP[l, m] * ry * rz * sinm + P[l, m] * m * cosm * cosphi / rxy
+                        gy2 = ZP[l, m] * rxy * rxy * sinm
+                    else:
+                        ilm = l * l + l + m
+                        yy = C[ilm] * P[l, m] * cosm
+                        gy0 = -ZP[l, m] * rx * rz * cosm + P[l, m] * m * sinm * sinphi / rxy
+                        gy1 = -ZP[l, m] * ry * rz * cosm - P[l, m] * m * sinm * cosphi / rxy
+                        gy2 = ZP[l, m] * rxy * rxy * cosm
+                    gy0 = gy0 * C[ilm] / rsize
+                    gy1 = gy1 * C[ilm] / rsize
+                    gy2 = gy2 * C[ilm] / rsize
+                    grly[ilm, ip, 0] = rx * l * RL[l] * yy + RL[l + 1] * gy0
+                    grly[ilm, ip, 1] = ry * l * RL[l] * yy + RL[l + 1] * gy1
+                    grly[ilm, ip, 2] = rz * l * RL[l] * yy + RL[l + 1] * gy2
+            cosmm1 = cosm
+            sinmm1 = sinm
+            cosm = cosmm1 * cosphi - sinmm1 * sinphi
+            sinm = cosmm1 * sinphi + sinmm1 * cosphi
@@ -87,7 +87,7 @@ class PySCFProjector(BaseProjector):
 
         return coeff
 
-    def get_V(self, dEdC, positions=None, species=None, calc_forces=False, rho=None):
+    def get_V(self, dEdC, positions=None, species=None, calc_forces=False, rho=None, out=None):
         if self.spec_agnostic:
             running_idx = 0
             for sym in self.spec_partition:
@@ -97,6 +97,9 @@ class PySCFProjector(BaseProjector):
             dEdC.pop('X')
         dEdC = self.bp.unpad_basis(dEdC)
         V = np.einsum('ijk, k', self.eri3c, dEdC)
+        if out is not None:
+            out += V
+            V = out
         return V
 
 
@@ -7,6 +7,7 @@ from sympy import N
 import numpy as np
 from ..formatter import expand
 from ..base import ABCRegistry
+from ..projector import spherical
 
 
 class SymmetrizerRegistry(ABCRegistry):
@@ -79,6 +80,9 @@ class BaseSymmetrizer(BaseEstimator, TransformerMixin, metaclass=SymmetrizerRegi
         """
         Returns a symmetrized version of the descriptors c (from DensityProjector)
 
+        Stores C for a subsequent call of get_gradient(dEdD). This is not
+        thread-safe, use symmetrize() if the symmetrizer is shared.
+
         Parameters
         ----------------
         C , dict of numpy.ndarrays or list of dict of numpy.ndarrays
@@ -90,11 +94,57 @@ class BaseSymmetrizer(BaseEstimator, TransformerMixin, metaclass=SymmetrizerRegi
             Symmetrized descriptors
         """
         self.C = C
+        return self._symmetrize(C, self._attrs['basis'])
+
+    def symmetrize(self, C):
+        """ Stateless version of get_symmetrized, the symmetrizer is not
+        modified and can be used by several threads at once
+
+        Parameters
+        ----------------
+        C , dict of numpy.ndarrays or list of dict of numpy.ndarrays
+            Electronic descriptors
+
+        Returns
+        ------------
+        D, dict of numpy.ndarrays
+            Symmetrized descriptors
+        ctx, SymmetrizerContext
+            Pass to get_gradient(dEdD, ctx)
+        """
+        basis = self._attrs['basis']
+        return self._symmetrize(C, basis), SymmetrizerContext(C, basis)
+
+    def symmetrize_batch(self, C_list):
+        """ Symmetrize many systems at once. The descriptors of all systems
+        are concatenated per species, such that every species is symmetrized
+        in a single call. Stateless (see symmetrize).
+
+        Parameters
+        ----------------
+        C_list , list of dict of numpy.ndarrays
+            Electronic descriptors of several systems
+
+        Returns
+        ------------
+        D_list, list of dict of numpy.ndarrays
+            Symmetrized descriptors
+        ctx, SymmetrizerContext
+            Pass to get_gradient(dEdD_list, ctx)
+        """
         basis = self._attrs['basis']
-        results = []
+        layout = {}
+        for idx, key, data in expand(list(C_list)):
+            layout.setdefault(key, []).append((idx, data[0].shape))
+        C = concatenate_systems(C_list, layout)
+        D = self._symmetrize(C, basis)
+        return split_systems(D, layout, len(C_list)), SymmetrizerContext(C, basis, layout, len(C_list))
+
+    def _symmetrize(self, C, basis):
+        n_systems = len(C) if isinstance(C, list) else 1
+        results = [{} for _ in range(n_systems)]
 
         for idx, key, data in expand(C):
-            results.append({})
             results[idx][key] = self._symmetrize_function(*data, basis[key]['l'], basis[key]['n'], self._cgs)
 
         if not isinstance(C, list):
@@ -110,30 +160,84 @@ class BaseSymmetrizer(BaseEstimator, TransformerMixin, metaclass=SymmetrizerRegi
         dEdD : dict of np.ndarrays or list of dict of np.ndarrays
         	dE/dD
 
-        C : dict of np.ndarrays or list of dict of np.ndarrays
-        	C
+        C : dict of np.ndarrays or list of dict of np.ndarrays or SymmetrizerContext
+        	C or the context returned by symmetrize/symmetrize_batch, if not
+        	provided C stored by the last call of get_symmetrized is used
 
         Returns
         -------------
         dEdC: dict of np.ndarrays
         """
-        if C == None:
-            C = self.C
+        if isinstance(C, SymmetrizerContext):
+            if C.layout is None:
+                return self._gradient(dEdD, C.C, C.basis)
+            dEdC = self._gradient(concatenate_systems(dEdD, C.layout), C.C, C.basis)
+            return split_systems(dEdC, C.layout, C.n_systems)
 
-        basis = self._attrs['basis']
+        if C is None:
+            C = self.C
+        results = self._gradient(dEdD, C, self._attrs['basis'])
+        self.C = None
+        return results
 
-        results = [{}] * len(C)
+    def _gradient(self, dEdD, C, basis):
+        n_systems = len(C) if isinstance(C, list) else 1
+        results = [{} for _ in range(n_systems)]
 
         for idx, key, data in expand(dEdD, C):
             results[idx][key] = self._gradient_function(*data, basis[key]['l'], basis[key]['n'])
+
         if not isinstance(C, list):
-            self.C = None
             return results[0]
         else:
-            self.C = None
             return results
 
 
+class SymmetrizerContext():
+    def __init__(self, C, basis, layout=None, n_systems=1):
+        """ Everything get_gradient needs to differentiate a call of
+        BaseSymmetrizer.symmetrize or symmetrize_batch
+
+        Parameters
+        ----------
+        C: dict of np.ndarrays or list of dict of np.ndarrays
+            Unsymmetrized descriptors (concatenated per species if batched)
+        basis: dict
+            Basis instructions used to symmetrize
+        layout: dict or None
+            For batches, {species: [(system index, shape of descriptors)]}
+        n_systems: int
+            Number of systems in batch
+        """
+        self.C = C
+        self.basis = basis
+        self.layout = layout
+        self.n_systems = n_systems
+
+
+def concatenate_systems(X_list, layout):
+    """ Concatenate the (atomic) rows of the descriptors of all systems
+    per species, in the order given by layout
+    """
+    X = {}
+    for spec in layout:
+        X[spec] = np.concatenate([X_list[idx][spec].reshape(-1, X_list[idx][spec].shape[-1]) for idx, _ in layout[spec]])
+    return X
+
+
+def split_systems(X, layout, n_systems):
+    """ Inverse of concatenate_systems, the last dimension may differ
+    """
+    X_list = [{} for _ in range(n_systems)]
+    for spec in layout:
+        start = 0
+        for idx, shape in layout[spec]:
+            stop = start + int(np.prod(shape[:-1], dtype=int))
+            X_list[idx][spec] = X[spec][start:stop].reshape(*shape[:-1], -1)
+            start = stop
+    return X_list
+
+
 class CasimirSymmetrizer(BaseSymmetrizer):
 
     _registry_name = 'casimir'
@@ -160,20 +264,110 @@ class CasimirSymmetrizer(BaseSymmetrizer):
         np.ndarray
             Casimir invariants
         """
+        starts, _ = casimir_segments(n_l, n)
+        if np.iscomplexobj(c):
+            c2 = (c * np.conj(c)).real
+        else:
+            c2 = np.square(c)
+        return np.add.reduceat(c2, starts, axis=-1)
 
-        c_shape = c.shape
+    @staticmethod
+    def _gradient_function(dEdd, c, n_l, n):
+        """Implements chain rule to obtain dE/dC from dE/dD
+        (unsymmetrized from symmetrized)
+
+        Parameters
+        ------------------
+        dEdD : np.ndarray
+        	dE/dD
+
+        c: np.ndarray
+            Unsymmetrized basis representation
+
+        n_l: int
+            number of angular momenta (not equal to maximum ang. momentum!
+                example: if only s-orbitals n_l would be 1)
+
+        n: int
+            number of radial functions
+
+        Returns
+        -------------
+        dEdC: dict of np.ndarrays
+        """
+        _, sizes = casimir_segments(n_l, n)
+        dEdd_shape = dEdd.shape
+        dEdd = dEdd.reshape(-1, dEdd_shape[-1])
+        c = c.reshape(-1, c.shape[-1])
+        grad = np.repeat(dEdd, sizes, axis=-1).astype(np.result_type(dEdd, c), copy=False)
+        grad *= c
+        grad *= 2
+        return grad.reshape(*dEdd_shape[:-1], grad.shape[-1])
+
+
+# Segments (start, size) of the (n, l) blocks in the coefficient vector,
+# keyed by the basis shape (n_l, n)
+casimir_segment_library = {}
+
+
+def casimir_segments(n_l, n):
+    """ Start indices and sizes of the blocks of 2l+1 coefficients belonging
+    to the same (n, l) in a coefficient vector ordered as (n, l, m)
+
+    Parameters
+    ----------
+    n_l: int
+        number of angular momenta
+    n: int
+        number of radial functions
+
+    Returns
+    -------
+    starts, sizes: np.ndarray of int
+    """
+    key = (n_l, n)
+    if not key in casimir_segment_library:
+        sizes = np.tile(2 * np.arange(n_l) + 1, n)
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        casimir_segment_library[key] = (starts, sizes)
+    return casimir_segment_library[key]
 
-        c = c.reshape(-1, c_shape[-1])
-        casimirs = []
-        idx = 0
 
-        for n_ in range(0, n):
-            for l in range(n_l):
-                casimirs.append(np.linalg.norm(c[:, idx:idx + (2 * l + 1)], axis=1)**2)
-                idx += 2 * l + 1
-        casimirs = np.array(casimirs).T
+class MixedCasimirSymmetrizer(BaseSymmetrizer):
 
-        return casimirs.reshape(*c_shape[:-1], -1)
+    _registry_name = 'mixed_casimir'
+
+    @staticmethod
+    def _symmetrize_function(c, n_l, n, *args):
+        """ Returns the casimir invariants with mixed radial channels
+        (power spectrum) sum_m c_{n1 l m} c_{n2 l m} of the tensors stored in c,
+        ordered by (n1, n2 >= n1, l)
+
+        Parameters:
+        -----------
+
+        c: np.ndarray of floats/complex
+            Stores the tensor elements in the order (n,l,m)
+
+        n_l: int
+            number of angular momenta (not equal to maximum ang. momentum!
+                example: if only s-orbitals n_l would be 1)
+
+        n: int
+            number of radial functions
+
+        Returns
+        -------
+        np.ndarray
+            Casimir invariants
+        """
+        n1, n2 = np.triu_indices(n)
+        c_shape = c.shape
+        # einsum('anlm,aklm->ankl') as matrix product batched over atoms and l
+        c = pad_lm(c.reshape(-1, n, n_l**2), n_l).transpose(0, 2, 1, 3)
+        power_spectrum = np.matmul(c, np.conj(c).transpose(0, 1, 3, 2)).real
+        power_spectrum = power_spectrum[:, :, n1, n2].transpose(0, 2, 1)
+        return power_spectrum.reshape(*c_shape[:-1], -1)
 
     @staticmethod
     def _gradient_function(dEdd, c, n_l, n):
@@ -199,198 +393,256 @@ class CasimirSymmetrizer(BaseSymmetrizer):
         -------------
         dEdC: dict of np.ndarrays
         """
+        n1, n2 = np.triu_indices(n)
         dEdd_shape = dEdd.shape
-        dEdd = dEdd.reshape(-1, dEdd.shape[-1])
-        c = c.reshape(-1, c.shape[-1])
-        casimirs_mask = np.zeros_like(c)
-        idx = 0
-        cnt = 0
-        for n_ in range(0, n):
-            for l in range(n_l):
-                casimirs_mask[:, idx:idx + (2 * l + 1)] = dEdd[:, cnt:cnt + 1]
-                idx += 2 * l + 1
-                cnt += 1
-
-        grad = 2 * c * casimirs_mask
-        return grad.reshape(*dEdd_shape[:-1], grad.shape[-1])
+        dEdd = dEdd.reshape(-1, len(n1), n_l)
+        c = pad_lm(c.reshape(len(dEdd), n, n_l**2), n_l).transpose(0, 2, 1, 3)
+
+        # dE/dP as a symmetric matrix in the radial channels, P_nn is quadratic in c_n
+        dEdd = dEdd.transpose(0, 2, 1)
+        dEdP = np.zeros((len(dEdd), n_l, n, n), dtype=dEdd.dtype)
+        dEdP[:, :, n1, n2] = dEdd
+        dEdP[:, :, n2, n1] += dEdd
+        grad = np.matmul(dEdP, c).transpose(0, 2, 1, 3)
+        grad = grad.reshape(len(dEdd), n, -1)[..., lm_padding(n_l)]
+        return grad.reshape(*dEdd_shape[:-1], -1)
+
+
+# Position of every (l, m) in an array padded to shape (n_l, 2 * n_l - 1),
+# keyed by the number of angular momenta
+lm_padding_library = {}
+
+
+def lm_padding(n_l):
+    """ Indices that place the coefficients of a radial function, ordered by
+    (l, m), into a flattened (n_l, 2 * n_l - 1) array with m = -l...l
+    starting in the first column
+
+    Parameters
+    ----------
+    n_l: int
+        number of angular momenta
+
+    Returns
+    -------
+    np.ndarray of int
+    """
+    if not n_l in lm_padding_library:
+        lm_padding_library[n_l] = np.concatenate([l * (2 * n_l - 1) + np.arange(2 * l + 1) for l in range(n_l)])
+    return lm_padding_library[n_l]
+
+
+def pad_lm(c, n_l):
+    """ Coefficients c (..., n_l**2) ordered by (l, m) as zero-padded array
+    (..., n_l, 2 * n_l - 1)
+    """
+    padded = np.zeros(c.shape[:-1] + (n_l * (2 * n_l - 1), ), dtype=c.dtype)
+    padded[..., lm_padding(n_l)] = c
+    return padded.reshape(c.shape[:-1] + (n_l, 2 * n_l - 1))
+
+
+class BispectrumSymmetrizer(BaseSymmetrizer):
+
+    _registry_name = 'bispectrum'
+
+    @staticmethod
+    def _symmetrize_function(c, n_l, n, *args):
+        """ Returns the casimir invariants followed by the bispectrum
+        B_{l1 l2 l3} = sum_m G(l1 m1, l2 m2, l3 m3) c_{l1 m1} c_{l2 m2} c_{l3 m3}
+        (for every radial function and l1 <= l2 <= l3) of the tensors stored in c
 
+        Parameters:
+        -----------
 
-# class MixedCasimirSymmetrizer(Symmetrizer):
-#
-#     _registry_name = 'mixed_casimir'
-#
-#     def __init__(self, symmetrize_instructions):
-#         self._attrs = symmetrize_instructions
-#
-#     @staticmethod
-#     def _symmetrize_function(c, n_l, n, *args):
-#         """ Returns the casimir invariants with mixed radial channels
-#         of the tensors stored in c
-#
-#         Parameters:
-#         -----------
-#
-#         c: np.ndarray of floats/complex
-#             Stores the tensor elements in the order (n,l,m)
-#
-#         n_l: int
-#             number of angular momenta (not equal to maximum ang. momentum!
-#                 example: if only s-orbitals n_l would be 1)
-#
-#         n: int
-#             number of radial functions
-#
-#         Returns
-#         -------
-#         np.ndarray
-#             Casimir invariants
-#         """
-#         c_shape = c.shape
-#
-#         c = c.reshape(-1, c_shape[-1])
-#         c = c.reshape(len(c), n, -1)
-#         casimirs = []
-#
-#         for n1 in range(0, n):
-#             for n2 in range(n1, n):
-#                 idx = 0
-#                 for l in range(n_l):
-#                     casimirs.append(np.sum(c[:,n1,idx:idx+(2*l+1)]*\
-#                                            np.conj(c[:,n2,idx:idx+(2*l+1)]),
-#                                             axis = -1).real)
-#                     idx += 2 * l + 1
-#
-#         casimirs = np.array(casimirs).T
-#
-#         return casimirs.reshape(*c_shape[:-1], -1)
-#
-#     @staticmethod
-#     def _gradient_function(dEdd, c, n_l, n):
-#         """Implements chain rule to obtain dE/dC from dE/dD
-#         (unsymmetrized from symmetrized)
-#
-#         Parameters
-#         ------------------
-#         dEdD : np.ndarray
-#         	dE/dD
-#
-#         c: np.ndarray
-#             Unsymmetrized basis representation
-#
-#         n_l: int
-#             number of angular momenta (not equal to maximum ang. momentum!
-#                 example: if only s-orbitals n_l would be 1)
-#
-#         n: int
-#             number of radial functions
-#
-#         Returns
-#         -------------
-#         dEdC: dict of np.ndarrays
-#         """
-#         dEdd_shape = dEdd.shape
-#         c_shape = c.shape
-#         dEdd = dEdd.reshape(-1, dEdd.shape[-1])
-#         c = np.conj(c.reshape(-1, c.shape[-1]))
-#         c = c.reshape(len(c), n, -1)
-#         casimirs_mask = np.zeros_like(c)
-#         idx = 0
-#         cnt = 0
-#         for n1 in range(0, n):
-#             for n2 in range(n1, n):
-#                 idx = 0
-#                 for l in range(n_l):
-#                     casimirs_mask[:, n1, idx:idx + (2 * l + 1)] = dEdd[:, cnt:cnt + 1]
-#                     idx += 2 * l + 1
-#                     cnt += 1
-#
-#         grad = 2 * c * casimirs_mask
-#         return grad.reshape(*c_shape[:-1], -1)
-
-# class BispectrumSymmetrizer(Symmetrizer):
-#
-#     _registry_name = 'bispectrum'
-#     def __init__(self, attrs):
-#         print('WARNING! This class has not been thoroughly tested yet')
-#         # super().__init__(attrs)
-#         self._attrs = attrs
-#         # Create array with Clebsch-Gordon coefficients
-#         basis = attrs['basis']
-#
-#         n_l_max = 0
-#         for spec in basis:
-#             n_l_max = max(n_l_max, basis[spec]['l'])
-#
-#         self._cgs = cg_matrix(n_l_max)
-#
-#     @staticmethod
-#     def _symmetrize_function(c, n_l, n, cgs=None):
-#         """ Returns the bispectrum of the tensors stored in c
-#
-#         Parameters:
-#         -----------
-#
-#         c: np.ndarray of floats/complex
-#             Stores the tensor elements in the order (n,l,m)
-#
-#         n_l: int
-#             number of angular momenta (not equal to maximum ang. momentum!
-#                 example: if only s-orbitals n_l would be 1)
-#
-#         n: int
-#             number of radial functions
-#
-#         cgs: np.ndarray, optional
-#             Clebsch-Gordan coefficients, if not provided, calculated on-the-fly
-#
-#         Returns
-#         -------
-#         np.ndarray
-#             Bispectrum
-#         """
-#         casimirs = CasimirSymmetrizer._symmetrize_function(c,n_l,n)
-#
-#         c_shape = c.shape
-#
-#         c = c.reshape(-1,c_shape[-1])
-#         c = c.reshape(len(c),n,-1)
-#         bispectrum = []
-#         idx = 0
-#
-#         start = {}
-#         for l in range(0, n_l):
-#             start[l] = idx
-#             idx += 2*l + 1
-#
-#         if not isinstance(cgs, np.ndarray):
-#             cgs = cg_matrix(n_l)
-#
-#         for n in range(0, n):
-#             for l1 in range(n_l):
-#                 for l2 in range(n_l):
-#                     for l in range(abs(l2-l1),min(l1+l2+1, n_l)):
-#                         b = 0
-#                         if np.linalg.norm(cgs[l1,:,l2,:,l,:]) < 1e-15:
-#                             continue
-#
-#                         for m in range(-l,l+1):
-#                             for m1 in range(-l1,l1+1):
-#                                 for m2 in range(-l2,l2+1):
-#                                     b +=\
-#                                      np.conj(c[:,n,start[l] + m + l])*\
-#                                      c[:,n,start[l1] + m1 + l1]*\
-#                                      c[:,n,start[l2] + m2 + l2]*\
-#                                      cgs[l1,m1,l2,m2,l,m]
-#                                      # cgs[l1,l2,l,m1,m2,m]
-#                         if np.any(abs(b.imag) > 1e-3):
-#                             raise Exception('Not real')
-#                         bispectrum.append(b.real.round(5))
-#
-#         bispectrum = np.array(bispectrum).T
-#
-#         bispectrum =  bispectrum.reshape(*c_shape[:-1], -1)
-#         bispectrum = np.concatenate([casimirs, bispectrum], axis = -1)
-#         return bispectrum
+        c: np.ndarray of floats/complex
+            Stores the tensor elements in the order (n,l,m), complex
+            coefficients (of complex spherical harmonics) are transformed
+            to the real basis
+
+        n_l: int
+            number of angular momenta (not equal to maximum ang. momentum!
+                example: if only s-orbitals n_l would be 1)
+
+        n: int
+            number of radial functions
+
+        Returns
+        -------
+        np.ndarray
+            Casimir invariants and bispectrum
+        """
+        coupling = bispectrum_coupling(n_l)
+        i1, i2, i3 = coupling['index']
+        c_shape = c.shape
+        c = c.reshape(-1, n, n_l**2)
+        if np.iscomplexobj(c):
+            c = np.dot(c, coupling['complex_to_real'].T).real
+        casimirs = CasimirSymmetrizer._symmetrize_function(c.reshape(len(c), -1), n_l, n)
+        casimirs = casimirs.reshape(*c_shape[:-1], -1)
+
+        products = c[..., i1] * c[..., i2]
+        products *= c[..., i3]
+        products *= coupling['value']
+        bispectrum = np.add.reduceat(products, coupling['start'], axis=-1)
+
+        bispectrum = bispectrum.reshape(*c_shape[:-1], -1)
+        return np.concatenate([casimirs, bispectrum], axis=-1)
+
+    @staticmethod
+    def _gradient_function(dEdd, c, n_l, n):
+        """Implements chain rule to obtain dE/dC from dE/dD
+        (unsymmetrized from symmetrized)
+
+        Parameters
+        ------------------
+        dEdD : np.ndarray
+        	dE/dD
+
+        c: np.ndarray
+            Unsymmetrized basis representation
+
+        n_l: int
+            number of angular momenta (not equal to maximum ang. momentum!
+                example: if only s-orbitals n_l would be 1)
+
+        n: int
+            number of radial functions
+
+        Returns
+        -------------
+        dEdC: dict of np.ndarrays
+        """
+        coupling = bispectrum_coupling(n_l)
+        n_casimirs = n * n_l
+        dEdd_shape = dEdd.shape
+        dEdd = dEdd.reshape(-1, dEdd_shape[-1])
+        c = c.reshape(-1, n, n_l**2)
+        is_complex = np.iscomplexobj(c)
+        if is_complex:
+            c = np.dot(c, coupling['complex_to_real'].T).real
+        grad = CasimirSymmetrizer._gradient_function(dEdd[:, :n_casimirs], c.reshape(len(c), -1), n_l, n)
+        grad = grad.reshape(c.shape)
+
+        dEdb = dEdd[:, n_casimirs:].reshape(len(c), n, -1)
+
+        # Every entry contributes to the coefficients at all three of its indices
+        target, other1, other2, entry = coupling['gradient_index']
+        weights = dEdb[..., coupling['invariant'][entry]] * coupling['value'][entry]
+        weights *= c[..., other1]
+        weights *= c[..., other2]
+        grad_b = np.zeros_like(c)
+        grad_b[..., coupling['gradient_target']] = np.add.reduceat(weights, coupling['gradient_start'], axis=-1)
+
+        grad += grad_b
+        if is_complex:
+            grad = np.dot(grad, coupling['complex_to_real'])
+        return grad.reshape(*dEdd_shape[:-1], -1)
+
+
+# Non-zero real Gaunt coefficients (sparse) keyed by the number of angular momenta
+bispectrum_coupling_library = {}
+
+
+def gaunt_tensor(n_l):
+    """ Real Gaunt coefficients G(l1 m1, l2 m2, l3 m3), the integrals over
+    the unit sphere of products of three real spherical harmonics (same
+    convention as the projectors), for all l < n_l. Computed by Gauss-Legendre
+    (in cos(theta)) and trapezoidal (in phi) quadrature, which is exact for
+    these polynomials.
+
+    Returns
+    -------
+    np.ndarray (n_l**2, n_l**2, n_l**2)
+        indices ordered by (l, m) with m = -l...l
+    """
+    lmax = n_l - 1
+    x, w_theta = np.polynomial.legendre.leggauss(3 * lmax // 2 + 1)
+    phi = np.arange(3 * lmax + 1) * 2 * np.pi / (3 * lmax + 1)
+    sin_theta = np.sqrt(1 - x**2)
+    X = np.outer(sin_theta, np.cos(phi)).ravel()
+    Y = np.outer(sin_theta, np.sin(phi)).ravel()
+    Z = np.outer(x, np.ones_like(phi)).ravel()
+    weights = np.outer(w_theta, np.ones_like(phi)).ravel() * 2 * np.pi / len(phi)
+    ylm = spherical.ylm(lmax, X, Y, Z)
+    return np.einsum('ip,jp,kp->ijk', ylm, ylm, ylm * weights, optimize=True)
+
+
+def bispectrum_coupling(n_l):
+    """ Sparse (COO) coupling tensor of the bispectrum for all angular momenta
+    l1 <= l2 <= l3 < n_l with non-vanishing real Gaunt coefficients
+    (triangle condition, l1 + l2 + l3 even)
+
+    Parameters
+    ----------
+    n_l: int
+        number of angular momenta
+
+    Returns
+    -------
+    dict
+        'index': three arrays of (l, m) indices of the entries,
+        'value': coefficients, 'invariant': invariant of every entry,
+        'start': first entry of every invariant (entries sorted by invariant),
+        'triplets': (l1, l2, l3) of every invariant,
+        'gradient_index', 'gradient_target', 'gradient_start': entries
+        regrouped by the coefficient they are differentiated with respect to,
+        'complex_to_real': unitary transformation of coefficients from complex
+        to real spherical harmonics
+    """
+    if n_l in bispectrum_coupling_library:
+        return bispectrum_coupling_library[n_l]
+
+    gaunt = gaunt_tensor(n_l)
+    index, value, invariant, triplets = [], [], [], []
+    for l1 in range(n_l):
+        for l2 in range(l1, n_l):
+            for l3 in range(l2, min(l1 + l2 + 1, n_l)):
+                if (l1 + l2 + l3) % 2:
+                    continue
+                block = gaunt[l1**2:(l1 + 1)**2, l2**2:(l2 + 1)**2, l3**2:(l3 + 1)**2]
+                nonzero = np.nonzero(np.abs(block) > 1e-12)
+                index.append(np.array([nonzero[0] + l1**2, nonzero[1] + l2**2, nonzero[2] + l3**2]))
+                value.append(block[nonzero])
+                invariant.append(np.full(len(nonzero[0]), len(triplets)))
+                triplets.append((l1, l2, l3))
+    index = np.concatenate(index, axis=1)
+    value = np.concatenate(value)
+    invariant = np.concatenate(invariant)
+    start = np.searchsorted(invariant, np.arange(len(triplets)))
+
+    # d/dc_i of c_i1 c_i2 c_i3 = c_other1 c_other2 for every position of i
+    entry = np.tile(np.arange(len(value)), 3)
+    target = index.ravel()
+    other1 = np.concatenate([index[1], index[0], index[0]])
+    other2 = np.concatenate([index[2], index[2], index[1]])
+    order = np.argsort(target, kind='stable')
+    target, other1, other2, entry = target[order], other1[order], other2[order], entry[order]
+    gradient_target, gradient_start = np.unique(target, return_index=True)
+
+    # Coefficients of complex spherical harmonics (Condon-Shortley phase) to
+    # coefficients of the real ones, Y_l,+-m = sqrt(2) Re/Im Y_lm
+    complex_to_real = np.zeros((n_l**2, n_l**2), dtype=complex)
+    for l in range(n_l):
+        complex_to_real[l * l + l, l * l + l] = 1
+        for m in range(1, l + 1):
+            plus, minus = l * l + l + m, l * l + l - m
+            complex_to_real[plus, plus] = 1 / np.sqrt(2)
+            complex_to_real[plus, minus] = (-1)**m / np.sqrt(2)
+            complex_to_real[minus, plus] = 1j / np.sqrt(2)
+            complex_to_real[minus, minus] = -1j * (-1)**m / np.sqrt(2)
+
+    bispectrum_coupling_library[n_l] = {
+        'index': index,
+        'value': value,
+        'invariant': invariant,
+        'start': start,
+        'triplets': triplets,
+        'gradient_index': (target, other1, other2, entry),
+        'gradient_target': gradient_target,
+        'gradient_start': gradient_start,
+        'complex_to_real': complex_to_real
+    }
+    return bispectrum_coupling_library[n_l]
 
 
 def symmetrizer_factory(symmetrize_instructions):
@@ -426,44 +678,3 @@ def cg_matrix(n_l):
                             # cgs[l1,l2,l,m1,m2,m] = N(CG(l1,l2,l,m1,m2,m).doit())
                             cgs[l1, m1, l2, m2, l, m] = N(CG(l1, m1, l2, m2, l, m).doit())
     return cgs
-
-
-# def to_casimirs_mixn(c, n_l, n):
-#     """ Returns the casimir invariants with mixed radial channels
-#     of the tensors stored in c
-#
-#     Parameters:
-#     -----------
-#
-#     c: np.ndarray of floats/complex
-#         Stores the tensor elements in the order (n,l,m)
-#
-#     n_l: int
-#         number of angular momenta (not equal to maximum ang. momentum!
-#             example: if only s-orbitals n_l would be 1)
-#
-#     n: int
-#         number of radial functions
-#
-#     Returns
-#     -------
-#     np.ndarray
-#         Casimir invariants
-#     """
-#     c_shape = c.shape
-#
-#     c = c.reshape(-1,c_shape[-1])
-#     c = c.reshape(len(c),n,-1)
-#     casimirs = []
-#
-#     for n1 in range(0, n):
-#         for n2 in range(n1,n):
-#             idx = 0
-#             for l in range(n_l):
-#                 casimirs.append(np.sum(c[:,n1,idx:idx+(2*l+1)]*\
-#                                        np.conj(c[:,n2,idx:idx+(2*l+1)]), axis = -1).real)
-#                 idx += 2*l + 1
-#
-#     casimirs = np.array(casimirs).T
-#
-#     return casimirs.reshape(*c_shape[:-1], -1)
@@ -132,3 +132,59 @@ def test_dspher():
             print('exact', exact)
             print('fd', fd)
             assert np.allclose(exact, fd, atol=incr)
+
+
+@pytest.mark.fast
+@pytest.mark.spher
+@pytest.mark.parametrize('lmax', [0, 1, 2, 3, 6])
+def test_grlylm_vectorized(lmax):
+    from neuralxc.projector.spherical import grlylm as grlylm_vectorized
+    from neuralxc.projector.spherical import grlylm_parallel
+
+    coords = np.random.rand(50, 3) - 0.5
+    coords[0] = 0
+    coords[1] = [0, 0, 0.3]
+
+    dangs_ref = np.array([grlylm(lmax, c) for c in coords]).transpose(2, 0, 1)
+    dangs = grlylm_vectorized(lmax, coords[:, 0].copy(), coords[:, 1].copy(), coords[:, 2].copy())
+    assert np.allclose(dangs, dangs_ref)
+
+    dangs = grlylm_parallel(lmax, coords[:, 0].copy(), coords[:, 1].copy(), coords[:, 2].copy(), chunk_size=7)
+    assert np.allclose(dangs, dangs_ref)
+
+
+@pytest.mark.fast
+@pytest.mark.spher
+@pytest.mark.parametrize('lmax', [0, 2, 3, 6])
+def test_angulars_cartesian(lmax):
+
+    coords = np.random.rand(50, 3) - 0.5
+    coords[1] = [0, 0, 0.3]
+    coords[2] = [0, 0, -0.3]
+    r = np.linalg.norm(coords, axis=-1)
+    l = np.array([l for l in range(lmax + 1) for m in range(-l, l + 1)])
+
+    angs_ref = np.array([rlylm(lmax, c) for c in coords]).T / r**l.reshape(-1, 1)
+    angs = xc.projector.DefaultProjector.angulars_cartesian(lmax + 1, *coords.T)
+    assert np.allclose(angs, angs_ref)
+
+    theta = np.arccos(coords[:, 2] / r)
+    phi = np.arctan2(coords[:, 1], coords[:, 0])
+    for l in range(lmax + 1):
+        assert np.allclose(xc.projector.DefaultProjector.angulars_real(l, theta, phi), angs[l**2:(l + 1)**2])
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('projector_type', ['ortho', 'non-ortho', 'behler'])
+def test_radial_table(projector_type):
+
+    basis_set = {'O': {'n': 4, 'l': 3, 'r_o': 1.7}, 'projector_type': projector_type}
+    projector = xc.projector.DensityProjector(np.eye(3) * 10, np.array([20, 20, 20]), basis_set)
+
+    basis = basis_set['O']
+    W = projector.get_W(basis)
+    assert W is projector.get_W(dict(basis))
+
+    r = np.linspace(0, 2, 333)
+    assert np.allclose(projector.get_radials(r, basis, W), projector.radials(r, basis, W))
+    assert np.allclose(projector.get_radials(r, basis, W, derivative=True), projector.dradials(r, basis, W))
@@ -14,6 +14,7 @@ import pickle
 import copy
 import matplotlib.pyplot as plt
 from neuralxc.constants import Bohr, Hartree
+from neuralxc.parallel import process_backend_supported
 try:
     import ase
     ase_found = True
@@ -97,7 +98,7 @@ def test_density_projector(projector_type):
                           ]) / xc.constants.Bohr
 
     basis_rep = density_projector.get_basis_rep(rho, positions, ['O', 'H', 'H'])
-    if projector_type == 'ortho':
+    if projector_type in ['ortho', 'sparse']:
         if save_test_density_projector:
             with open(os.path.join(test_dir, 'h2o_rep.pckl'), 'wb') as file:
                 pickle.dump(basis_rep, file)
@@ -109,6 +110,397 @@ def test_density_projector(projector_type):
                 assert np.allclose(basis_rep[spec], basis_rep_ref[spec])
 
 
+@pytest.mark.fast
+@pytest.mark.parametrize('projector_type', ['ortho', 'non-ortho', 'behler'])
+def test_precomputed_stencils(projector_type):
+
+    density_getter = xc.utils.SiestaDensityGetter(binary=True)
+    rho, unitcell, grid = density_getter.get_density(os.path.join(test_dir, 'benzene_test', 'benzene.RHOXC'))
+
+    basis_set = {'C': {'n': 3, 'l': 3, 'r_o': 2}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}, 'projector_type': projector_type}
+    positions = np.array([[0.0, 0.0, 0.0], [5.1, 4.3, 2.2], [18.0, 10.0, 1.0]])
+    species = ['C', 'H', 'H']
+
+    density_projector = xc.projector.DensityProjector(unitcell, grid, basis_set)
+    basis_rep_ref = density_projector.get_basis_rep(rho, positions, species)
+    dEdC = {spec: np.random.rand(*basis_rep_ref[spec].shape) for spec in basis_rep_ref}
+    V_ref = density_projector.get_V(dEdC, positions, species)
+
+    density_projector.precompute_stencils(positions, species)
+    basis_rep = density_projector.get_basis_rep(rho, positions, species)
+    V = density_projector.get_V(dEdC, positions, species)
+
+    for spec in basis_rep:
+        assert np.allclose(basis_rep[spec], basis_rep_ref[spec])
+    assert np.allclose(V, V_ref)
+
+
+@pytest.mark.fast
+def test_batched_stencils():
+
+    density_getter = xc.utils.SiestaDensityGetter(binary=True)
+    rho, unitcell, grid = density_getter.get_density(os.path.join(test_dir, 'benzene_test', 'benzene.RHOXC'))
+
+    basis_set = {'C': {'n': 3, 'l': 3, 'r_o': 2}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}}
+    positions = np.array([[0.0, 0.0, 0.0], [5.1, 4.3, 2.2], [18.0, 10.0, 1.0], [6.0, 4.0, 2.0]])
+    species = ['H', 'C', 'H', 'C']
+
+    density_projector = xc.projector.DensityProjector(unitcell, grid, basis_set)
+    density_projector.precompute_stencils(positions, species)
+    assert density_projector.match_stencil_batches(positions, species)
+    assert density_projector.match_stencil_batches(positions[:2], species[:2]) is None
+
+    basis_rep = density_projector.get_basis_rep(rho, positions, species)
+    dEdC = {spec: np.random.rand(*basis_rep[spec].shape) for spec in basis_rep}
+    V = density_projector.get_V(dEdC, positions, species)
+
+    # Per atom (unbatched) stencils
+    V_ref = 0
+    for pos, spec, i in zip(positions, species, [0, 0, 1, 1]):
+        basis_rep_ref = density_projector.get_basis_rep(rho, pos.reshape(-1, 3), [spec])
+        assert np.allclose(basis_rep_ref[spec][0], basis_rep[spec][i])
+        V_ref += density_projector.get_V({spec: dEdC[spec][i:i + 1]}, pos.reshape(-1, 3), [spec])
+    assert np.allclose(V, V_ref)
+
+
+@pytest.mark.fast
+@pytest.mark.filterwarnings('error::RuntimeWarning')  # Atom on a grid point, R = 0
+def test_numba_kernel():
+
+    density_getter = xc.utils.SiestaDensityGetter(binary=True)
+    rho, unitcell, grid = density_getter.get_density(os.path.join(test_dir, 'benzene_test', 'benzene.RHOXC'))
+
+    basis_set = {'C': {'n': 3, 'l': 4, 'r_o': 2}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}}
+    positions = np.array([[0.0, 0.0, 0.0], [5.1, 4.3, 2.2], [18.0, 10.0, 1.0], [6.0, 4.0, 2.0]])
+    species = ['H', 'C', 'H', 'C']
+
+    results = []
+    for kernel in ['numpy', 'numba']:
+        density_projector = xc.projector.DensityProjector(unitcell, grid, dict(basis_set, kernel=kernel))
+        density_projector.precompute_stencils(positions, species)
+        basis_rep = density_projector.get_basis_rep(rho, positions, species)
+        dEdC = {spec: np.linspace(-1, 1, basis_rep[spec].size).reshape(basis_rep[spec].shape) for spec in basis_rep}
+        V, forces = density_projector.get_V(dEdC, positions, species, calc_forces=True, rho=rho)
+        results.append((basis_rep, V, forces))
+
+    for spec in results[0][0]:
+        assert np.allclose(results[0][0][spec], results[1][0][spec])
+    assert np.allclose(results[0][1], results[1][1])
+    assert np.allclose(results[0][2], results[1][2])
+
+    with pytest.raises(ValueError):
+        xc.projector.DensityProjector(unitcell, grid, dict(basis_set, kernel='cuda'))
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('projector_type', ['ortho', 'sparse'])
+def test_wrapped_boxes(projector_type):
+    """ Boxes larger than the unit cell: V has to be the adjoint of the
+    projection, <V, rho> = sum(dEdC * C), even though grid points repeat
+    """
+    unitcell = np.eye(3) * 2.5
+    grid = np.array([9, 9, 9])
+    basis_set = {'O': {'n': 2, 'l': 3, 'r_o': 2.0}, 'projector_type': projector_type}
+    positions = np.array([[0.3, 0.1, 1.2], [1.4, 2.0, 0.2]])
+    species = ['O', 'O']
+
+    rho = np.random.rand(*grid)
+    density_projector = xc.projector.DensityProjector(unitcell, grid, basis_set)
+    V_cell = density_projector.V_cell
+
+    for precompute in [False, True]:
+        if precompute:
+            density_projector.precompute_stencils(positions, species)
+        basis_rep = density_projector.get_basis_rep(rho, positions, species)
+        dEdC = {'O': np.random.rand(*basis_rep['O'].shape)}
+        V = density_projector.get_V(dEdC, positions, species)
+        assert np.allclose(np.sum(V * rho) * V_cell, np.sum(dEdC['O'] * basis_rep['O']))
+
+    # Per atom stencils (not batched)
+    V = 0
+    for i, pos in enumerate(positions):
+        V += density_projector.get_V({'O': dEdC['O'][i:i + 1]}, pos.reshape(-1, 3), ['O'])
+    assert np.allclose(np.sum(V * rho) * V_cell, np.sum(dEdC['O'] * basis_rep['O']))
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('projector_type', ['ortho', 'non-ortho', 'sparse'])
+def test_get_V_parallel(projector_type):
+    from concurrent.futures import ThreadPoolExecutor
+    unitcell = np.eye(3) * 2.5
+    grid = np.array([9, 9, 9])
+    basis_set = {'O': {'n': 2, 'l': 3, 'r_o': 2.0}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}, 'projector_type': projector_type}
+    positions = np.array([[0.3, 0.1, 1.2], [1.4, 2.0, 0.2], [2.4, 0.5, 0.9]])
+    species = ['O', 'H', 'O']
+    density_projector = xc.projector.DensityProjector(unitcell, grid, basis_set)
+    basis_rep = density_projector.get_basis_rep(np.random.rand(*grid), positions, species)
+    dEdC = {spec: np.random.rand(*basis_rep[spec].shape) for spec in basis_rep}
+
+    V_ref = density_projector.get_V(dEdC, positions, species)
+    for precompute in [False, True]:
+        if precompute:
+            density_projector.precompute_stencils(positions, species)
+        for n_slabs in [1, 4, 20]:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                V = density_projector.get_V_parallel(dEdC, positions, species, executor, n_slabs)
+                # Smallest chunks (n_slabs atoms), same order of summation
+                V_chunked = density_projector.get_V_parallel(dEdC, positions, species, executor, n_slabs, max_bytes=1)
+            assert np.allclose(V, V_ref)
+            assert np.array_equal(V, V_chunked)
+
+        # Accumulate into existing (Fortran ordered) buffers
+        out = np.asfortranarray(np.random.rand(*grid))
+        out_0 = out.copy()
+        assert density_projector.get_V(dEdC, positions, species, out=out) is out
+        assert np.allclose(out - out_0, V_ref)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            density_projector.get_V_parallel(dEdC, positions, species, executor, 4, out=out)
+        assert np.allclose(out - out_0, 2 * V_ref)
+
+
+@pytest.mark.fast
+def test_force_corrections_parallel():
+    from concurrent.futures import ThreadPoolExecutor
+    unitcell = np.eye(3) * 5.0
+    grid = np.array([16, 16, 16])
+    basis_set = {'O': {'n': 2, 'l': 3, 'r_o': 2.0}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}}
+    positions = np.array([[0.3, 0.1, 1.2], [1.4, 2.0, 0.2], [2.4, 0.5, 0.9], [4.1, 3.3, 2.7]])
+    species = ['O', 'H', 'O', 'H']
+    density_projector = xc.projector.DensityProjector(unitcell, grid, basis_set)
+    rho = np.random.rand(*grid)
+    basis_rep = density_projector.get_basis_rep(rho, positions, species)
+    dEdC = {spec: np.random.rand(*basis_rep[spec].shape) for spec in basis_rep}
+
+    F_ref = density_projector.get_force_corrections(dEdC, positions, species, rho)
+    for max_workers in [1, 2, 3]:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            F = density_projector.get_force_corrections(dEdC, positions, species, rho, executor=executor)
+        assert np.array_equal(F, F_ref)
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('projector_type', ['ortho', 'fft'])
+def test_delta_projector(projector_type):
+    unitcell = np.eye(3) * 5.0
+    grid = np.array([16, 16, 16])
+    basis_set = {'O': {'n': 2, 'l': 3, 'r_o': 2.0}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}, 'projector_type': projector_type}
+    positions = np.array([[0.3, 0.1, 1.2], [1.4, 2.0, 0.2], [2.4, 0.5, 0.9]])
+    species = ['O', 'H', 'O']
+    rho = np.random.rand(*grid)
+    rho_const = np.random.rand(*grid)
+
+    density_projector = xc.projector.DensityProjector(unitcell, grid, basis_set)
+    basis_rep_ref = density_projector.get_basis_rep(rho - rho_const, positions, species)
+    dEdC = {spec: np.random.rand(*basis_rep_ref[spec].shape) for spec in basis_rep_ref}
+    V_ref, forces_ref = density_projector.get_V(dEdC, positions, species, calc_forces=True, rho=rho - rho_const)
+
+    delta_projector = xc.projector.DeltaProjector(density_projector)
+    delta_projector.set_constant_density(rho_const, positions, species)
+
+    basis_rep = delta_projector.get_basis_rep(rho, positions, species)
+    for spec in basis_rep:
+        assert np.allclose(basis_rep[spec], basis_rep_ref[spec])
+    V, forces = delta_projector.get_V(dEdC, positions, species, calc_forces=True, rho=rho)
+    assert np.allclose(V, V_ref)
+    assert np.allclose(forces, forces_ref)
+
+    # Single atoms (threaded path)
+    basis_rep = delta_projector.get_basis_rep(rho, positions[2:], species[2:])
+    assert np.allclose(basis_rep['O'][0], basis_rep_ref['O'][1])
+
+    # Atoms are matched up to round-off in their positions
+    assert delta_projector.get_atom_indices(positions[::-1] + 1e-9, species[::-1]) == [(2, 1), (1, 0), (0, 0)]
+    with pytest.raises(ValueError):
+        delta_projector.get_atom_indices(positions + 0.1, species)
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('projector_type', ['ortho', 'sparse'])
+def test_delta_projector_binned(projector_type):
+    unitcell = np.eye(3) * 5.0
+    grid = np.array([16, 16, 16])
+    basis_set = {
+        'O': {'n': 2, 'l': 3, 'r_o': 2.0},
+        'H': {'n': 2, 'l': 2, 'r_o': 1.5},
+        'projector_type': projector_type,
+        'offset_tolerance': 0.05
+    }
+    positions = np.array([[0.3, 0.1, 1.2], [1.4, 2.0, 0.2], [2.4, 0.5, 0.9]])
+    species = ['O', 'H', 'O']
+    rng = np.random.RandomState(42)
+    rho = rng.rand(*grid)
+    rho_const = rng.rand(*grid)
+
+    # Same order of calls as NeuralXC.initialize and set_constant_density
+    density_projector = xc.projector.DensityProjector(unitcell, grid, basis_set)
+    density_projector.precompute_stencils(positions, species)
+    basis_rep_ref = density_projector.get_basis_rep(rho - rho_const, positions, species)
+    dEdC = {spec: rng.rand(*basis_rep_ref[spec].shape) for spec in basis_rep_ref}
+    V_ref, forces_ref = density_projector.get_V(dEdC, positions, species, calc_forces=True, rho=rho - rho_const)
+
+    delta_projector = xc.projector.DeltaProjector(density_projector)
+    delta_projector.set_constant_density(rho_const, positions, species)
+    V, forces = delta_projector.get_V(dEdC, positions, species, calc_forces=True, rho=rho)
+    assert np.allclose(V, V_ref)
+    assert np.allclose(forces, forces_ref)
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('projector_type', ['ortho', 'non-ortho', 'behler'])
+def test_compact_box(projector_type):
+
+    unitcell = np.eye(3) * 6
+    grid = np.array([24, 24, 24])
+    basis_set = {'O': {'n': 3, 'l': 3, 'r_o': 2.2}, 'projector_type': projector_type}
+    density_projector = xc.projector.DensityProjector(unitcell, grid, basis_set)
+    basis = density_projector.basis['O']
+    W = density_projector.W['O']
+    rho = np.random.rand(*grid)
+    pos = np.array([1.1, 5.3, 0.2])
+
+    box = density_projector.box_around(pos, basis['r_o'], compact=False)
+    compact_box = density_projector.box_around(pos, basis['r_o'])
+    assert compact_box['mesh'][0].ndim == 1
+    assert np.all(compact_box['radial'][0] <= basis['r_o'])
+    assert len(compact_box['radial'][0]) < 0.6 * box['radial'][0].size
+
+    coeffs = np.random.rand(1, 3 * 9)
+    assert np.allclose(
+        density_projector.project(rho, box, basis, W)[0],
+        density_projector.project(rho, compact_box, basis, W)[0])
+    assert np.allclose(
+        density_projector.get_force_correction(rho, coeffs, box, basis, W),
+        density_projector.get_force_correction(rho, coeffs, compact_box, basis, W))
+
+    V = np.zeros(grid)
+    V_compact = np.zeros(grid)
+    density_projector.add_to_grid(V, box['mesh'], density_projector.build(coeffs, box, basis, W))
+    density_projector.add_to_grid(V_compact, compact_box['mesh'],
+                                  density_projector.build(coeffs, compact_box, basis, W))
+    assert np.allclose(V, V_compact)
+
+
+@pytest.mark.fast
+def test_stencil_library():
+
+    unitcell = np.eye(3) * 6
+    grid = np.array([24, 24, 24])
+    basis_set = {'O': {'n': 3, 'l': 3, 'r_o': 1.9}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}}
+    rho = np.random.rand(*grid)
+
+    # Atoms that are shifted by grid vectors share their stencil
+    density_projector = xc.projector.DensityProjector(unitcell, grid, basis_set)
+    positions = np.array([[1.13, 2.21, 0.37], [1.13 + 0.25 * 3, 2.21, 0.37 - 0.25 * 5]])
+    stencils = [density_projector.get_atom_stencil(pos, 'O') for pos in positions]
+    assert stencils[0]['basis'] is stencils[1]['basis']
+
+    # Binned offsets approximate the exact basis representation
+    species = ['O', 'H']
+    positions = np.array([[1.13, 2.21, 0.37], [4.2, 0.3, 5.9]])
+    basis_rep_ref = density_projector.get_basis_rep(rho, positions, species)
+    for tolerance in [1e-1, 1e-2]:
+        density_projector = xc.projector.DensityProjector(unitcell, grid, dict(basis_set, offset_tolerance=tolerance))
+        density_projector.precompute_stencils(positions, species)
+        basis_rep = density_projector.get_basis_rep(rho, positions, species)
+        for spec in basis_rep:
+            error = np.max(np.abs(basis_rep[spec] - basis_rep_ref[spec]) / np.max(np.abs(basis_rep_ref[spec])))
+            assert 0 < error < tolerance
+
+        # Energy and forces are those of atoms displaced to stencil_position
+        positions_binned = np.array([density_projector.stencil_position(pos) for pos in positions])
+        assert np.all(np.linalg.norm(positions_binned - positions, axis=-1) <= tolerance)
+        exact_projector = xc.projector.DensityProjector(unitcell, grid, basis_set)
+        basis_rep_binned = exact_projector.get_basis_rep(rho, positions_binned, species)
+        dEdC = {spec: np.random.rand(*basis_rep[spec].shape) for spec in basis_rep}
+        forces = density_projector.get_force_corrections(dEdC, positions, species, rho)
+        forces_binned = exact_projector.get_force_corrections(dEdC, positions_binned, species, rho)
+        for spec in basis_rep:
+            assert np.allclose(basis_rep[spec], basis_rep_binned[spec])
+        assert np.allclose(forces[:-3], forces_binned[:-3])
+
+    # cache_memory only sets the budget of the projector itself
+    library_bytes = xc.projector.projector.stencil_library.max_bytes
+    density_projector = xc.projector.DensityProjector(unitcell, grid, dict(basis_set, cache_memory=1))
+    assert density_projector.all_angs.max_bytes == 2**20
+    assert xc.projector.projector.stencil_library.max_bytes == library_bytes
+
+    # Memory budget
+    cache = xc.projector.projector.LRUCache(max_bytes=3 * 800)
+    for i in range(5):
+        cache[i] = {'basis': np.zeros(100)}
+    assert len(cache) == 3 and cache.nbytes == 3 * 800
+    assert 0 not in cache and 4 in cache
+    cache.get(2)
+    cache[5] = np.zeros(100)
+    assert 3 not in cache and 2 in cache
+
+
+@pytest.mark.fast
+def test_fft_projector():
+
+    unitcell = np.eye(3) * 6
+    grid = np.array([30, 30, 30])
+    basis_set = {'O': {'n': 3, 'l': 3, 'r_o': 2.0}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}}
+    x = np.linspace(0, 1, 30, endpoint=False)
+    rho = np.exp(np.sin(2 * np.pi * x)[:, None, None] + np.cos(4 * np.pi * x)[None, :, None] * x[None, None, :])
+
+    ortho_projector = xc.projector.DensityProjector(unitcell, grid, dict(basis_set, projector_type='ortho'))
+    fft_projector = xc.projector.DensityProjector(unitcell, grid, dict(basis_set, projector_type='fft'))
+    species = ['O', 'H', 'O']
+
+    # Exact for atoms on grid points, interpolated otherwise
+    for positions, tolerance in [(np.array([[0, 0, 0], [1.2, 3.4, 5.8], [5.8, 0.4, 2.0]]), 1e-10),
+                                 (np.array([[0.13, 0.37, 2.91], [1.21, 3.3, 5.75], [5.9, 0.45, 2.02]]), 1e-2)]:
+        basis_rep_ref = ortho_projector.get_basis_rep(rho, positions, species)
+        basis_rep = fft_projector.get_basis_rep(rho, positions, species)
+        for spec in basis_rep:
+            assert np.max(np.abs(basis_rep[spec] - basis_rep_ref[spec])) < tolerance * np.max(np.abs(basis_rep_ref[spec]))
+
+    # get_V is the adjoint of get_basis_rep
+    dEdC = {spec: np.random.rand(*basis_rep[spec].shape) for spec in basis_rep}
+    V = fft_projector.get_V(dEdC, positions, species)
+    assert np.allclose(np.sum(V * rho) * fft_projector.V_cell, sum([np.sum(dEdC[s] * basis_rep[s]) for s in basis_rep]))
+
+    assert xc.projector.select_projector_type(unitcell, grid, basis_set, species) == 'ortho'
+    assert xc.projector.select_projector_type(unitcell, grid, basis_set, species * 20) == 'fft'
+
+    # Force corrections are the (negative) derivative of the interpolated coefficients
+    force_corrections = fft_projector.get_force_corrections(dEdC, positions, species, rho)
+    incr = 1e-4
+    for ia, ix in [(0, 0), (1, 2), (2, 1)]:
+        E = []
+        for sign in [1, -1]:
+            positions_shifted = np.array(positions)
+            positions_shifted[ia, ix] += sign * incr
+            basis_rep = fft_projector.get_basis_rep(rho, positions_shifted, species)
+            E.append(sum([np.sum(dEdC[s] * basis_rep[s]) for s in basis_rep]))
+        assert np.allclose(force_corrections[ia, ix], -(E[0] - E[1]) / (2 * incr), rtol=1e-5)
+
+
+@pytest.mark.fast
+def test_sparse_projector():
+
+    density_getter = xc.utils.SiestaDensityGetter(binary=True)
+    rho, unitcell, grid = density_getter.get_density(os.path.join(test_dir, 'benzene_test', 'benzene.RHOXC'))
+
+    basis_set = {'C': {'n': 3, 'l': 3, 'r_o': 2}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}}
+    positions = np.array([[0.0, 0.0, 0.0], [5.1, 4.3, 2.2], [18.0, 10.0, 1.0], [6.0, 4.0, 2.0]])
+    species = ['H', 'C', 'H', 'C']
+
+    ortho_projector = xc.projector.DensityProjector(unitcell, grid, dict(basis_set, projector_type='ortho'))
+    sparse_projector = xc.projector.DensityProjector(unitcell, grid, dict(basis_set, projector_type='sparse'))
+
+    basis_rep_ref = ortho_projector.get_basis_rep(rho, positions, species)
+    basis_rep = sparse_projector.get_basis_rep(rho, positions, species)
+    for spec in basis_rep_ref:
+        assert np.allclose(basis_rep[spec], basis_rep_ref[spec])
+
+    dEdC = {spec: np.random.rand(*basis_rep_ref[spec].shape) for spec in basis_rep_ref}
+    V_ref = ortho_projector.get_V(dEdC, positions, species)
+    V = sparse_projector.get_V(dEdC, positions, species)
+    assert np.allclose(V, V_ref)
+
+
 @pytest.mark.fast
 @pytest.mark.parametrize("symmetrizer_type",[name for name in \
     xc.symmetrizer.BaseSymmetrizer.get_registry() if not name in ['default','base']])
@@ -178,6 +570,205 @@ def test_symmetrizer_rot_invariance_synthetic(symmetrizer_type):
             assert np.allclose(D[spec], D_list[0][spec])
 
 
+@pytest.mark.fast
+@pytest.mark.parametrize("symmetrizer_type",[name for name in \
+    xc.symmetrizer.BaseSymmetrizer.get_registry() if not name in ['default','base']])
+def test_symmetrizer_stateless(symmetrizer_type):
+    from concurrent.futures import ThreadPoolExecutor
+    with open(os.path.join(test_dir, 'h2o_rep.pckl'), 'rb') as file:
+        C = pickle.load(file)
+
+    basis_set = {'O': {'n': 2, 'l': 3, 'r_o': 1}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}}
+    symmetrize_instructions = {'basis': basis_set, 'symmetrizer_type': symmetrizer_type}
+    symmetrizer = xc.symmetrizer.symmetrizer_factory(symmetrize_instructions)
+
+    rng = np.random.RandomState(42)
+    C_list = [{spec: C[spec] * (1 + 0.1 * i) + 0.01 * rng.rand(*C[spec].shape) for spec in C} for i in range(8)]
+    C_list.append({'O': np.stack([C['O']] * 3, axis=0)})  # Several snapshots, only one species
+    dEdD_list = [{spec: rng.rand(*d.shape) for spec, d in symmetrizer.get_symmetrized(c).items()} for c in C_list]
+    reference = [(symmetrizer.get_symmetrized(c), symmetrizer.get_gradient(dEdD, c)) for c, dEdD in zip(C_list, dEdD_list)]
+
+    def evaluate(i):
+        D, ctx = symmetrizer.symmetrize(C_list[i])
+        return D, symmetrizer.get_gradient(dEdD_list[i], ctx)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(evaluate, range(len(C_list))))
+    assert symmetrizer.C is None
+
+    D_list, ctx = symmetrizer.symmetrize_batch(C_list)
+    dEdC_list = symmetrizer.get_gradient(dEdD_list, ctx)
+    assert len(D_list) == len(dEdC_list) == len(C_list)
+
+    for (D_ref, dEdC_ref), (D, dEdC), D_batch, dEdC_batch in zip(reference, results, D_list, dEdC_list):
+        assert D.keys() == D_ref.keys() == D_batch.keys()
+        for spec in D_ref:
+            assert np.allclose(D[spec], D_ref[spec])
+            assert np.allclose(D_batch[spec], D_ref[spec])
+            assert np.allclose(dEdC[spec], dEdC_ref[spec])
+            assert np.allclose(dEdC_batch[spec], dEdC_ref[spec])
+
+
+@pytest.mark.fast
+def test_bispectrum_coupling():
+    from neuralxc.symmetrizer.symmetrizer import gaunt_tensor, bispectrum_coupling
+    n_l = 5
+    gaunt = gaunt_tensor(n_l)
+    # Orthonormality of spherical harmonics
+    assert np.allclose(gaunt[0] * np.sqrt(4 * np.pi), np.eye(n_l**2))
+    # Symmetric in its three indices
+    assert np.allclose(gaunt, gaunt.transpose(1, 0, 2))
+    assert np.allclose(gaunt, gaunt.transpose(0, 2, 1))
+
+    coupling = bispectrum_coupling(n_l)
+    i1, i2, i3 = coupling['index']
+    assert np.allclose(gaunt[i1, i2, i3], coupling['value'])
+    for l1, l2, l3 in coupling['triplets']:
+        assert l1 <= l2 <= l3 <= l1 + l2 and (l1 + l2 + l3) % 2 == 0
+
+    # Real and complex representation of the same coefficients
+    rng = np.random.RandomState(42)
+    c = rng.rand(3, 2 * n_l**2)
+    c_complex = np.dot(c.reshape(3, 2, -1), coupling['complex_to_real'].conj()).reshape(3, -1)
+    symmetrize_instructions = {'basis': {'X': {'n': 2, 'l': n_l}}, 'symmetrizer_type': 'bispectrum'}
+    symmetrizer = xc.symmetrizer.symmetrizer_factory(symmetrize_instructions)
+    D = symmetrizer.get_symmetrized({'X': c})['X']
+    D_complex = symmetrizer.get_symmetrized({'X': c_complex})['X']
+    assert np.allclose(D, D_complex)
+
+
+@pytest.mark.fast
+def test_mixed_casimir_ordering():
+    with open(os.path.join(test_dir, 'h2o_rep.pckl'), 'rb') as file:
+        C = pickle.load(file)
+    basis_set = {'O': {'n': 2, 'l': 3, 'r_o': 1}, 'H': {'n': 2, 'l': 2, 'r_o': 1.5}}
+
+    D = xc.symmetrizer.symmetrizer_factory({'basis': basis_set, 'symmetrizer_type': 'mixed_casimir'}).get_symmetrized(C)
+    D_ref = xc.symmetrizer.symmetrizer_factory({'basis': basis_set, 'symmetrizer_type': 'casimir'}).get_symmetrized(C)
+
+    for spec in D:
+        n, n_l = basis_set[spec]['n'], basis_set[spec]['l']
+        # Invariants ordered by (n1, n2 >= n1, l), diagonal n1 == n2 are the casimirs
+        D_spec = D[spec].reshape(len(D[spec]), -1, n_l)
+        n1, n2 = np.triu_indices(n)
+        assert D_spec.shape[1] == n * (n + 1) // 2
+        assert np.allclose(D_spec[:, n1 == n2].reshape(len(D_spec), -1), D_ref[spec])
+        c = C[spec].reshape(len(C[spec]), n, -1)
+        assert np.allclose(D_spec[:, 1, 0], c[:, 0, 0] * c[:, 1, 0])
+
+
+@pytest.mark.fast
+def test_timer(tmp_path):
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+    from neuralxc.timer import Timer
+
+    timer = Timer()
+
+    def task(i):
+        timer.start('task')
+        timer.start('task:inner')
+        timer.stop('task:inner')
+        timer.stop('task')
+
+    timer.start('outer')
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(task, range(20)))
+
+    with pytest.raises(ValueError):
+        timer.stop('task')
+
+    path = str(tmp_path / 'NXC_TIMING')
+    timer.create_report(path)  # Stops 'outer'
+    report = json.load(open(path + '.json'))
+    assert report['task']['calls'] == 20
+    assert report['outer']['calls'] == 1
+    assert sum([bucket['count'] for bucket in report['task:inner']['histogram']]) == 20
+    assert report['task']['total'] <= report['master']['total'] * report['task']['threads']
+
+    trace = json.load(open(path + '.trace.json'))
+    assert len(trace['traceEvents']) == 41
+    assert all([event['ph'] == 'X' for event in trace['traceEvents']])
+
+
+@pytest.mark.fast
+def test_timer_memory():
+    from neuralxc.timer import Timer
+
+    timer = Timer(memory='tracemalloc')
+    timer.start('outer')
+    kept = np.ones(2**20)
+    timer.start('inner')
+    temporary = np.ones(2**21)
+    del temporary
+    timer.stop('inner')
+    timer.stop('outer')
+
+    report = timer.get_report()
+    assert report['inner']['peak_memory'] >= 2**24
+    assert report['inner']['net_memory'] < 2**20
+    assert report['outer']['peak_memory'] >= 2**24 + 2**23
+    assert report['outer']['net_memory'] >= 2**23
+    assert 'Peak memory (MB)' in timer.format_report()
+
+    with pytest.raises(ValueError):
+        Timer(memory='valgrind')
+
+
+@pytest.mark.fast
+def test_timer_memory_threads():
+    """ A stage started in another thread resets the tracemalloc peak, the
+    peak of a stage that is already running must not get lost
+    """
+    import threading
+    from neuralxc.timer import Timer
+
+    timer = Timer(memory='tracemalloc')
+    allocated, started = threading.Event(), threading.Event()
+
+    def first():
+        timer.start('first')
+        temporary = np.ones(2**21)
+        del temporary
+        allocated.set()
+        started.wait()
+        timer.stop('first')
+
+    def second():
+        allocated.wait()
+        timer.start('second')
+        started.set()
+        timer.stop('second')
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report = timer.get_report()
+    assert report['first']['peak_memory'] >= 2**24
+    assert report['second']['peak_memory'] < 2**24
+
+
+@pytest.mark.fast
+def test_enable_timer():
+    from neuralxc import timer as timer_module
+
+    previous = timer_module.timer._timer
+    try:
+        new_timer = timer_module.enable_timer(memory='rss')
+        assert new_timer.memory == ('rss' if timer_module.rss_available() else 'tracemalloc')
+        # Modules hold the proxy, calls go to the new timer
+        timer_module.timer.start('stage')
+        timer_module.timer.stop('stage')
+        assert new_timer.get_report()['stage']['calls'] == 1
+        assert timer_module.timer.get_report()['stage']['calls'] == 1
+    finally:
+        timer_module.set_timer(previous)
+    assert timer_module.timer._timer is previous
+
+
 @pytest.mark.fast
 def test_formatter():
     with open(os.path.join(test_dir, 'h2o_rep.pckl'), 'rb') as file:
@@ -348,3 +939,138 @@ def test_parallel(use_delta):
     V_parallel = benzene_nxc.get_V(rho, calc_forces=False)[1]
 
     assert np.allclose(V_serial, V_parallel, atol=1e-6, rtol=1e-5)
+
+
+@pytest.mark.skipif(not ase_found, reason='requires ase')
+@pytest.mark.parallel
+@pytest.mark.parametrize('max_workers', [1, 3])
+def test_output_buffer(max_workers):
+
+    benzene_traj = ase.io.read(os.path.join(test_dir, 'benzene_test', 'benzene.xyz'), '0')
+    density_getter = xc.utils.SiestaDensityGetter(binary=True)
+    rho, unitcell, grid = density_getter.get_density(os.path.join(test_dir, 'benzene_test', 'benzene.RHOXC'))
+    positions = benzene_traj.get_positions() / Bohr
+    species = benzene_traj.get_chemical_symbols()
+    benzene_nxc = xc.NeuralXC(os.path.join(test_dir, 'benzene_test', 'benzene'))
+    benzene_nxc.max_workers = max_workers
+    benzene_nxc.initialize(unitcell, grid, positions, species)
+
+    E_ref, (V_ref, forces_ref) = benzene_nxc.get_V(rho, calc_forces=True)
+
+    # Fortran ordered buffer, as passed by SIESTA
+    out = np.asfortranarray(np.random.rand(*grid))
+    out_0 = out.copy()
+    E, (V, forces) = benzene_nxc.get_V(rho, calc_forces=True, out=out, scale=0.5)
+    assert V is out
+    assert np.allclose(E, 0.5 * E_ref)
+    assert np.allclose(out - out_0, 0.5 * V_ref)
+    assert np.allclose(forces, 0.5 * forces_ref)
+
+
+@pytest.mark.skipif(not ase_found, reason='requires ase')
+@pytest.mark.parallel
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('max_workers', [1, 3])
+def test_siesta_buffer(dtype, max_workers):
+    """ SiestaNXC adds V in place into SIESTA's Fortran ordered (maxp, 1)
+    buffer, single precision if SIESTA is compiled with grid_p = sp
+    """
+    from neuralxc.constants import Rydberg
+    benzene_traj = ase.io.read(os.path.join(test_dir, 'benzene_test', 'benzene.xyz'), '0')
+    density_getter = xc.utils.SiestaDensityGetter(binary=True)
+    rho, unitcell, grid = density_getter.get_density(os.path.join(test_dir, 'benzene_test', 'benzene.RHOXC'))
+    positions = benzene_traj.get_positions() / Bohr
+    elements = benzene_traj.get_atomic_numbers()
+
+    # Buffers as passed by SIESTA: grid points in Fortran order, shape (maxp, 1)
+    rho_siesta = np.asfortranarray(rho.T.reshape(-1, 1), dtype=dtype)
+    V_siesta = np.asfortranarray(np.random.rand(rho.size, 1), dtype=dtype)
+    V_0 = V_siesta.copy()
+
+    siesta_nxc = xc.neuralxc.SiestaNXC(os.path.join(test_dir, 'benzene_test', 'benzene'))
+    siesta_nxc.set_max_workers(max_workers)
+    siesta_nxc.initialize(rho_siesta, unitcell.T, grid, positions.T, elements)
+    E = siesta_nxc.get_V(rho_siesta, unitcell.T, grid, positions.T, elements, V_siesta, calc_forces=True)
+
+    # Reference: compute V as a new array, convert and add it to a copy of the buffer
+    E_ref, (V_ref, forces_ref) = siesta_nxc._adaptee.get_V(rho_siesta.reshape(*grid[::-1]).T, calc_forces=True)
+    V_ref = V_0 + (V_ref / Rydberg).T.reshape(-1, 1)
+
+    assert V_siesta.dtype == dtype
+    assert V_siesta.flags.f_contiguous
+    rtol = 1e-5 if dtype == np.float32 else 1e-7
+    assert np.allclose(E, E_ref / Rydberg)
+    assert np.allclose(V_siesta, V_ref, rtol=rtol, atol=rtol * np.max(np.abs(V_ref)))
+    assert np.allclose(siesta_nxc.force_correction, forces_ref[:-3].T / Rydberg)
+    assert np.allclose(siesta_nxc.stress_correction, forces_ref[-3:].T / Rydberg)
+
+
+@pytest.mark.skipif(not ase_found, reason='requires ase')
+@pytest.mark.fast
+def test_numba_threads():
+    """ The numba kernels use all threads unless max_workers is set, the
+    process-wide thread count is restored after get_V
+    """
+    import numba
+    benzene_traj = ase.io.read(os.path.join(test_dir, 'benzene_test', 'benzene.xyz'), '0')
+    density_getter = xc.utils.SiestaDensityGetter(binary=True)
+    rho, unitcell, grid = density_getter.get_density(os.path.join(test_dir, 'benzene_test', 'benzene.RHOXC'))
+    positions = benzene_traj.get_positions() / Bohr
+    species = benzene_traj.get_chemical_symbols()
+    benzene_nxc = xc.NeuralXC(os.path.join(test_dir, 'benzene_test', 'benzene'))
+    benzene_nxc.initialize(unitcell, grid, positions, species)
+    E_ref, V_ref = benzene_nxc.get_V(rho)
+
+    assert benzene_nxc.max_workers == 1
+    assert benzene_nxc.numba_num_threads == numba.config.NUMBA_NUM_THREADS
+    benzene_nxc.projector.kernel = 'numba'
+    previous = numba.get_num_threads()
+    E, V = benzene_nxc.get_V(rho)
+    assert numba.get_num_threads() == previous
+    assert np.allclose(E, E_ref)
+    assert np.allclose(V, V_ref)
+
+    benzene_nxc.max_workers = 1
+    assert benzene_nxc.numba_num_threads == 1
+    with xc.neuralxc.numba_threads(1):
+        assert numba.get_num_threads() == 1
+    assert numba.get_num_threads() == previous
+
+
+@pytest.mark.skipif(not ase_found, reason='requires ase')
+@pytest.mark.skipif(not process_backend_supported(), reason='requires shared memory and fork')
+@pytest.mark.parallel
+@pytest.mark.parametrize('use_delta', [False, True])
+def test_process_backend(use_delta):
+    if not process_backend_supported():
+        pytest.skip('numba thread pool (TBB) started by an earlier test, can not fork')
+
+    benzene_traj = ase.io.read(os.path.join(test_dir, 'benzene_test', 'benzene.xyz'), '0')
+    # Break symmetry
+    positions = benzene_traj.get_positions()
+    positions[0, 1] += 0.05
+    positions[3, 1] += 0.05
+    density_getter = xc.utils.SiestaDensityGetter(binary=True)
+    rho, unitcell, grid = density_getter.get_density(os.path.join(test_dir, 'benzene_test', 'benzene.RHOXC'))
+    positions = positions / Bohr
+    species = benzene_traj.get_chemical_symbols()
+    model = 'dbenzene' if use_delta else 'benzene'
+    if use_delta:
+        drho, _, _ = density_getter.get_density(os.path.join(test_dir, 'benzene_test', 'benzene.DRHO'))
+
+    results = []
+    for max_workers, backend in [(1, 'thread'), (3, 'process')]:
+        benzene_nxc = xc.NeuralXC(os.path.join(test_dir, 'benzene_test', model))
+        benzene_nxc.max_workers = max_workers
+        benzene_nxc.backend = backend
+        benzene_nxc.initialize(unitcell, grid, positions, species)
+        if use_delta:
+            benzene_nxc.set_constant_density(rho - drho)
+        E, V = benzene_nxc.get_V(rho)
+        _, (_, forces) = benzene_nxc.get_V(rho, calc_forces=True)
+        results.append((E, V, forces))
+    benzene_nxc._process_backend.close()
+
+    assert np.allclose(results[0][0], results[1][0])
+    assert np.allclose(results[0][1], results[1][1])
+    assert np.allclose(results[0][2], results[1][2])
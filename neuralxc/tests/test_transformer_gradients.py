@@ -170,3 +170,40 @@ def test_estimator_gradient(use_stacked):
         grad_fd[spec][:, 0, ix] += (Ep - Em) / (2 * incr)
 
     assert np.allclose(grad_analytic[spec], grad_fd[spec])
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('model', ['benzene', 'dbenzene'])
+def test_pipeline_compile(model):
+
+    pipeline = xc.ml.network.load_pipeline(os.path.join(test_dir, 'benzene_test', model))
+    compiled = pipeline.compile()
+    assert len(compiled.steps) == 1
+
+    # Features distributed like the training data (mean and std of the fitted scaler)
+    rng = np.random.RandomState(42)
+    var_selector, scaler = pipeline.steps[0][1], pipeline.steps[1][1]
+    X = {}
+    for spec in var_selector._spec_dict:
+        support = var_selector._spec_dict[spec].get_support()
+        X[spec] = np.zeros([10, 1, len(support)])
+        X[spec][..., support] = scaler._spec_dict[spec].mean_ + \
+            scaler._spec_dict[spec].scale_ * rng.randn(10, 1, np.sum(support))
+    assert np.allclose(pipeline.predict(X), compiled.predict(X))
+    grad, grad_compiled = pipeline.get_gradient(X), compiled.get_gradient(X)
+    for spec in X:
+        assert np.allclose(grad[spec], grad_compiled[spec])
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('whiten', [False, True])
+def test_pca_fold(whiten):
+
+    rng = np.random.RandomState(42)
+    X = {'C': rng.rand(20, 1, 8)}
+    pca = xc.ml.transformer.GroupedPCA(n_components=4, whiten=whiten).fit(X)
+    W, B = {'C': rng.rand(4, 3)}, {'C': rng.rand(3)}
+    W_folded, B_folded = pca.fold(W, B)
+
+    X_pca = pca.transform(X)['C'].reshape(-1, 4)
+    assert np.allclose(X_pca.dot(W['C']) + B['C'], X['C'].reshape(-1, 8).dot(W_folded['C']) + B_folded['C'])
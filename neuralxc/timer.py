@@ -1,4 +1,23 @@
+""" Instrumentation of the hot paths (projection, symmetrizer, ML pipeline,
+potential and force build). Timing is disabled by default, set the environment
+variable NXC_PROFILE to the path of the report (or to 1 to use NXC_TIMING)
+to enable it. The report is written as a table (path), as JSON (path.json) and
+as a Chrome trace-event file (path.trace.json, open with chrome://tracing or
+https://ui.perfetto.dev)
+
+Setting NXC_PROFILE_MEMORY to 'tracemalloc' or 'rss' additionally records
+the peak memory per stage (numpy allocations are traced by tracemalloc, rss
+measures the resident set size of the process, only available on Linux).
+
+Other modules import the module level `timer`, a TimerProxy; use
+enable_timer or set_timer to exchange the timer it forwards to.
+"""
+import os
 import time
+import json
+import atexit
+import threading
+import tracemalloc
 import pandas as pd
 from tabulate import tabulate
 
@@ -10,58 +29,313 @@ class DummyTimer():
     def stop(self, stop, *args, **kwargs):
         pass
 
-    def create_report(self, path, *args, **kwargs):
+    def create_report(self, path=None, *args, **kwargs):
         pass
 
+    def get_report(self):
+        return {}
+
 
 class Timer():
-    def __init__(self):
+    def __init__(self, path='NXC_TIMING', max_events=100000, memory=None):
+        """ Thread-safe timer. Every thread keeps its own running timers,
+        call counts, total times and histograms (powers of two of the
+        duration in ns), which are merged when a report is created.
+
+        Parameters
+        ------------------
+        path, str
+        	Default path of reports
+        max_events, int
+        	Maximum number of events per thread that are stored for the trace
+        memory, str or None
+        	'tracemalloc' or 'rss': record the peak memory of every stage
+        	(relative to its start) and the memory it leaves allocated. Memory
+        	is a property of the process, with several threads the stages
+        	running concurrently are charged for each other's allocations
+        	(and their peaks).
+        	'rss' needs /proc and the resource module (Linux), elsewhere
+        	tracemalloc is used instead.
+        """
+        if not memory in [None, 'tracemalloc', 'rss']:
+            raise ValueError('memory must be one of None, tracemalloc, rss')
         print("NEURALXC: Timer started")
-        self.start_dict = {'master': time.time()}
-        self.cnt_dict = {'master': 1}
-        self.accum_dict = {}
-        self.path = 'NXC_TIMING'
-        self.threaded = False
+        if memory == 'rss' and not rss_available():
+            print("NEURALXC: rss not available on this platform, tracing memory with tracemalloc")
+            memory = 'tracemalloc'
+        self.path = path
+        self.max_events = max_events
+        self.memory = memory
+        if memory == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.threaded = False  # Not used, kept for compatibility
+        self._t0 = time.perf_counter_ns()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = []
 
-    def start(self, name, threadsafe=True):
+    def _state(self):
+        try:
+            return self._local.state
+        except AttributeError:
+            state = {'tid': threading.get_ident(), 'running': {}, 'stats': {}, 'events': []}
+            with self._lock:
+                self._threads.append(state)
+            self._local.state = state
+            return state
+
+    def _sample_memory(self):
+        """ Current and peak memory in bytes. The peak is the one since the
+        last reset (tracemalloc) or the high-water mark of the process (rss)
+        """
+        if self.memory == 'tracemalloc':
+            return tracemalloc.get_traced_memory()
+        import resource
+        with open('/proc/self/statm') as file:
+            current = int(file.read().split()[1]) * resource.getpagesize()
+        return current, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
-        if not (self.threaded and not threadsafe):
-            if name in self.cnt_dict:
-                self.cnt_dict[name] += 1
-            else:
-                self.cnt_dict[name] = 1
+    def _observe_memory(self):
+        """ Sample memory and pass the peak on to the running stages of all
+        threads, so that resetting the (process-wide) tracemalloc peak does not
+        lose it. Has to be called with self._lock held.
+        """
+        current, peak = self._sample_memory()
+        for state in self._threads:
+            for entry in state['running'].values():
+                entry['peak'] = max(entry['peak'], peak)
+        return current, peak
 
-            if not name in self.start_dict:
-                self.start_dict[name] = time.time()
+    def start(self, name, threadsafe=True):
+        """ Start timer name in the calling thread. Nested calls with the same
+        name are counted, but the time is measured from the outermost call.
+        (threadsafe is ignored, all timers are thread-safe)
+        """
+        state = self._state()
+        if not name in state['stats']:
+            state['stats'][name] = {'calls': 0, 'total': 0, 'histogram': {}, 'peak_memory': 0, 'net_memory': 0}
+        state['stats'][name]['calls'] += 1
+        if name in state['running']:
+            return
+        if self.memory:
+            with self._lock:
+                current, peak = self._observe_memory()
+                if self.memory == 'tracemalloc' and hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                entry = {'memory': current, 'peak': current, 'high_water_mark': peak}
+                entry['begin'] = time.perf_counter_ns()
+                state['running'][name] = entry
+        else:
+            state['running'][name] = {'begin': time.perf_counter_ns()}
 
     def stop(self, name, threadsafe=True):
+        end = time.perf_counter_ns()
+        state = self._state()
+        if not name in state['running']:
+            raise ValueError('Timer with name {} was never started'.format(name))
+        if self.memory:
+            # Other threads may reset the peak as soon as this stage is no longer running
+            with self._lock:
+                current, peak = self._observe_memory()
+                entry = state['running'].pop(name)
+        else:
+            entry = state['running'].pop(name)
+        duration = end - entry['begin']
+        stats = state['stats'][name]
+        stats['total'] += duration
+        bucket = duration.bit_length()
+        stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+        if len(state['events']) < self.max_events:
+            state['events'].append((name, entry['begin'], duration))
+
+        if self.memory:
+            if self.memory == 'tracemalloc':
+                peak = max(entry['peak'], peak)
+            elif peak <= entry['high_water_mark']:
+                # High-water mark not exceeded during this stage, only know the end points
+                peak = max(entry['memory'], current)
+            stats['peak_memory'] = max(stats['peak_memory'], peak - entry['memory'])
+            stats['net_memory'] += current - entry['memory']
+
+    def get_report(self):
+        """ Merge the statistics of all threads
+
+        Returns
+        ------------
+        dict
+        	{name: {'calls', 'threads', 'total', 'per_call', 'percent', 'histogram'}},
+        	times in seconds, percent is relative to 'master' (time since
+        	creation of the timer). histogram lists the number of calls
+        	that took at most 'max' seconds. If memory is tracked, 'peak_memory'
+        	(max. over calls and threads) and 'net_memory' (sum) in bytes are added
+        """
+        master = time.perf_counter_ns() - self._t0
+        with self._lock:
+            threads = list(self._threads)
 
-        if not (self.threaded and not threadsafe):
-            if name in self.start_dict:
-                if name in self.accum_dict:
-                    self.accum_dict[name] += time.time() - self.start_dict[name]
-                else:
-                    self.accum_dict[name] = time.time() - self.start_dict[name]
+        merged = {
+            'master': {
+                'calls': 1,
+                'threads': 1,
+                'total': master,
+                'histogram': {
+                    master.bit_length(): 1
+                },
+                'peak_memory': 0,
+                'net_memory': 0
+            }
+        }
+        for state in threads:
+            for name, stats in list(state['stats'].items()):
+                if not name in merged:
+                    merged[name] = {'calls': 0, 'threads': 0, 'total': 0, 'histogram': {}, 'peak_memory': 0, 'net_memory': 0}
+                merged[name]['calls'] += stats['calls']
+                merged[name]['threads'] += 1
+                merged[name]['total'] += stats['total']
+                merged[name]['peak_memory'] = max(merged[name]['peak_memory'], stats['peak_memory'])
+                merged[name]['net_memory'] += stats['net_memory']
+                for bucket, count in list(stats['histogram'].items()):
+                    merged[name]['histogram'][bucket] = merged[name]['histogram'].get(bucket, 0) + count
 
-                self.start_dict.pop(name)
-            else:
-                raise ValueError('Timer with name {} was never started'.format(name))
+        report = {}
+        for name, stats in merged.items():
+            report[name] = {
+                'calls': stats['calls'],
+                'threads': stats['threads'],
+                'total': stats['total'] * 1e-9,
+                'per_call': stats['total'] * 1e-9 / max(stats['calls'], 1),
+                'percent': stats['total'] / master * 100,
+                'histogram': [{
+                    'max': 2**bucket * 1e-9,
+                    'count': stats['histogram'][bucket]
+                } for bucket in sorted(stats['histogram'])]
+            }
+            if self.memory:
+                report[name]['peak_memory'] = stats['peak_memory']
+                report[name]['net_memory'] = stats['net_memory']
+        return report
+
+    def export_trace(self, path):
+        """ Write all recorded events in the Chrome trace-event format
+        """
+        pid = os.getpid()
+        with self._lock:
+            threads = list(self._threads)
+        events = []
+        for state in threads:
+            for name, begin, duration in list(state['events']):
+                events.append({
+                    'name': name,
+                    'cat': name.split(':')[0],
+                    'ph': 'X',
+                    'ts': (begin - self._t0) * 1e-3,
+                    'dur': duration * 1e-3,
+                    'pid': pid,
+                    'tid': state['tid']
+                })
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
 
     def create_report(self, path=None):
-        keys = list(self.start_dict.keys())
-        for key in keys:
-            if not key in self.accum_dict:
-                self.stop(key)
-
-        report = pd.DataFrame.from_dict(self.accum_dict, orient='index', columns=['Total time'])
-        report['Calls'] = pd.DataFrame.from_dict(self.cnt_dict, orient='index', columns=['Calls'])
-        report['Time per call'] = report['Total time'] / report['Calls']
-        report["% of master"] = report['Total time'] / report['Total time'].loc['master'] * 100
-        if path:
-            open(path, 'w').write(tabulate(report, tablefmt="pipe", headers="keys"))
-        else:
-            print(report)
+        """ Stop running timers of the calling thread and write the report
+        to path (table), path.json and path.trace.json
+        """
+        path = path or self.path
+        for name in list(self._state()['running']):
+            self.stop(name)
+
+        report = self.get_report()
+        with open(path, 'w') as file:
+            file.write(self.format_report(report))
+        with open(path + '.json', 'w') as file:
+            json.dump(report, file, indent=2)
+        self.export_trace(path + '.trace.json')
+
+    def format_report(self, report=None):
+        """ Report (see get_report) as a table
+        """
+        if report is None:
+            report = self.get_report()
+        table = pd.DataFrame.from_dict(report, orient='index')
+        columns = {'total': 'Total time', 'calls': 'Calls', 'per_call': 'Time per call', 'percent': '% of master'}
+        if self.memory:
+            table['peak_memory'] /= 2**20
+            table['net_memory'] /= 2**20
+            columns.update({'peak_memory': 'Peak memory (MB)', 'net_memory': 'Net memory (MB)'})
+        table = table[list(columns)]
+        table.columns = list(columns.values())
+        return tabulate(table, tablefmt="pipe", headers="keys")
+
+
+def rss_available():
+    """ Whether the resident set size can be measured (Linux)
+    """
+    try:
+        import resource
+    except ImportError:
+        return False
+    return os.path.exists('/proc/self/statm')
+
+
+class TimerProxy():
+    """ Forwards to the active timer (Timer or DummyTimer). Modules keep a
+    reference to the proxy, so the timer can be exchanged at runtime.
+    """
+    def __init__(self, timer):
+        self._timer = timer
+
+    def start(self, name, *args, **kwargs):
+        self._timer.start(name, *args, **kwargs)
+
+    def stop(self, name, *args, **kwargs):
+        self._timer.stop(name, *args, **kwargs)
+
+    def __getattr__(self, attr):
+        if attr == '_timer':
+            raise AttributeError(attr)
+        return getattr(self._timer, attr)
+
+
+def get_timer():
+    """ Timer if the environment variable NXC_PROFILE (or NXC_PROFILE_MEMORY)
+    is set, DummyTimer (no overhead) otherwise
+    """
+    path = os.environ.get('NXC_PROFILE', '')
+    memory = os.environ.get('NXC_PROFILE_MEMORY', '')
+    if path in ['', '0'] and memory in ['', '0']:
+        return DummyTimer()
+    path = 'NXC_TIMING' if path in ['', '0', '1'] else path
+    memory = None if memory in ['', '0'] else ('tracemalloc' if memory == '1' else memory)
+    timer = Timer(path, memory=memory)
+    atexit.register(timer.create_report)
+    return timer
+
+
+def set_timer(new_timer):
+    """ Make new_timer the timer used by all modules. A Timer created from
+    the environment (get_timer) no longer writes its report at exit.
+    """
+    if isinstance(timer._timer, Timer):
+        atexit.unregister(timer._timer.create_report)
+    timer._timer = new_timer
+
+
+def enable_timer(path='NXC_TIMING', memory=None):
+    """ Replace the active timer by a new Timer
+
+    Parameters
+    ------------------
+    path, str
+    	Default path of reports
+    memory, str or None
+    	see Timer
+    Returns
+    ------------
+    Timer
+    """
+    new_timer = Timer(path, memory=memory)
+    set_timer(new_timer)
+    return new_timer
 
 
-# timer = Timer()
-timer = DummyTimer()
+timer = TimerProxy(get_timer())